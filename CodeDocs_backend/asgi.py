@@ -13,6 +13,7 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import file_manager.routing
+from file_manager.ownership import OwnershipLifespan
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CodeDocs_backend.settings')
 
@@ -21,4 +22,6 @@ application = ProtocolTypeRouter({
     "websocket":     URLRouter(
             file_manager.routing.websocket_urlpatterns
     ),
+    # the files of the worker are handed off on shutdown
+    "lifespan": OwnershipLifespan(),
 })
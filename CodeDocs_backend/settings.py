@@ -37,13 +37,77 @@ SITE_NAME = 'code_docs'
 CHANNEL_LAYERS = {
     "default": {
         # "BACKEND": "channels.layers.InMemoryChannelLayer",  # local-development
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # channels_redis.core.RedisChannelLayer which delivers to the group members in the same process directly
+        "BACKEND": "file_manager.channel_layers.HybridChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
         },
     },
 }
 
+# websocket consumer of the editor (file_manager.consumers.FileEditorConsumer or
+# file_manager.async_consumers.AsyncFileEditorConsumer which does not take a thread for every message)
+FILE_EDITOR_CONSUMER = 'file_manager.consumers.FileEditorConsumer'
+
+# connections of the opened files (file_manager.presence.RedisPresence or MemoryPresence for a single worker)
+PRESENCE_BACKEND = 'file_manager.presence.RedisPresence'
+PRESENCE_REDIS_URL = 'redis://127.0.0.1:6379/0'
+# a connection without messages for this number of seconds is removed by `manage.py prune_presences`,
+# an idle client sends {"type": "heartbeat"} more often to stay in the room
+PRESENCE_MAX_AGE = 60
+# a connection updates its presence at most once in this number of seconds
+PRESENCE_TOUCH_INTERVAL = 10
+# users with access of the opened files and their last changes (file_manager.roster.RedisRoster or MemoryRoster)
+ROSTER_BACKEND = 'file_manager.roster.RedisRoster'
+ROSTER_REDIS_URL = 'redis://127.0.0.1:6379/0'
+ROSTER_CHANGES_SIZE = 100
+# cursors of a file are sent this number of times a second, only the last cursor of a user (0 - every cursor at once)
+CURSOR_FLUSH_RATE = 20
+# json codec of the websocket messages (file_manager.codec.OrjsonCodec or JsonCodec), None - orjson when it is installed
+JSON_CODEC = None
+# the connection which sent operations gets {'type': 'ack', ...} with their revisions instead of the operations
+OPERATION_ACK = False
+# milliseconds the messages to a room are gathered and sent as one batch message (0 - every message at once)
+GROUP_BATCH_INTERVAL = 0
+# a file is owned by one worker chosen by consistent hashing, the other workers forward its document messages
+FILE_OWNERSHIP = False
+# live workers (file_manager.ownership.RedisWorkers or MemoryWorkers)
+WORKERS_BACKEND = 'file_manager.ownership.RedisWorkers'
+WORKERS_REDIS_URL = 'redis://127.0.0.1:6379/0'
+# seconds since the last heartbeat after which a worker is considered dead
+WORKER_MAX_AGE = 30
+# points of a worker on the hash ring
+FILE_OWNER_REPLICAS = 64
+# seconds for the owner of a file to ack a forwarded message, then the client gets an error (504)
+FORWARD_TIMEOUT = 5
+# the output of a running file is paced: sent at most once per this number of milliseconds and at most
+# RUN_OUTPUT_CHUNK_SIZE bytes at once, whatever the speed of the room
+RUN_OUTPUT_PACING_INTERVAL = 50
+RUN_OUTPUT_CHUNK_SIZE = 16 * 1024
+# bytes of the output of a run sent to the room, the rest is dropped (0 - no limit)
+RUN_OUTPUT_LIMIT = 1024 * 1024
+
+# number of the last operations of an opened file kept in memory
+DOCUMENT_OPERATIONS_LOG_SIZE = 1000
+# in-memory representation of an opened file (file_manager.document_buffer.StringBuffer or Rope)
+DOCUMENT_BUFFER = 'file_manager.document_buffer.Rope'
+# the opened file in memory is authoritative only when every file is written by one process: the owner of the file
+# (FILE_OWNERSHIP) or the only ASGI worker (SINGLE_WORKER). Otherwise, e.g. several workers behind a load balancer,
+# the operations are serialized by a lock of the file row and written at once ('sync' durability)
+SINGLE_WORKER = False
+# 'write_behind' - opened files are written by a background thread, 'sync' - every operation is written at once.
+# Without SINGLE_WORKER or FILE_OWNERSHIP 'write_behind' falls back to 'sync', a warning is logged at startup
+DOCUMENT_DURABILITY = 'write_behind'
+# write-behind flush policy: seconds since the first unsaved operation or number of unsaved operations
+DOCUMENT_FLUSH_INTERVAL = 2
+DOCUMENT_FLUSH_OPERATIONS = 100
+# number of the last revisions whose operations survive `manage.py compact_operations`,
+# which also composes the neighbouring operations of one channel older than DOCUMENT_RESYNC_OPERATIONS revisions
+DOCUMENT_OPERATIONS_RETENTION = 1000
+# a client behind by more operations or bytes of operations text is sent the content ('resync')
+DOCUMENT_RESYNC_OPERATIONS = 500
+DOCUMENT_RESYNC_BYTES = 256 * 1024
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -19,3 +19,11 @@ class UserRegistrationSerializer(UserCreateSerializer):
 
     class Meta(UserCreateSerializer.Meta):
         fields = ('id', 'username', 'email', 'password', 'account_color')
+
+
+def serialize_user(user):
+    # the data of UserSerializer without the field introspection of a serializer instance
+    return {'id': user.id,
+            'username': str(user.username),
+            'email': str(user.email),
+            'account_color': user.account_color}
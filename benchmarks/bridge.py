@@ -0,0 +1,61 @@
+"""
+Cost of the transformation of a client operation by Document.transform, the call path of the consumers.
+
+    DJANGO_SETTINGS_MODULE=CodeDocs_backend.settings python -m benchmarks.bridge
+"""
+import random
+import timeit
+
+import django
+
+django.setup()
+
+from file_manager.document import Document  # noqa: E402
+from benchmarks.transform import random_operation  # noqa: E402
+
+
+def main(history_size=400, repeat=5):
+    random.seed(0)
+    scenarios = [
+        # everyone edits everywhere
+        ('dense', [random_operation() for _ in range(history_size)], [random_operation() for _ in range(100)]),
+        # the others edit below the client
+        ('remote', [random_operation(2000, 3000) for _ in range(history_size)],
+         [random_operation(0, 1000) for _ in range(100)]),
+    ]
+
+    for scenario, history, operations in scenarios:
+        document = Document(1, 'x' * 3000, 0)
+        # the history is not in the database, the benchmark does not need one
+        for operation in history:
+            document.add_operation(operation, 'another_channel')
+
+        def new_bridge():
+            for operation in operations:
+                document.bridges.clear()
+                document.transform(operation, 0, 'channel')
+
+        def new_bridge_built_at_once():
+            # the bridge as it was built before the lazy history
+            for operation in operations:
+                bridge = document.history_bridge(0, 'channel')
+                bridge.build()
+                bridge.transform(operation)
+
+        def pipelined_operations():
+            # the next operation of the client is not based on the history yet
+            for operation in operations:
+                document.bridges.clear()
+                document.transform(operation, 0, 'channel')
+                document.transform(operation, 0, 'channel')
+
+        for name, benchmark in [('new bridge', new_bridge),
+                                ('new bridge built at once', new_bridge_built_at_once),
+                                ('new bridge and a pipelined operation', pipelined_operations)]:
+            best = min(timeit.repeat(benchmark, number=1, repeat=repeat))
+            print(f"{scenario} {name}: {best / len(operations) * 1e6:.0f} us per operation, "
+                  f"{history_size} operations behind")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Cost of the websocket payloads built by the serializers and by the plain functions.
+
+    DJANGO_SETTINGS_MODULE=CodeDocs_backend.settings python -m benchmarks.serializers
+"""
+import json
+import timeit
+
+import django
+
+django.setup()
+
+from authentication.models import CustomUser  # noqa: E402
+from file_manager.models import File, UserFiles, Operations, Access  # noqa: E402
+from file_manager.serializers import (  # noqa: E402
+    UserWithAccessSerializer, FileSerializer, OperationSerializer, serialize_user_with_access, serialize_file,
+    serialize_operation, serialize_operations
+)
+
+
+def main(number=10000, repeat=5):
+    # the instances are not saved, the benchmark does not need a database
+    user = CustomUser(id=1, username='Igor Mashtakov', email='masht@mail.ru', account_color='#ffffff')
+    file = File(id='1', name='file_1', programming_language='python', content='x' * 1000, last_revision=100)
+    user_with_access = UserFiles(user=user, file=file, access=Access.OWNER)
+    operation = Operations(file=file, type=Operations.Type.INSERT, position=10, text='x', revision=100,
+                           channel_name='channel_1')
+    operations = [operation] * 10
+
+    benchmarks = [
+        ('operation', lambda: OperationSerializer(operation).data, lambda: serialize_operation(operation)),
+        ('10 operations', lambda: OperationSerializer(operations, many=True).data,
+         lambda: serialize_operations(operations)),
+        ('file', lambda: FileSerializer(file).data, lambda: serialize_file(file)),
+        ('user with access', lambda: UserWithAccessSerializer(user_with_access).data,
+         lambda: serialize_user_with_access(user_with_access)),
+    ]
+
+    for name, serializer, function in benchmarks:
+        assert json.dumps(serializer()) == json.dumps(function())
+        serializer_time = min(timeit.repeat(serializer, number=number, repeat=repeat)) / number
+        function_time = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+        print(f"{name}: serializer {serializer_time * 1e6:.1f} us, function {function_time * 1e6:.2f} us, "
+              f"{serializer_time / function_time:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Cost of one operation transformation.
+
+    python -m benchmarks.transform
+"""
+import random
+import timeit
+
+from file_manager.operations import Insert, Delete, NeutralOperation
+from file_manager.bulk_transform import OperationColumns, python_transform, numpy_transform, numpy
+
+
+def random_operation(first_position=0, last_position=1000):
+    position = random.randint(first_position, last_position)
+    kind = random.random()
+    if kind < 0.45:
+        return Insert(position, "x" * random.randint(1, 5))
+    elif kind < 0.9:
+        return Delete(position, "x" * random.randint(1, 5))
+    return NeutralOperation()
+
+
+def main(history_size=1000, repeat=5):
+    random.seed(0)
+    scenarios = [
+        # everyone edits everywhere
+        ('dense', [random_operation() for _ in range(history_size)], [random_operation() for _ in range(100)]),
+        # the others edit below the client
+        ('remote', [random_operation(2000, 3000) for _ in range(history_size)],
+         [random_operation(0, 1000) for _ in range(100)]),
+    ]
+
+    for scenario, history, operations in scenarios:
+        columns = OperationColumns()
+        for operation in history:
+            info = operation.info()
+            columns.add(info['type'], info.get('position'), info.get('text'))
+
+        def transform():
+            for operation in operations:
+                for prev_operation in history:
+                    operation /= prev_operation
+
+        def run(bulk_transform):
+            return lambda: [bulk_transform(operation, columns) for operation in operations]
+
+        benchmarks = [('transform', transform), ('python bulk transform', run(python_transform))]
+        if numpy is not None:
+            benchmarks.append(('numpy bulk transform', run(numpy_transform)))
+
+        for name, benchmark in benchmarks:
+            best = min(timeit.repeat(benchmark, number=1, repeat=repeat))
+            print(f"{scenario} {name}: {best / (len(operations) * len(history)) * 1e9:.0f} ns per operation pair")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class FileManagerConfig(AppConfig):
     name = 'file_manager'
+
+    def ready(self):
+        from .persistence import check_durability
+        check_durability()
@@ -0,0 +1,279 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.exceptions import InvalidToken
+from channels.exceptions import StopConsumer
+from rest_framework import status
+
+from .models import File
+from .serializers import serialize_operations
+from authentication.serializers import serialize_user
+from .exceptions import FileManageException, ResyncRequiredException
+from .run_file import RunFileTask
+from .editor import FileEditorMixin
+from .outbox import encode_batch
+from .codec import get_codec
+from .ownership import FORWARDED_MESSAGES
+from .roster import get_active_users, get_all_users, get_roster_since
+from .catch_websocket_exceptions import catch_async_websocket_exception
+
+
+class AsyncFileEditorConsumer(FileEditorMixin, AsyncJsonWebsocketConsumer):
+    """
+    FileEditorConsumer which does not take a thread for every message:
+    the ORM and the document locks are called through database_sync_to_async, the channel layer is awaited.
+    """
+
+    async def connect(self):
+        await self.accept()
+
+        # get current user
+        try:
+            self.scope['user'] = await database_sync_to_async(self.get_user)()
+        except InvalidToken as e:
+            await self.close_connection(e.status_code)
+
+        if not self.scope['user'].is_authenticated:
+            await self.close_connection(status.HTTP_401_UNAUTHORIZED)
+
+        # get file
+        try:
+            self.file = await database_sync_to_async(File.decode)(self.scope['url_route']['kwargs']['file_id'])
+        except FileManageException as e:
+            await self.close_connection(e.response_status)
+
+        self.room_group_name = f"file_{self.file.pk}"
+        if self.ownership is None:
+            self.document = self.documents_manager.open_document(self.file)
+        else:
+            # the document is opened by the first message handled here
+            await self.ownership.start(self.channel_layer)
+
+        # Join room group
+        await self.channel_layer.group_add(self.room_group_name,
+                                           self.channel_name)
+        new_user = await database_sync_to_async(self.join_room)()
+
+        await self.send_json({'type': 'channel_name',
+                              'channel_name': self.channel_name})
+
+        await self.send_json({'type': 'file_status',
+                              'is_running': self.launched_file_manager.file_is_running(self.file.pk)})
+
+        if new_user is not None:
+            await self.send_to_group({'type': 'new_user',
+                                      'user': new_user})
+
+    async def close_connection(self, http_code):
+        await self.close(4000 + http_code)
+        raise StopConsumer()
+
+    @classmethod
+    async def decode_json(cls, text_data):
+        return get_codec().loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return get_codec().dumps(content)
+
+    async def send_text(self, event):
+        await self.send(text_data=self.message_text(event))
+
+    async def close_forwarded(self, event):
+        await self.close(event['code'])
+
+    async def forward_timeout(self, event):
+        # the owner of the file has not acked the forwarded message
+        await self.send_error(event['content_type'], status.HTTP_504_GATEWAY_TIMEOUT)
+
+    async def send_batch(self, event):
+        await self.send(text_data=encode_batch(self.message_text(message) for message in event['messages']))
+
+    async def send_to_group(self, content, ack=None):
+        await self.outbox.send(self.channel_layer, self.room_group_name, self.group_message(content, ack))
+
+    async def send_error(self, package_type, error_code, message=""):
+        await self.send_json({"type": package_type,
+                              "error_code": 4000 + error_code,
+                              "message": message})
+
+    async def receive_json(self, content, **kwargs):
+        if self.touch_is_due():
+            # the presence backend can block on the network
+            await sync_to_async(self.presence.touch, thread_sensitive=False)(self.room_group_name, self.channel_name)
+        if content['type'] in FORWARDED_MESSAGES and not await self.handles_document():
+            await self.forward(content)
+            return
+        await getattr(self, content['type'])(content)
+
+    async def handles_document(self):
+        """
+        The document of the file is handled by this worker, otherwise by the owner of the file (FILE_OWNERSHIP).
+        """
+        if self.document_is_remote():
+            return False
+        if self.document_is_stale():
+            await database_sync_to_async(self.open_document)()
+        return True
+
+    async def forward(self, content):
+        await self.ownership.forward(self.file.pk, self.forward_message(content))
+
+    @catch_async_websocket_exception([])
+    async def file_info(self, event):
+        await self.send_json({**event,
+                              'file': await database_sync_to_async(self.get_file_data)()})
+
+    @catch_async_websocket_exception([])
+    async def active_users(self, event):
+        users = await database_sync_to_async(get_active_users)(self.room_group_name, self.file.pk)
+        await self.send_json({**event,
+                              'users': users})
+
+    @catch_async_websocket_exception([])
+    async def all_users(self, event):
+        users = await database_sync_to_async(get_all_users)(self.room_group_name, self.file.pk)
+        await self.send_json({**event,
+                              'users': users})
+
+    @catch_async_websocket_exception([])
+    async def roster(self, event):
+        # the changes since the version of the client or the whole roster
+        roster = await database_sync_to_async(get_roster_since)(self.room_group_name, self.file.pk,
+                                                                event.get('version'))
+        await self.send_json({'type': event['type'],
+                              **roster})
+
+    @catch_async_websocket_exception(['config'])
+    async def change_file_config(self, event):
+        await self.send_to_group({'type': event['type'],
+                                  'file': await database_sync_to_async(self.save_file_config)(event['config'])})
+
+    @catch_async_websocket_exception(['new_access'])
+    async def change_link_access(self, event):
+        await database_sync_to_async(self.save_link_access)(event['new_access'])
+        await self.send_to_group(event)
+
+    @catch_async_websocket_exception(['another_user_id', 'new_access'])
+    async def change_user_access(self, event):
+        error_code, another_user = await database_sync_to_async(self.save_user_access)(event['another_user_id'],
+                                                                                       event['new_access'])
+        if error_code:
+            await self.send_error(event['type'], error_code)
+        else:
+            await self.send_to_group({'type': event['type'],
+                                      'user': another_user})
+
+    async def heartbeat(self, event):
+        # a client without other messages sends it more often than PRESENCE_MAX_AGE to stay in the room
+        await sync_to_async(self.touch, thread_sensitive=False)()
+
+    async def refresh_access(self, event):
+        # the access is read from the database, the message can come from the client too
+        self.access = await database_sync_to_async(self.get_access)()
+
+    @catch_async_websocket_exception(['revision', 'operation'])
+    async def apply_operation(self, event):
+        await self.apply(event, [event['operation']])
+
+    @catch_async_websocket_exception(['revision', 'operations'])
+    async def apply_operations(self, event):
+        await self.apply(event, event['operations'])
+
+    async def apply(self, event, operations):
+        try:
+            operation_queries = await database_sync_to_async(self.apply_to_document)(operations, event['revision'])
+        except ResyncRequiredException:
+            await self.resync()
+            return
+        except FileManageException as e:
+            await self.send_error(event['type'], e.response_status)
+            return
+
+        if operation_queries:
+            message, ack = self.applied_messages(event, operation_queries)
+            await self.send_to_group(message, ack=ack)
+
+    @catch_async_websocket_exception(['revision'])
+    async def operation_history(self, event):
+        try:
+            operations = await database_sync_to_async(self.document.operations_since)(event['revision'])
+        except ResyncRequiredException:
+            await self.resync()
+            return
+
+        operations_data = serialize_operations(operations)
+        await self.send_json({'type': event['type'],
+                              'operations': operations_data})
+
+    async def resync(self):
+        # the lock of the document is held by the transformations in the threads
+        await self.send_json(await database_sync_to_async(self.resync_message)())
+
+    @catch_async_websocket_exception(['position'])
+    async def change_cursor_position(self, event):
+        await self.cursor_coalescer.add(self.channel_layer, self.room_group_name, self.scope['user'].pk,
+                                        {**event, 'user_id': self.scope['user'].pk})
+
+    async def send_cursors(self, event):
+        for cursor in event['cursors']:
+            await self.send(text_data=cursor)
+
+    @catch_async_websocket_exception([])
+    async def run_file(self, event):
+        await database_sync_to_async(self.get_file_data)()
+
+        if self.launched_file_manager.file_is_running(file_id=self.file.pk):
+            await self.send_error(event['type'], status.HTTP_409_CONFLICT)
+        else:
+            # create RunFileTask when the file is not running
+            run_file_task = RunFileTask(self.file.pk, self.file.content, self.file.programming_language, self)
+            try:
+                self.launched_file_manager.add_running_file(self.file.pk, run_file_task)
+
+                await self.send_to_group({"type": "START run_file"})
+                await run_file_task.start()
+            except FileManageException as e:
+                await self.send_error(event['type'], e.response_status)
+
+    async def file_output(self, file_output):
+        await self.send_to_group({'type': 'file_output',
+                                  'file_output': file_output,
+                                  'index': self.file_output_index})
+        self.file_output_index += 1
+
+    @catch_async_websocket_exception(['file_input'])
+    async def file_input(self, event):
+        self.launched_file_manager.get_thread_by_file_id(self.file.pk).add_input(event['file_input'])
+
+    @catch_async_websocket_exception([])
+    async def stop_file(self, event):
+        try:
+            file_thread = self.launched_file_manager.get_thread_by_file_id(self.file.pk)
+            file_thread.close()
+
+            self.launched_file_manager.remove_stopped_file(self.file.pk)
+            self.file_output_index = 0
+        except FileManageException as e:
+            await self.send_error(event['type'], e.response_status)
+
+    async def disconnect(self, code):
+        handles_document = await self.handles_document()
+        # the bridge is removed under the lock of the document
+        user_ids = await database_sync_to_async(self.leave_room)(handles_document)
+
+        # leave room
+        if self.scope['user'].pk not in user_ids:
+            user_data = serialize_user(self.scope['user'])
+            await self.send_to_group({'type': 'delete_user',
+                                      'user': user_data})
+
+        if not handles_document:
+            # the owner of the file removes the bridge and closes the room
+            await self.ownership.forward(self.file.pk, {'type': 'forward_disconnect',
+                                                        'channel_name': self.channel_name,
+                                                        'user_id': self.scope['user'].pk,
+                                                        'last': not user_ids})
+
+        await self.channel_layer.group_discard(self.room_group_name,
+                                               self.channel_name)
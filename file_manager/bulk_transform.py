@@ -0,0 +1,108 @@
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .operations import NEUTRAL_OPERATION, Insert, Delete
+
+
+OPERATIONS = {1: Insert, 2: Delete}
+# the position of a neutral operation, it never changes another operation
+NEUTRAL_POSITION = sys.maxsize
+
+# shorter histories are faster without numpy
+NUMPY_MIN_HISTORY = 64
+NUMPY_BLOCK_SIZE = 256
+
+
+class OperationColumns:
+    """
+    History of operations as columns of types, positions and texts.
+    """
+    __slots__ = ('types', 'positions', 'texts', 'numpy_arrays')
+
+    def __init__(self, rows=()):
+        self.types = []
+        self.positions = []
+        self.texts = []
+        self.numpy_arrays = None
+        for row in rows:
+            self.add(*row)
+
+    def add(self, type_operation, position, text):
+        self.types.append(type_operation)
+        self.positions.append(NEUTRAL_POSITION if type_operation == 0 else position)
+        self.texts.append(text)
+
+    def add_queries(self, operation_queries):
+        for operation_query in operation_queries:
+            self.add(operation_query.type, operation_query.position, operation_query.text)
+
+    def __len__(self):
+        return len(self.types)
+
+    def arrays(self):
+        # positions and prefix sums of the inserted text lengths
+        if self.numpy_arrays is None or len(self.numpy_arrays[0]) != len(self):
+            insert_lengths = [len(text) if type_operation == 1 else 0
+                              for type_operation, text in zip(self.types, self.texts)]
+            self.numpy_arrays = (numpy.array(self.positions, dtype=numpy.int64),
+                                 numpy.concatenate(([0], numpy.cumsum(insert_lengths, dtype=numpy.int64))))
+        return self.numpy_arrays
+
+
+def unchanged_from(operation):
+    # a history operation starting from this position does not change the operation
+    if type(operation) is Insert:
+        return operation.start
+    return max(operation.end, operation.start + 1)
+
+
+def bulk_transform(operation, columns):
+    """
+    The same as `operation / history[0] / history[1] ...`, but history operations
+    which cannot change the operation are skipped without creating them.
+    """
+    if numpy is not None and len(columns) >= NUMPY_MIN_HISTORY:
+        return numpy_transform(operation, columns)
+    return python_transform(operation, columns)
+
+
+def python_transform(operation, columns):
+    types, positions, texts = columns.types, columns.positions, columns.texts
+    if operation is NEUTRAL_OPERATION:
+        return operation
+
+    threshold = unchanged_from(operation)
+    for index in range(len(types)):
+        if positions[index] >= threshold:
+            continue
+
+        operation /= OPERATIONS[types[index]](positions[index], texts[index])
+        if operation is NEUTRAL_OPERATION:
+            break
+        threshold = unchanged_from(operation)
+    return operation
+
+
+def numpy_transform(operation, columns):
+    types, positions, texts = columns.types, columns.positions, columns.texts
+    positions_array, growth = columns.arrays()
+
+    index = 0
+    while index < len(types) and operation is not NEUTRAL_OPERATION:
+        end = min(index + NUMPY_BLOCK_SIZE, len(types))
+        # an operation can only grow by the text of the previous inserts, so history operations
+        # from this position cannot change it anywhere in the block
+        threshold = unchanged_from(operation) + int(growth[end] - growth[index])
+        candidates = numpy.flatnonzero(positions_array[index:end] < threshold) + index
+
+        for candidate in candidates.tolist():
+            if positions[candidate] < unchanged_from(operation):
+                operation /= OPERATIONS[types[candidate]](positions[candidate], texts[candidate])
+                if operation is NEUTRAL_OPERATION:
+                    break
+        index = end
+    return operation
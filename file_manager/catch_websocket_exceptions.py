@@ -27,3 +27,28 @@ def catch_websocket_exception(required_request_fields):
                 self.close(4500)
         return wrap
     return decorator
+
+
+def catch_async_websocket_exception(required_request_fields):
+    # catch_websocket_exception for the handlers of AsyncFileEditorConsumer
+    def decorator(func):
+        async def wrap(self, event, *args, **kwargs):
+            # check necessary fields in package
+            for field in required_request_fields:
+                try:
+                    event[field]
+                except KeyError:
+                    message = f"{field} is empty field"
+                    file_manager_logger.error(message)
+                    await self.send_json({'type': event['type'],
+                                          'error_code': 4000 + status.HTTP_404_NOT_FOUND,
+                                          'message': f"{message} in {event}"}, close=True)
+
+            # catch unknown exceptions
+            try:
+                return await func(self, event, *args, **kwargs)
+            except Exception as e:
+                file_manager_logger.error(f"UNKNOWN EXCEPTION {__name__} {e} {traceback.format_exc()}")
+                await self.close(4500)
+        return wrap
+    return decorator
@@ -0,0 +1,49 @@
+import collections
+
+from channels_redis.core import RedisChannelLayer
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer which delivers the group messages to the members in this process directly,
+    only the members in other processes get them through Redis.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {group: channel names of this process}
+        self.local_groups = collections.defaultdict(set)
+        # {channel name: number of its groups}
+        self.local_channels = collections.Counter()
+
+    def is_local(self, channel):
+        # the channels of new_channel of this process
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    async def group_add(self, group, channel):
+        # the members in other processes send to the group through Redis
+        await super().group_add(group, channel)
+        if self.is_local(channel) and channel not in self.local_groups[group]:
+            self.local_groups[group].add(channel)
+            self.local_channels[channel] += 1
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if channel in self.local_groups.get(group, ()):
+            self.local_groups[group].discard(channel)
+            if not self.local_groups[group]:
+                del self.local_groups[group]
+            self.local_channels[channel] -= 1
+            if not self.local_channels[channel]:
+                del self.local_channels[channel]
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        # the same way receive() puts the messages of Redis
+        for channel in self.local_groups.get(group, ()):
+            self.receive_buffer[channel].put_nowait(message)
+        await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # the local members already have the message
+        channel_names = [channel for channel in channel_names if channel not in self.local_channels]
+        return super()._map_channel_keys_to_connection(channel_names, message)
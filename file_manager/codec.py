@@ -0,0 +1,56 @@
+import functools
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    """
+    The json of the standard library.
+    """
+    @staticmethod
+    def dumps(content):
+        return json.dumps(content)
+
+    @staticmethod
+    def loads(text_data):
+        return json.loads(text_data)
+
+
+class OrjsonCodec:
+    """
+    orjson, several times faster than json. The text is compact, without spaces after the separators.
+    """
+    def __init__(self):
+        if orjson is None:
+            raise ImproperlyConfigured("OrjsonCodec requires the orjson package")
+
+    @staticmethod
+    def dumps(content):
+        # json.dumps accepts the keys which are not strings too
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(text_data):
+        return orjson.loads(text_data)
+
+
+@functools.lru_cache(maxsize=None)
+def load_codec(path):
+    if path is None:
+        return OrjsonCodec() if orjson is not None else JsonCodec()
+    return import_string(path)()
+
+
+def get_codec():
+    """
+    The codec of JSON_CODEC, orjson when it is installed by default.
+    """
+    return load_codec(getattr(settings, 'JSON_CODEC', None))
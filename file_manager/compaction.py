@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.db.models import F
+
+from .models import File
+from .document import DocumentsManager, truncate_operations, compose_operations
+
+
+def compact_operations(retention=None):
+    """
+    Delete the operations older than the last `retention` revisions of every file.
+    The written content of a file is the snapshot of its deleted operations.
+    The neighbouring operations of one channel older than DOCUMENT_RESYNC_OPERATIONS revisions are composed,
+    a client based on them is sent the content anyway. The in-memory log of a document is not composed,
+    it is indexed by revision.
+    Returns the number of compacted files.
+    """
+    if retention is None:
+        retention = getattr(settings, 'DOCUMENT_OPERATIONS_RETENTION', 1000)
+    resync_operations = getattr(settings, 'DOCUMENT_RESYNC_OPERATIONS', 500)
+
+    # documents of this process write their unsaved operations first
+    opened_files = set()
+    compacted_files = set()
+    for document in DocumentsManager().opened_documents():
+        if document.compact(retention):
+            compacted_files.add(document.file_id)
+        opened_files.add(document.file_id)
+
+    files = File.objects.filter(last_revision__gt=F('snapshot_revision') + retention).exclude(pk__in=opened_files)
+    for file_id, last_revision in files.values_list('pk', 'last_revision'):
+        if truncate_operations(file_id, last_revision - retention) is not None:
+            compacted_files.add(file_id)
+
+    files = File.objects.filter(last_revision__gt=F('snapshot_revision') + resync_operations + 1)
+    for file_id, last_revision in files.values_list('pk', 'last_revision'):
+        if compose_operations(file_id, last_revision - resync_operations):
+            compacted_files.add(file_id)
+
+    return len(compacted_files)
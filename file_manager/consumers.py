@@ -1,46 +1,48 @@
 from channels.generic.websocket import JsonWebsocketConsumer
-from asgiref.sync import async_to_sync
-from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
-from channels_presence.models import Room, Presence
-from channels_presence.decorators import (
-    remove_presence, touch_presence
-)
+from asgiref.sync import async_to_sync, sync_to_async
 from rest_framework_simplejwt.exceptions import InvalidToken
 from channels.exceptions import StopConsumer
 from rest_framework import status
 
 from authentication.models import CustomUser
-from .models import File, UserFiles, Operations, Access
-from .serializers import (
-    UserWithAccessSerializer, FileSerializer, OperationSerializer
-)
-from authentication.serializers import UserSerializer
-from .exceptions import FileManageException
-from .operation_factory import OperationFactory as Factory
-from .run_file import RunFileThread
-from .launched_files import LaunchedFilesManager
+from .models import File
+from .serializers import serialize_operations
+from authentication.serializers import serialize_user
+from .exceptions import FileManageException, ResyncRequiredException
+from .run_file import RunFileTask
+from .editor import FileEditorMixin
+from .outbox import encode_batch
+from .codec import get_codec
+from .ownership import FORWARDED_MESSAGES
+from .roster import get_active_users, get_all_users, get_roster_since
 from .catch_websocket_exceptions import catch_websocket_exception
 
 
-class FileEditorConsumer(JsonWebsocketConsumer):
+class RunFileProxy:
+    """
+    The consumer as RunFileTask sees it: the calls of the task are run in a thread.
+    The task outlives the async_to_sync call which started it, so the calls can not wait for its thread.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.file = consumer.file
+        self.launched_file_manager = consumer.launched_file_manager
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.file = None
-        self.room_group_name = None
-        self.room = None
-        self.launched_file_manager = LaunchedFilesManager()
-        self.file_output_index = 0
+    async def file_output(self, file_output):
+        await sync_to_async(self.consumer.file_output, thread_sensitive=False)(file_output)
+
+    async def send_to_group(self, content):
+        await sync_to_async(self.consumer.send_to_group, thread_sensitive=False)(content)
+
+
+class FileEditorConsumer(FileEditorMixin, JsonWebsocketConsumer):
 
     def connect(self):
         self.accept()
 
         # get current user
         try:
-            jwt = JWTTokenUserAuthentication()
-            validated_token = jwt.get_validated_token(self.scope['url_route']['kwargs']['access_token'])
-            token_user = jwt.get_user(validated_token)
-            self.scope['user'] = CustomUser.objects.get(pk=token_user.pk)
+            self.scope['user'] = self.get_user()
         except InvalidToken as e:
             self.close_connection(e.status_code)
 
@@ -54,19 +56,16 @@ class FileEditorConsumer(JsonWebsocketConsumer):
             self.close_connection(e.response_status)
 
         self.room_group_name = f"file_{self.file.pk}"
-
-        # check access to file
-        try:
-            access_to_file = UserFiles.objects.get(user=self.scope['user'], file=self.file)
-        except UserFiles.DoesNotExist:
-            access_to_file = UserFiles.objects.create(user=self.scope['user'],
-                                                      file=self.file,
-                                                      access=self.file.link_access)
+        if self.ownership is None:
+            self.document = self.documents_manager.open_document(self.file)
+        else:
+            # the document is opened by the first message handled here
+            async_to_sync(self.ownership.start)(self.channel_layer)
 
         # Join room group
         async_to_sync(self.channel_layer.group_add)(self.room_group_name,
                                                     self.channel_name)
-        self.room = Room.objects.add(self.room_group_name, self.channel_name, self.scope["user"])
+        new_user = self.join_room()
 
         self.send_json({'type': 'channel_name',
                         'channel_name': self.channel_name})
@@ -74,149 +73,173 @@ class FileEditorConsumer(JsonWebsocketConsumer):
         self.send_json({'type': 'file_status',
                         'is_running': self.launched_file_manager.file_is_running(self.file.pk)})
 
-        if Presence.objects.filter(user=self.scope['user'], room=self.room).count() == 1:
-            user_serializer = UserWithAccessSerializer(access_to_file)
+        if new_user is not None:
             self.send_to_group({'type': 'new_user',
-                                'user': user_serializer.data})
+                                'user': new_user})
 
     def close_connection(self, http_code):
         self.close(4000 + http_code)
         raise StopConsumer()
 
-    def send_content(self, content):
-        self.send_json(content['content'])
+    @classmethod
+    def decode_json(cls, text_data):
+        return get_codec().loads(text_data)
+
+    @classmethod
+    def encode_json(cls, content):
+        return get_codec().dumps(content)
+
+    def send_text(self, event):
+        self.send(text_data=self.message_text(event))
+
+    def close_forwarded(self, event):
+        self.close(event['code'])
+
+    def forward_timeout(self, event):
+        # the owner of the file has not acked the forwarded message
+        self.send_error(event['content_type'], status.HTTP_504_GATEWAY_TIMEOUT)
 
-    def send_to_group(self, content):
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name, {'type': 'send_content',
-                                   'content': content})
+    def send_batch(self, event):
+        self.send(text_data=encode_batch(self.message_text(message) for message in event['messages']))
+
+    def send_to_group(self, content, ack=None):
+        async_to_sync(self.outbox.send)(self.channel_layer, self.room_group_name, self.group_message(content, ack))
 
     def send_error(self, package_type, error_code, message=""):
         self.send_json({"type": package_type,
                         "error_code": 4000 + error_code,
                         "message": message})
 
-    @touch_presence
     def receive_json(self, content, **kwargs):
+        if self.touch_is_due():
+            self.presence.touch(self.room_group_name, self.channel_name)
+        if content['type'] in FORWARDED_MESSAGES and not self.handles_document():
+            self.forward(content)
+            return
         getattr(self, content['type'])(content)
 
+    def handles_document(self):
+        """
+        The document of the file is handled by this worker, otherwise by the owner of the file (FILE_OWNERSHIP).
+        """
+        if self.document_is_remote():
+            return False
+        if self.document_is_stale():
+            self.open_document()
+        return True
+
+    def forward(self, content):
+        async_to_sync(self.ownership.forward)(self.file.pk, self.forward_message(content))
+
     @catch_websocket_exception([])
     def file_info(self, event):
-        self.file.refresh_from_db()
-        file_serializer = FileSerializer(self.file)
         self.send_json({**event,
-                        'file': file_serializer.data})
+                        'file': self.get_file_data()})
 
     @catch_websocket_exception([])
     def active_users(self, event):
-        users = self.room.get_users()
-        users_with_accesses = UserFiles.objects.filter(user__in=users, file=self.file).all()
-        serializer = UserWithAccessSerializer(users_with_accesses, many=True)
         self.send_json({**event,
-                        'users': serializer.data})
+                        'users': get_active_users(self.room_group_name, self.file.pk)})
 
     @catch_websocket_exception([])
     def all_users(self, event):
-        all_users = UserFiles.objects.filter(file=self.file).all()
-        serializer = UserWithAccessSerializer(all_users, many=True)
         self.send_json({**event,
-                        'users': serializer.data})
+                        'users': get_all_users(self.room_group_name, self.file.pk)})
+
+    @catch_websocket_exception([])
+    def roster(self, event):
+        # the changes since the version of the client or the whole roster
+        self.send_json({'type': event['type'],
+                        **get_roster_since(self.room_group_name, self.file.pk, event.get('version'))})
 
     @catch_websocket_exception(['config'])
     def change_file_config(self, event):
-        self.file.refresh_from_db()
-        for field in event['config']:
-            setattr(self.file, field, event['config'][field])
-
-        self.file.save()
-
-        file_serializer = FileSerializer(self.file)
         self.send_to_group({'type': event['type'],
-                            'file': file_serializer.data})
+                            'file': self.save_file_config(event['config'])})
 
     @catch_websocket_exception(['new_access'])
     def change_link_access(self, event):
-        self.file.refresh_from_db()
-        self.file.link_access = event['new_access']
-        self.file.save()
+        self.save_link_access(event['new_access'])
         self.send_to_group(event)
 
     @catch_websocket_exception(['another_user_id', 'new_access'])
     def change_user_access(self, event):
-        another_user = UserFiles.objects.get(user__id=event['another_user_id'], file=self.file)
-
-        current_user_access = UserFiles.objects.get(user=self.scope['user'], file=self.file).access
-        if current_user_access < another_user.access:
-            self.send_error(event['type'], status.HTTP_403_FORBIDDEN)
-        elif current_user_access < event['new_access']:
-            self.send_error(event['type'], status.HTTP_406_NOT_ACCEPTABLE)
+        error_code, another_user = self.save_user_access(event['another_user_id'], event['new_access'])
+        if error_code:
+            self.send_error(event['type'], error_code)
         else:
-            another_user.access = event['new_access']
-            another_user.save()
-
-            user_serializer = UserWithAccessSerializer(another_user)
             self.send_to_group({'type': event['type'],
-                                'user': user_serializer.data})
+                                'user': another_user})
+
+    def heartbeat(self, event):
+        # a client without other messages sends it more often than PRESENCE_MAX_AGE to stay in the room
+        self.touch()
+
+    def refresh_access(self, event):
+        # the access is read from the database, the message can come from the client too
+        self.access = self.get_access()
 
     @catch_websocket_exception(['revision', 'operation'])
     def apply_operation(self, event):
-        current_user_access = UserFiles.objects.get(user=self.scope['user'], file=self.file).access
-        if current_user_access == Access.VIEWER:
+        self.apply(event, [event['operation']])
+
+    @catch_websocket_exception(['revision', 'operations'])
+    def apply_operations(self, event):
+        self.apply(event, event['operations'])
+
+    def apply(self, event, operations):
+        try:
+            operation_queries = self.apply_to_document(operations, event['revision'])
+        except ResyncRequiredException:
+            self.resync()
+            return
+        except FileManageException as e:
+            self.send_error(event['type'], e.response_status)
             return
 
-        bd_operations = Operations.objects.filter(revision__gt=event['revision'],
-                                                  file=self.file).order_by('revision').all()
-        operations = [Factory.create(operation.type, operation.position, operation.text) for operation in bd_operations]
-
-        # operation transformation
-        current_operation = Factory.create(event['operation']['type'],
-                                           event['operation']['position'],
-                                           event['operation']['text'])
-        for operation in operations:
-            current_operation /= operation
-
-        # update file content
-        self.file.refresh_from_db()
-        self.file.content = current_operation.execute(self.file.content)
-        self.file.last_revision += 1
-        self.file.save()
-
-        current_operation_query = Operations.objects.create(**current_operation.info(),
-                                                            revision=self.file.last_revision,
-                                                            file=self.file,
-                                                            channel_name=self.channel_name)
-
-        operation_serializer = OperationSerializer(current_operation_query)
-        self.send_to_group({'type': event['type'],
-                            'operation': operation_serializer.data})
+        if operation_queries:
+            message, ack = self.applied_messages(event, operation_queries)
+            self.send_to_group(message, ack=ack)
 
     @catch_websocket_exception(['revision'])
     def operation_history(self, event):
-        operations_query = Operations.objects.filter(revision__gt=event['revision']).order_by('revision').all()
+        try:
+            operations = self.document.operations_since(event['revision'])
+        except ResyncRequiredException:
+            self.resync()
+            return
 
-        operation_serializer = OperationSerializer(operations_query, many=True)
+        operations_data = serialize_operations(operations)
         self.send_json({'type': event['type'],
-                        'operations': operation_serializer.data})
+                        'operations': operations_data})
+
+    def resync(self):
+        self.send_json(self.resync_message())
 
     @catch_websocket_exception(['position'])
     def change_cursor_position(self, event):
-        self.send_to_group({**event,
-                            'user_id': self.scope['user'].pk})
+        async_to_sync(self.cursor_coalescer.add)(self.channel_layer, self.room_group_name, self.scope['user'].pk,
+                                                 {**event, 'user_id': self.scope['user'].pk})
+
+    def send_cursors(self, event):
+        for cursor in event['cursors']:
+            self.send(text_data=cursor)
 
     @catch_websocket_exception([])
     def run_file(self, event):
-        self.file.refresh_from_db()
+        self.get_file_data()
 
         if self.launched_file_manager.file_is_running(file_id=self.file.pk):
             self.send_error(event['type'], status.HTTP_409_CONFLICT)
         else:
-            # create RunFilThread when the file is not running
-            my_thread = RunFileThread(self.file.pk, self.file.content, self.file.programming_language, self)
+            # create RunFileTask when the file is not running
+            run_file_task = RunFileTask(self.file.pk, self.file.content, self.file.programming_language,
+                                        RunFileProxy(self))
             try:
-                self.launched_file_manager.add_running_file(self.file.pk, my_thread)
+                self.launched_file_manager.add_running_file(self.file.pk, run_file_task)
 
                 self.send_to_group({"type": "START run_file"})
-                my_thread.start()
+                async_to_sync(run_file_task.start)()
             except FileManageException as e:
                 self.send_error(event['type'], e.response_status)
 
@@ -241,19 +264,61 @@ class FileEditorConsumer(JsonWebsocketConsumer):
         except FileManageException as e:
             self.send_error(event['type'], e.response_status)
 
-    @remove_presence
     def disconnect(self, code):
+        handles_document = self.handles_document()
+        user_ids = self.leave_room(handles_document)
+
         # leave room
-        if not Presence.objects.filter(user=self.scope['user'], room=self.room).exists():
-            user_serializer = UserSerializer(self.scope['user'])
+        if self.scope['user'].pk not in user_ids:
+            user_data = serialize_user(self.scope['user'])
             self.send_to_group({'type': 'delete_user',
-                                'user': user_serializer.data})
+                                'user': user_data})
 
-        # last connection
-        if not self.room.get_users().exists():
-            Operations.objects.filter(file=self.file).all().delete()
-            self.file.last_revision = 0
-            self.file.save()
+        if not handles_document:
+            # the owner of the file removes the bridge and closes the room
+            async_to_sync(self.ownership.forward)(self.file.pk, {'type': 'forward_disconnect',
+                                                                 'channel_name': self.channel_name,
+                                                                 'user_id': self.scope['user'].pk,
+                                                                 'last': not user_ids})
 
         async_to_sync(self.channel_layer.group_discard)(self.room_group_name,
                                                         self.channel_name)
+
+
+class ForwardedConnection(FileEditorConsumer):
+    """
+    A connection to another worker. Its document messages are handled by the owner of the file,
+    the answers are sent to the connection through the channel layer.
+    """
+    def __init__(self, channel_layer, message):
+        super().__init__()
+        self.ownership = None
+        self.channel_layer = channel_layer
+        self.channel_name = message['channel_name']
+        self.file = File.decode(message['file_id'])
+        self.room_group_name = f"file_{self.file.pk}"
+        self.scope = {'user': CustomUser.objects.get(pk=message['user_id'])}
+
+    def base_send(self, message):
+        # the websocket messages are sent to the consumer of the connection
+        if message['type'] == 'websocket.send':
+            message = {'type': 'send_text',
+                       'text': message['text']}
+        else:
+            message = {'type': 'close_forwarded',
+                       'code': message.get('code')}
+        async_to_sync(self.channel_layer.send)(self.channel_name, message)
+
+    def receive_forwarded(self, message):
+        self.access = message['access']
+        # the file is read from the database only after a handoff
+        if self.document_is_stale():
+            self.open_document()
+        getattr(self, message['content']['type'])(message['content'])
+
+    def disconnect_forwarded(self, last):
+        if self.document_is_stale():
+            self.open_document()
+        self.document.remove_bridge(self.channel_name)
+        if last:
+            self.close_room()
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+from django.conf import settings
+
+from .launched_files import SingletonMeta
+from .codec import get_codec
+from .outbox import GroupOutbox
+
+
+class CursorCoalescer(metaclass=SingletonMeta):
+    """
+    Keeps only the last cursor of every user of a room and sends the cursors to the room
+    CURSOR_FLUSH_RATE times a second instead of every cursor at once.
+    """
+    def __init__(self):
+        # {room: {user_id: cursor}}, a room is here while its flush is scheduled
+        self.cursors = {}
+        self.tasks = set()
+        self.lock = threading.Lock()
+
+    @property
+    def flush_rate(self):
+        return getattr(settings, 'CURSOR_FLUSH_RATE', 20)
+
+    async def add(self, channel_layer, room, user_id, cursor):
+        if not self.flush_rate:
+            await self.send_cursors(channel_layer, room, [cursor])
+            return
+
+        with self.lock:
+            is_scheduled = room in self.cursors
+            self.cursors.setdefault(room, {})[user_id] = cursor
+
+        if not is_scheduled:
+            # the event loop keeps only weak references to the tasks
+            task = asyncio.ensure_future(self.flush_later(channel_layer, room))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def flush_later(self, channel_layer, room):
+        try:
+            await asyncio.sleep(1 / self.flush_rate)
+        finally:
+            with self.lock:
+                cursors = self.cursors.pop(room, {})
+
+        await self.send_cursors(channel_layer, room, cursors.values())
+
+    @staticmethod
+    async def send_cursors(channel_layer, room, cursors):
+        # the cursors are encoded once for all the connections of the room
+        codec = get_codec()
+        texts = [codec.dumps(cursor) for cursor in cursors]
+        outbox = GroupOutbox()
+        if outbox.interval:
+            # the cursors are sent in the batch with the other messages to the room
+            for text in texts:
+                await outbox.send(channel_layer, room, {'text': text})
+            return
+
+        await channel_layer.group_send(room, {'type': 'send_cursors', 'cursors': texts})
@@ -0,0 +1,513 @@
+import contextlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Max
+from django.utils.module_loading import import_string
+
+from .models import File, Operations
+from .operation_factory import OperationFactory as Factory
+from .launched_files import SingletonMeta
+from .operations import compose, compact
+from .bulk_transform import OperationColumns, bulk_transform
+from .persistence import DocumentPersister, single_writer
+from .exceptions import (
+    RevisionConflictException, OperationsCompactedException, RevisionTooOldException, DocumentClosedException,
+    ResyncRequiredException
+)
+
+
+# columns of the written operations read by Document
+WRITTEN_FIELDS = ('type', 'position', 'text', 'revision', 'channel_name')
+
+OPERATIONS_LOG_SIZE = getattr(settings, 'DOCUMENT_OPERATIONS_LOG_SIZE', 1000)
+DOCUMENT_BUFFER = import_string(getattr(settings, 'DOCUMENT_BUFFER', 'file_manager.document_buffer.Rope'))
+
+
+def compact_operation_queries(operation_queries):
+    """
+    Compose the neighbouring operations of one channel, a composed operation takes the last revision.
+    The unsaved operations of a write-behind flush and the old written ones (compose_operations) are composed.
+    """
+    compacted_queries = []
+    for operation_query in operation_queries:
+        if compacted_queries and compacted_queries[-1].channel_name == operation_query.channel_name:
+            prev_query = compacted_queries[-1]
+            operation = compose(Factory.create(prev_query.type, prev_query.position, prev_query.text),
+                                Factory.create(operation_query.type, operation_query.position, operation_query.text))
+            if operation is not None:
+                compacted_queries[-1] = Operations(**operation.info(),
+                                                   revision=operation_query.revision,
+                                                   file_id=operation_query.file_id,
+                                                   channel_name=operation_query.channel_name)
+                continue
+        compacted_queries.append(operation_query)
+    return compacted_queries
+
+
+def truncate_operations(file_id, revision):
+    """
+    Delete the written operations up to `revision`, returns the new snapshot revision or None.
+    """
+    with transaction.atomic():
+        # serialized with compose_operations by the file row
+        File.objects.select_for_update().filter(pk=file_id).values_list('pk', flat=True).get()
+        # a composed operation is deleted only as a whole
+        snapshot_revision = Operations.objects.filter(file__id=file_id, revision__lte=revision) \
+            .aggregate(Max('revision'))['revision__max']
+        if snapshot_revision is None:
+            return None
+
+        Operations.objects.filter(file__id=file_id, revision__lte=snapshot_revision).delete()
+        File.objects.filter(pk=file_id, snapshot_revision__lt=snapshot_revision).update(snapshot_revision=snapshot_revision)
+    return snapshot_revision
+
+
+def compose_operations(file_id, revision):
+    """
+    Compose the neighbouring written operations of one channel up to `revision`, returns whether any were composed.
+    A client based on a revision inside a composed operation is sent the content.
+    """
+    with transaction.atomic():
+        snapshot_revision = File.objects.select_for_update().filter(pk=file_id) \
+            .values_list('snapshot_revision', flat=True).get()
+        operation_queries = list(Operations.objects.filter(file__id=file_id, revision__gt=snapshot_revision,
+                                                           revision__lte=revision).order_by('revision'))
+        compacted_queries = compact_operation_queries(operation_queries)
+        # the operations which are not composed keep their rows
+        composed_queries = [operation_query for operation_query in compacted_queries if operation_query.pk is None]
+        if not composed_queries:
+            return False
+
+        kept_ids = {operation_query.pk for operation_query in compacted_queries if operation_query.pk is not None}
+        Operations.objects.filter(pk__in=[operation_query.pk for operation_query in operation_queries
+                                          if operation_query.pk not in kept_ids]).delete()
+        Operations.objects.bulk_create(composed_queries)
+    return True
+
+
+class Bridge:
+    """
+    Jupiter-style state of a client: operations of the others which the client has not acknowledged,
+    transformed past the operations of the client. A new operation of the client is transformed only against them.
+    A new bridge keeps the history as columns: the first operation of the client is transformed by bulk_transform,
+    the history is transformed past it only for a next operation which is not based on the whole history.
+    """
+    __slots__ = ('revision', 'last_revision', 'operations', 'history', 'client_operations')
+
+    def __init__(self, revision, last_revision, revisions=(), columns=None):
+        # the last revision acknowledged by the client
+        self.revision = revision
+        # the last revision included in the bridge
+        self.last_revision = last_revision
+        # [(revision, operation), ...]
+        self.operations = []
+        # ([revision, ...], OperationColumns) of the history not transformed past the client yet
+        self.history = (list(revisions), columns) if revisions else None
+        # operations of the client since the bridge was built
+        self.client_operations = []
+
+    def __len__(self):
+        return len(self.operations) + (len(self.history[0]) if self.history else 0)
+
+    def add_rows(self, rows):
+        # rows of WRITTEN_FIELDS
+        for type_operation, position, text, revision, _ in rows:
+            self.operations.append((revision, Factory.create(type_operation, position, text)))
+
+    def add_queries(self, operation_queries):
+        for operation_query in operation_queries:
+            operation = Factory.create(operation_query.type, operation_query.position, operation_query.text)
+            self.operations.append((operation_query.revision, operation))
+
+    def acknowledge(self, revision):
+        self.revision = revision
+        if self.history is not None:
+            if self.history[0][-1] <= revision:
+                # the client is based on the whole history, it is never transformed
+                self.history = None
+                self.client_operations = []
+            else:
+                self.build()
+
+        index = 0
+        while index < len(self.operations) and self.operations[index][0] <= revision:
+            index += 1
+        del self.operations[:index]
+
+    def build(self):
+        # the history is transformed past the operations of the client, before the operations added since
+        revisions, columns = self.history
+        added_operations = self.operations
+        self.history = None
+        self.operations = [(revision, Factory.create(type_operation, position, text))
+                           for revision, type_operation, position, text
+                           in zip(revisions, columns.types, columns.positions, columns.texts)]
+        client_operations, self.client_operations = self.client_operations, []
+        for operation in client_operations:
+            self.transform(operation)
+        self.operations += added_operations
+
+    def transform(self, operation):
+        if self.history is not None:
+            if not self.client_operations and not self.operations:
+                self.client_operations.append(operation)
+                return bulk_transform(operation, self.history[1])
+            self.build()
+
+        operations = []
+        for revision, prev_operation in self.operations:
+            operations.append((revision, prev_operation / operation))
+            operation /= prev_operation
+        self.operations = operations
+        return operation
+
+
+class Document:
+    """
+    State of an opened file: content, revision and the recent operations.
+    Operations are applied in memory, the database is only written by DocumentPersister.
+    The memory is authoritative only with a single writer of the file (see single_writer),
+    otherwise the workers serialize their operations by a lock of the file row.
+    """
+    def __init__(self, file_id, content, revision, snapshot_revision=0):
+        self.file_id = file_id
+        self.buffer = DOCUMENT_BUFFER(content)
+        self.revision = revision
+        self.snapshot_revision = snapshot_revision
+        self.operations = []
+        self.bridges = {}
+        self.lock = threading.RLock()
+        # a closed document has been handed off or its room has been closed, it does not take operations
+        self.is_closed = False
+
+        # write-behind state
+        self.persisted_revision = revision
+        self.pending_operations = []
+        self.dirty_since = None
+        self.flush_lock = threading.Lock()
+
+    @property
+    def content(self):
+        return str(self.buffer)
+
+    @property
+    def first_revision(self):
+        # the oldest revision kept in memory
+        if self.operations:
+            return self.operations[0].revision
+        return self.revision + 1
+
+    def history(self, revision):
+        """
+        Operations since `revision`: written rows of WRITTEN_FIELDS and the in-memory operations after them.
+        """
+        with self.lock:
+            if revision < self.snapshot_revision:
+                # the client must take the content
+                raise OperationsCompactedException(self.file_id, self.snapshot_revision)
+
+            # a far behind client takes the content instead of a long transformation
+            if self.revision - revision > getattr(settings, 'DOCUMENT_RESYNC_OPERATIONS', 500):
+                raise RevisionTooOldException(self.file_id, revision)
+
+            if revision + 1 >= self.first_revision:
+                rows = []
+                operations = self.operations[max(revision + 1 - self.first_revision, 0):]
+            else:
+                # the client is older than the in-memory log
+                rows = self.written_operations_since(revision)
+                last_revision = rows[-1][3] if rows else revision
+                operations = self.operations[max(last_revision + 1 - self.first_revision, 0):]
+
+            history_bytes = sum(len(row[2] or '') for row in rows) + \
+                sum(len(operation.text or '') for operation in operations)
+            if history_bytes > getattr(settings, 'DOCUMENT_RESYNC_BYTES', 256 * 1024):
+                raise RevisionTooOldException(self.file_id, revision)
+            return rows, operations
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        Lock the document to transform and apply operations.
+        """
+        with self.lock:
+            self.check_open()
+            if single_writer():
+                yield
+                return
+
+            # the operations of the other workers are loaded first, the new ones are written at once (sync)
+            with transaction.atomic():
+                last_revision = File.objects.select_for_update().filter(pk=self.file_id) \
+                    .values_list('last_revision', flat=True).get()
+                if last_revision != self.revision:
+                    self.reload()
+                yield
+
+    def catch_up(self):
+        # the operations written by the other workers, the memory is not authoritative without a single writer
+        if single_writer():
+            return
+        with self.lock:
+            last_revision = File.objects.filter(pk=self.file_id).values_list('last_revision', flat=True).get()
+            if last_revision != self.revision:
+                self.reload()
+
+    def state(self):
+        """
+        -> (content, revision)
+        """
+        self.catch_up()
+        with self.lock:
+            return self.content, self.revision
+
+    def operations_since(self, revision):
+        self.catch_up()
+        rows, operations = self.history(revision)
+        return [Operations(**dict(zip(WRITTEN_FIELDS, row)), file_id=self.file_id) for row in rows] + operations
+
+    def written_operations_since(self, revision):
+        # a written operation is composed of the operations from the previous written revision to its own one
+        snapshot_revision = File.objects.filter(pk=self.file_id).values_list('snapshot_revision', flat=True).get()
+        rows = list(Operations.objects.filter(file__id=self.file_id,
+                                              revision__gte=revision).order_by('revision').values_list(*WRITTEN_FIELDS))
+
+        if revision < snapshot_revision:
+            # compacted by another process
+            raise OperationsCompactedException(self.file_id, revision)
+        if revision > snapshot_revision and (not rows or rows[0][3] != revision):
+            # the revision is inside a composed operation
+            raise RevisionTooOldException(self.file_id, revision)
+        return [row for row in rows if row[3] > revision]
+
+    def transform(self, operation, revision, channel_name=None):
+        with self.lock:
+            if channel_name is not None:
+                return self.bridge(channel_name, revision).transform(operation)
+
+            rows, operations = self.history(revision)
+            columns = OperationColumns(row[:3] for row in rows)
+            columns.add_queries(operations)
+            return bulk_transform(operation, columns)
+
+    def transform_batch(self, operations, revision, channel_name=None):
+        """
+        Transform consecutive operations of one client made on `revision`.
+        Every next operation is based on the previous ones, so the history is transformed past them.
+        """
+        with self.lock:
+            if channel_name is not None:
+                bridge = self.bridge(channel_name, revision)
+            else:
+                bridge = self.history_bridge(revision)
+            return [bridge.transform(operation) for operation in compact(operations)]
+
+    def history_bridge(self, revision, channel_name=None):
+        """
+        A new bridge of the history since `revision`. The operations of the client itself are not transformed against.
+        An operation of the others before an operation of the client would have to be transformed past the original
+        operation of the client, which is not kept: the client takes the content instead.
+        """
+        rows, operations = self.history(revision)
+        history = [row[:4] for row in rows if row[4] != channel_name] + \
+            [(operation_query.type, operation_query.position, operation_query.text, operation_query.revision)
+             for operation_query in operations if operation_query.channel_name != channel_name]
+        if channel_name is not None and history:
+            own_revisions = [row[3] for row in rows if row[4] == channel_name] + \
+                [operation_query.revision for operation_query in operations
+                 if operation_query.channel_name == channel_name]
+            if own_revisions and own_revisions[-1] > history[0][3]:
+                raise RevisionTooOldException(self.file_id, revision)
+
+        revisions, columns = [], OperationColumns()
+        for type_operation, position, text, operation_revision in history:
+            revisions.append(operation_revision)
+            columns.add(type_operation, position, text)
+        return Bridge(revision, self.revision, revisions, columns)
+
+    def written_bridge(self, bridge, channel_name, revision):
+        """
+        The bridge with the operations since its last revision which are only written, e.g. after a reload,
+        or None when they are compacted.
+        """
+        try:
+            rows = self.written_operations_since(bridge.last_revision)
+        except ResyncRequiredException:
+            return None
+        bridge.acknowledge(revision)
+        bridge.add_rows(row for row in rows if row[4] != channel_name and revision < row[3] < self.first_revision)
+        bridge.last_revision = self.first_revision - 1
+        return bridge
+
+    def bridge(self, channel_name, revision):
+        bridge = self.bridges.get(channel_name)
+        if bridge is not None and revision >= bridge.revision and bridge.last_revision + 1 < self.first_revision:
+            # the operations since the last one of the client are not in memory
+            bridge = self.written_bridge(bridge, channel_name, revision)
+        if bridge is None or revision < bridge.revision:
+            bridge = self.bridges[channel_name] = self.history_bridge(revision, channel_name)
+            return bridge
+
+        bridge.acknowledge(revision)
+        # operations of the others since the last operation of the client
+        bridge.add_queries(operation_query
+                           for operation_query in self.operations[bridge.last_revision + 1 - self.first_revision:]
+                           if operation_query.channel_name != channel_name and operation_query.revision > revision)
+        bridge.last_revision = self.revision
+
+        if len(bridge) > getattr(settings, 'DOCUMENT_RESYNC_OPERATIONS', 500):
+            del self.bridges[channel_name]
+            raise RevisionTooOldException(self.file_id, revision)
+        return bridge
+
+    def remove_bridge(self, channel_name):
+        with self.lock:
+            self.bridges.pop(channel_name, None)
+
+    def check_open(self):
+        if self.is_closed:
+            raise DocumentClosedException(self.file_id)
+
+    def apply(self, operation, channel_name):
+        with self.lock:
+            self.check_open()
+            operation_query = self.add_operation(operation, channel_name)
+            self.update_bridge(channel_name)
+        DocumentPersister().schedule(self)
+        return operation_query
+
+    def apply_batch(self, operations, channel_name):
+        # the batch is written at once
+        with self.lock:
+            self.check_open()
+            operation_queries = [self.add_operation(operation, channel_name) for operation in operations]
+            self.update_bridge(channel_name)
+        DocumentPersister().schedule(self)
+        return operation_queries
+
+    def update_bridge(self, channel_name):
+        # the bridge is already transformed past the operations of the client
+        bridge = self.bridges.get(channel_name)
+        if bridge is not None:
+            bridge.last_revision = self.revision
+
+    def add_operation(self, operation, channel_name):
+        self.buffer = operation.execute(self.buffer)
+        self.revision += 1
+
+        operation_query = Operations(**operation.info(),
+                                     revision=self.revision,
+                                     file_id=self.file_id,
+                                     channel_name=channel_name)
+        self.operations.append(operation_query)
+        # unsaved operations are not in the database yet, keep them
+        saved_operations_number = self.persisted_revision - self.first_revision + 1
+        del self.operations[:max(min(len(self.operations) - OPERATIONS_LOG_SIZE, saved_operations_number), 0)]
+
+        self.pending_operations.append(operation_query)
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+        return operation_query
+
+    def flush(self):
+        """
+        Write the content and the unsaved operations, returns (number of operations, flush lag) or None.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if self.dirty_since is None:
+                    return None
+                content, revision = self.content, self.revision
+                pending_operations, self.pending_operations = self.pending_operations, []
+                dirty_since, self.dirty_since = self.dirty_since, None
+
+            try:
+                with transaction.atomic():
+                    # unique_file_revision fails when another worker has written these revisions
+                    Operations.objects.bulk_create(compact_operation_queries(pending_operations))
+                    File.objects.filter(pk=self.file_id).update(content=content, last_revision=revision)
+            except IntegrityError:
+                self.reload()
+                raise RevisionConflictException(self.file_id, pending_operations[0].revision)
+            except Exception:
+                with self.lock:
+                    self.pending_operations[:0] = pending_operations
+                    self.dirty_since = dirty_since
+                raise
+
+            with self.lock:
+                self.persisted_revision = revision
+            return len(pending_operations), time.monotonic() - dirty_since
+
+    def compact(self, retention):
+        """
+        Delete the operations older than the last `retention` written revisions.
+        """
+        # the persisted content becomes the snapshot of the deleted operations
+        DocumentPersister().flush(self)
+        with self.flush_lock:
+            if self.persisted_revision - retention <= self.snapshot_revision:
+                return False
+
+            snapshot_revision = truncate_operations(self.file_id, self.persisted_revision - retention)
+            if snapshot_revision is None:
+                return False
+
+            with self.lock:
+                self.snapshot_revision = snapshot_revision
+                del self.operations[:max(snapshot_revision - self.first_revision + 1, 0)]
+            return True
+
+    def reload(self):
+        # the database wins, unsaved operations are dropped
+        with self.lock:
+            content, revision, snapshot_revision = File.objects.filter(pk=self.file_id).values_list(
+                'content', 'last_revision', 'snapshot_revision').get()
+            self.buffer = DOCUMENT_BUFFER(content)
+            self.revision = self.persisted_revision = revision
+            self.snapshot_revision = snapshot_revision
+            self.operations = []
+            # the bridges catch up from the written operations, unless they include dropped ones
+            if self.pending_operations:
+                self.bridges = {}
+            self.pending_operations = []
+            self.dirty_since = None
+
+    def update_file(self, file):
+        # put in-memory state into the model instance
+        self.catch_up()
+        with self.lock:
+            file.content = self.content
+            file.last_revision = self.revision
+        return file
+
+
+class DocumentsManager(metaclass=SingletonMeta):
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def open_document(self, file):
+        with self.lock:
+            if file.pk not in self.documents:
+                self.documents[file.pk] = Document(file.pk, file.content, file.last_revision, file.snapshot_revision)
+            return self.documents[file.pk]
+
+    def get_document(self, file_id):
+        return self.documents.get(file_id)
+
+    def opened_documents(self):
+        with self.lock:
+            return list(self.documents.values())
+
+    def close_document(self, file_id):
+        with self.lock:
+            document = self.documents.pop(file_id, None)
+        if document:
+            # the operations in progress are written, the later ones are rejected
+            with document.lock:
+                document.is_closed = True
+            DocumentPersister().flush(document)
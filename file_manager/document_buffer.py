@@ -0,0 +1,209 @@
+import random
+
+
+CHUNK_SIZE = 1024
+
+
+class StringBuffer:
+    """
+    Plain string buffer: every change rebuilds the whole content.
+    """
+    def __init__(self, text=''):
+        self.text = text
+
+    def insert(self, position, text):
+        self.text = self.text[:position] + text + self.text[position:]
+        return self
+
+    def delete(self, position, length):
+        self.text = self.text[:position] + self.text[position + length:]
+        return self
+
+    def __len__(self):
+        return len(self.text)
+
+    def __str__(self):
+        return self.text
+
+
+class _Node:
+    __slots__ = ('text', 'priority', 'left', 'right', 'size')
+
+    def __init__(self, text, priority=None):
+        self.text = text
+        self.priority = random.random() if priority is None else priority
+        self.left = None
+        self.right = None
+        self.size = len(text)
+
+    def update(self):
+        self.size = len(self.text) + _size(self.left) + _size(self.right)
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+def _build(chunks, start, end):
+    # balanced tree whose priorities keep the heap order
+    if start >= end:
+        return None
+    middle = (start + end) // 2
+    node = _Node(chunks[middle])
+    node.left = _build(chunks, start, middle)
+    node.right = _build(chunks, middle + 1, end)
+    node.priority = max(node.priority, node.left.priority if node.left else 0, node.right.priority if node.right else 0)
+    node.update()
+    return node
+
+
+def _attach(root, hook, side, node):
+    # -> the root of a part with the node as the `side` child of its last node
+    if hook is None:
+        return node
+    setattr(hook, side, node)
+    return root
+
+
+def _split(node, position):
+    """
+    -> (first `position` characters, the rest). Iterative, a deep tree does not hit the recursion limit.
+    """
+    left = right = None
+    # the last nodes of both parts, their right (left) child is not known yet
+    left_hook = right_hook = None
+    path = []
+    tail = None
+    while node is not None:
+        path.append(node)
+        left_size = _size(node.left)
+        if position <= left_size:
+            right = _attach(right, right_hook, 'left', node)
+            right_hook = node
+            node = node.left
+        elif position >= left_size + len(node.text):
+            left = _attach(left, left_hook, 'right', node)
+            left_hook = node
+            position -= left_size + len(node.text)
+            node = node.right
+        else:
+            # split inside the chunk: the tail is a new node with its own priority, merged into the rest below
+            position -= left_size
+            tail = _Node(node.text[position:])
+            node.text = node.text[:position]
+            left = _attach(left, left_hook, 'right', node)
+            left_hook = node
+            # the right subtree of the chunk closes the right part
+            right = _attach(right, right_hook, 'left', node.right)
+            right_hook = None
+            break
+
+    # nothing follows the last nodes of the parts
+    if left_hook is not None:
+        left_hook.right = None
+    if right_hook is not None:
+        right_hook.left = None
+
+    for node in reversed(path):
+        node.update()
+    if tail is not None:
+        right = _merge(tail, right)
+    return left, right
+
+
+def _merge(left, right):
+    # iterative, see _split
+    root = hook = side = None
+    path = []
+    while left is not None and right is not None:
+        if left.priority > right.priority:
+            root = _attach(root, hook, side, left)
+            hook, side = left, 'right'
+            left = left.right
+        else:
+            root = _attach(root, hook, side, right)
+            hook, side = right, 'left'
+            right = right.left
+        path.append(hook)
+    root = _attach(root, hook, side, left if left is not None else right)
+
+    for node in reversed(path):
+        node.update()
+    return root
+
+
+def _edge(node, side):
+    # the first (side='left') or the last (side='right') chunk
+    while node is not None and getattr(node, side) is not None:
+        node = getattr(node, side)
+    return node
+
+
+def _join(left, right):
+    """
+    Merge the parts, the chunks around the junction are put together while they fit in one chunk,
+    so the edits do not pile up small chunks.
+    """
+    last, first = _edge(left, 'right'), _edge(right, 'left')
+    if last is not None and first is not None and len(last.text) + len(first.text) <= CHUNK_SIZE:
+        _, right = _split(right, len(first.text))
+        # the last chunk and the sizes of the right spine grow
+        node = left
+        while node:
+            node.size += len(first.text)
+            if node.right is None:
+                node.text += first.text
+            node = node.right
+    return _merge(left, right)
+
+
+class Rope:
+    """
+    Treap of text chunks: insert and delete cost O(log n), the string is built only by str().
+    """
+    def __init__(self, text=''):
+        self.root = self._from_text(text)
+        self._text = text
+
+    @staticmethod
+    def _from_text(text):
+        chunks = [text[index:index + CHUNK_SIZE] for index in range(0, len(text), CHUNK_SIZE)]
+        return _build(chunks, 0, len(chunks))
+
+    def insert(self, position, text):
+        if not text:
+            return self
+        self._text = None
+
+        left, right = _split(self.root, position)
+        self.root = _join(_join(left, self._from_text(text)), right)
+        return self
+
+    def delete(self, position, length):
+        if length <= 0:
+            return self
+        self._text = None
+
+        left, right = _split(self.root, position)
+        _, right = _split(right, length)
+        self.root = _join(left, right)
+        return self
+
+    def __len__(self):
+        return _size(self.root)
+
+    def __str__(self):
+        if self._text is None:
+            # in-order traversal without recursion
+            chunks = []
+            stack = []
+            node = self.root
+            while stack or node:
+                while node:
+                    stack.append(node)
+                    node = node.left
+                node = stack.pop()
+                chunks.append(node.text)
+                node = node.right
+            self._text = ''.join(chunks)
+        return self._text
@@ -0,0 +1,287 @@
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
+from rest_framework import status
+
+from authentication.models import CustomUser
+from authentication.serializers import serialize_user
+from .models import File, UserFiles, Operations, Access
+from .serializers import serialize_user_with_access, serialize_file, serialize_operation, serialize_operations
+from .operation_factory import OperationFactory as Factory
+from .launched_files import LaunchedFilesManager
+from .document import DocumentsManager
+from .file_manager_backend import FileManager
+from .presence import get_presence, get_touch_interval, get_max_age
+from .cursors import CursorCoalescer
+from .outbox import GroupOutbox
+from .codec import get_codec
+from .ownership import get_ownership, ownership_enabled, find_owner_channel
+from .roster import get_roster, update_roster
+
+
+class FileEditorMixin:
+    """
+    State and synchronous work of FileEditorConsumer and AsyncFileEditorConsumer.
+    The sync consumer calls the methods directly, the async one through database_sync_to_async.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file = None
+        self.room_group_name = None
+        self.presence = get_presence()
+        self.last_touch = 0
+        self.cursor_coalescer = CursorCoalescer()
+        self.outbox = GroupOutbox()
+        self.document = None
+        # access of the user to the file, refreshed by refresh_access
+        self.access = None
+        self.launched_file_manager = LaunchedFilesManager()
+        self.documents_manager = DocumentsManager()
+        self.ownership = get_ownership() if ownership_enabled() else None
+        self.file_output_index = 0
+
+    def get_user(self):
+        jwt = JWTTokenUserAuthentication()
+        validated_token = jwt.get_validated_token(self.scope['url_route']['kwargs']['access_token'])
+        token_user = jwt.get_user(validated_token)
+        return CustomUser.objects.get(pk=token_user.pk)
+
+    def join_room(self):
+        """
+        -> the user with access for the room when it is the first connection of the user, otherwise None.
+        """
+        # check access to file
+        try:
+            access_to_file = UserFiles.objects.with_users().get(user=self.scope['user'], file=self.file)
+        except UserFiles.DoesNotExist:
+            access_to_file = UserFiles.objects.create(user=self.scope['user'],
+                                                      file=self.file,
+                                                      access=self.file.link_access)
+            update_roster(self.room_group_name, self.scope['user'].pk,
+                          entry=serialize_user_with_access(access_to_file))
+        self.access = access_to_file.access
+
+        user_connections = self.presence.add(self.room_group_name, self.channel_name, self.scope['user'].pk)
+        self.last_touch = time.monotonic()
+        if user_connections == 1:
+            update_roster(self.room_group_name, self.scope['user'].pk, active=True)
+            return serialize_user_with_access(access_to_file)
+        return None
+
+    def leave_room(self, handles_document):
+        """
+        -> the ids of the users left in the room. The last connection closes the room.
+        """
+        if handles_document:
+            self.document.remove_bridge(self.channel_name)
+        user_ids = self.presence.remove(self.room_group_name, self.channel_name)
+        version = None
+        if self.scope['user'].pk not in user_ids:
+            version = update_roster(self.room_group_name, self.scope['user'].pk, active=False)
+
+        # last connection, the roster changed by a new connection since the leave is kept
+        if not user_ids:
+            if version is not None:
+                get_roster().delete(self.room_group_name, version)
+            if handles_document:
+                self.close_room()
+        return user_ids
+
+    def close_room(self):
+        close_room(self.file.pk)
+
+    def group_message(self, content, ack=None):
+        # the content is encoded once for all the connections of the room
+        message = {'text': get_codec().dumps(content)}
+        if ack is not None and getattr(settings, 'OPERATION_ACK', False):
+            # the connection which sent the content gets only the ack
+            message.update(channel_name=self.channel_name, ack=get_codec().dumps(ack))
+        return message
+
+    def message_text(self, message):
+        # a message of group_message
+        if message.get('channel_name') == self.channel_name:
+            return message['ack']
+        return message['text']
+
+    def touch(self):
+        self.last_touch = time.monotonic()
+        self.presence.touch(self.room_group_name, self.channel_name)
+
+    def touch_is_due(self):
+        # cursor moves and keystrokes do not write the presence every time
+        now = time.monotonic()
+        if now - self.last_touch < get_touch_interval():
+            return False
+        self.last_touch = now
+        return True
+
+    def document_is_remote(self):
+        # the document is handled by the owner of the file on another worker (FILE_OWNERSHIP)
+        return self.ownership is not None and self.ownership.owner_channel(self.file.pk) is not None
+
+    def document_is_stale(self):
+        # the document has been closed, e.g. by a handoff
+        return self.document is None or self.documents_manager.get_document(self.file.pk) is not self.document
+
+    def open_document(self):
+        # the document is opened again from the database after a handoff
+        self.file.refresh_from_db()
+        self.document = self.documents_manager.open_document(self.file)
+
+    def forward_message(self, content):
+        # the owner acks the message by its id
+        return {'type': 'forward',
+                'id': uuid.uuid4().hex,
+                'channel_name': self.channel_name,
+                'user_id': self.scope['user'].pk,
+                'access': self.access,
+                'content': content}
+
+    def get_file_data(self):
+        self.file.refresh_from_db()
+        self.document.update_file(self.file)
+        return serialize_file(self.file)
+
+    def save_file_config(self, config):
+        self.file.refresh_from_db()
+        for field in config:
+            setattr(self.file, field, config[field])
+
+        # the content and the revision are owned by the document
+        config_fields = [field.name for field in File._meta.concrete_fields
+                         if field.name in config and field.name not in ('id', 'content', 'last_revision')]
+        self.file.save(update_fields=config_fields)
+        self.document.update_file(self.file)
+        return serialize_file(self.file)
+
+    def save_link_access(self, new_access):
+        self.file.refresh_from_db()
+        self.file.link_access = new_access
+        self.file.save(update_fields=['link_access'])
+        FileManager.refresh_access(self.file.pk)
+
+    def save_user_access(self, another_user_id, new_access):
+        """
+        -> (error code, serialized user with access)
+        """
+        another_user = UserFiles.objects.with_users().get(user__id=another_user_id, file=self.file)
+
+        if self.access < another_user.access:
+            return status.HTTP_403_FORBIDDEN, None
+        if self.access < new_access:
+            return status.HTTP_406_NOT_ACCEPTABLE, None
+
+        another_user.access = new_access
+        another_user.save()
+        FileManager.refresh_access(self.file.pk, another_user.user_id)
+
+        another_user_data = serialize_user_with_access(another_user)
+        update_roster(self.room_group_name, another_user.user_id, entry=another_user_data)
+        return None, another_user_data
+
+    def get_access(self):
+        # None - the user has left the file
+        return UserFiles.objects.filter(user=self.scope['user'], file=self.file) \
+            .values_list('access', flat=True).first()
+
+    def apply_to_document(self, operations, revision):
+        """
+        Transform and apply the operations of the client, -> the applied operation queries or None for a viewer.
+        """
+        if self.access is None or self.access == Access.VIEWER or not operations:
+            return None
+
+        operations = [Factory.create(operation['type'], operation['position'], operation['text'])
+                      for operation in operations]
+        with self.document.writing():
+            if len(operations) == 1:
+                operation = self.document.transform(operations[0], revision, self.channel_name)
+                return [self.document.apply(operation, self.channel_name)]
+
+            # the batch is transformed against the history once
+            operations = self.document.transform_batch(operations, revision, self.channel_name)
+            return self.document.apply_batch(operations, self.channel_name)
+
+    @staticmethod
+    def applied_messages(event, operation_queries):
+        """
+        -> (the message to the room, the ack to the client) of the applied operations.
+        """
+        if event['type'] == 'apply_operation':
+            operation_data = serialize_operation(operation_queries[0])
+            return ({'type': event['type'],
+                     'operation': operation_data},
+                    {'type': 'ack',
+                     'revision': operation_data['revision']})
+
+        revisions = {'first_revision': operation_queries[0].revision,
+                     'last_revision': operation_queries[-1].revision}
+        return ({'type': event['type'],
+                 **revisions,
+                 'operations': serialize_operations(operation_queries)},
+                {'type': 'ack',
+                 **revisions})
+
+    def resync_message(self):
+        # the client is too far behind and must rebase its changes on the current content
+        self.document.remove_bridge(self.channel_name)
+        content, revision = self.document.state()
+        return {'type': 'resync',
+                'content': content,
+                'revision': revision}
+
+
+def close_room(file_id):
+    DocumentsManager().close_document(file_id)
+    Operations.objects.filter(file_id=file_id).all().delete()
+    File.objects.filter(pk=file_id).update(last_revision=0, snapshot_revision=0)
+
+
+def prune_presences(max_age=None):
+    """
+    Remove the dead connections from the presence, they leave their rooms as disconnected ones.
+    Returns their number.
+    """
+    expired = get_presence().expire(get_max_age() if max_age is None else max_age)
+    for room, channel_name, user_id in expired:
+        leave_expired_room(room, channel_name, user_id)
+    return len(expired)
+
+
+def leave_expired_room(room, channel_name, user_id):
+    # FileEditorMixin.leave_room and the disconnect of the consumer for a connection removed by the expiry
+    channel_layer = get_channel_layer()
+    file_id = room[len('file_'):]
+    user_ids = get_presence().user_ids(room)
+    version = None
+    if user_id not in user_ids:
+        version = update_roster(room, user_id, active=False)
+        user = CustomUser.objects.filter(pk=user_id).first()
+        if user is not None:
+            text = get_codec().dumps({'type': 'delete_user',
+                                      'user': serialize_user(user)})
+            async_to_sync(channel_layer.group_send)(room, {'type': 'send_text', 'text': text})
+    if not user_ids and version is not None:
+        get_roster().delete(room, version)
+
+    owner_channel = find_owner_channel(file_id) if ownership_enabled() else None
+    if owner_channel is not None:
+        # the owner of the file removes the bridge and closes the room
+        async_to_sync(channel_layer.send)(owner_channel, {'type': 'forward_disconnect',
+                                                          'file_id': file_id,
+                                                          'channel_name': channel_name,
+                                                          'user_id': user_id,
+                                                          'last': not user_ids})
+    else:
+        document = DocumentsManager().get_document(file_id)
+        if document is not None:
+            document.remove_bridge(channel_name)
+        if not user_ids:
+            close_room(file_id)
+
+    async_to_sync(channel_layer.group_discard)(room, channel_name)
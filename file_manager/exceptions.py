@@ -30,3 +30,33 @@ class FileAlreadyRunningException(FileManageException):
 class FileNotRunningException(FileManageException):
     def __init__(self, file):
         super().__init__(f"The file {file} is not running", status.HTTP_409_CONFLICT)
+
+
+class RevisionConflictException(FileManageException):
+    def __init__(self, file, revision):
+        super().__init__(f"The revision {revision} of the file {file} is already written", status.HTTP_409_CONFLICT)
+
+
+class DocumentWriteException(FileManageException):
+    def __init__(self, file):
+        super().__init__(f"The operations of the file {file} are not written", status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class DocumentClosedException(FileManageException):
+    def __init__(self, file):
+        super().__init__(f"The document of the file {file} is closed", status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class ResyncRequiredException(FileManageException):
+    def __init__(self, message):
+        super().__init__(message, status.HTTP_410_GONE)
+
+
+class OperationsCompactedException(ResyncRequiredException):
+    def __init__(self, file, revision):
+        super().__init__(f"The operations of the file {file} before {revision} are compacted")
+
+
+class RevisionTooOldException(ResyncRequiredException):
+    def __init__(self, file, revision):
+        super().__init__(f"The revision {revision} of the file {file} is too old to transform")
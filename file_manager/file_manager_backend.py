@@ -1,4 +1,9 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
 from .models import File, UserFiles, Access
+from .presence import get_presence
+from .roster import update_roster
 
 from .exceptions import (
     NoRequiredFileAccess, FileDoesNotExistException
@@ -63,6 +68,22 @@ class FileManager:
             if access_to_file.access == Access.OWNER:
                 raise NoRequiredFileAccess('VIEWER OR EDITOR')
             access_to_file.delete()
+            update_roster(f"file_{file_id}", user.pk, entry=None)
+            FileManager.refresh_access(file_id, user.pk)
 
         except UserFiles.DoesNotExist:
             raise NoRequiredFileAccess('ANY')
+
+    @staticmethod
+    def refresh_access(file_id, user_id=None):
+        """
+        Make the connections of the user (of all users by default) to the file reload their access.
+        """
+        channel_layer = get_channel_layer()
+        room_group_name = f"file_{file_id}"
+        if user_id is None:
+            async_to_sync(channel_layer.group_send)(room_group_name, {'type': 'refresh_access'})
+            return
+
+        for channel_name in get_presence().channels(room_group_name, user_id):
+            async_to_sync(channel_layer.send)(channel_name, {'type': 'refresh_access'})
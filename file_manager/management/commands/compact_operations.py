@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from file_manager.compaction import compact_operations
+
+
+class Command(BaseCommand):
+    help = "Delete old operations of the files, run it periodically (e.g. by cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=int, default=None,
+                            help="number of the last revisions to keep, DOCUMENT_OPERATIONS_RETENTION by default")
+
+    def handle(self, *args, **options):
+        compacted_files = compact_operations(options['retention'])
+        self.stdout.write(f"compacted files: {compacted_files}")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from file_manager.editor import prune_presences
+
+
+class Command(BaseCommand):
+    help = ("Remove the connections without messages or heartbeats from the presence and their rooms, "
+            "run it periodically (e.g. by cron)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help="seconds since the last message of a connection, PRESENCE_MAX_AGE by default")
+
+    def handle(self, *args, **options):
+        expired_connections = prune_presences(options['max_age'])
+        self.stdout.write(f"expired connections: {expired_connections}")
@@ -38,6 +38,8 @@ class File(models.Model):
 
     link_access = models.IntegerField(default=Access.VIEWER, choices=Access.choices)
     last_revision = models.BigIntegerField(default=0)
+    # operations up to this revision are deleted, the content is their snapshot
+    snapshot_revision = models.BigIntegerField(default=0)
 
     objects = FileManager()
 
@@ -71,6 +73,13 @@ def cascade_with_deleting_files_where_user_is_owner(collector, field, sub_objs,
     )
 
 
+class UserFilesManager(models.Manager):
+    def with_users(self):
+        # the users with the columns of UserWithAccessSerializer in the same query
+        return self.get_queryset().select_related('user') \
+            .only('access', 'user', 'user__id', 'user__username', 'user__email', 'user__account_color')
+
+
 class UserFiles(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='user_files')
     user = models.ForeignKey(get_user_model(),
@@ -78,6 +87,8 @@ class UserFiles(models.Model):
                              related_name='user_files')
     access = models.IntegerField(choices=Access.choices)
 
+    objects = UserFilesManager()
+
 
 class Operations(models.Model):
     class Type(models.IntegerChoices):
@@ -88,6 +99,13 @@ class Operations(models.Model):
     type = models.IntegerField(choices=Type.choices)
     position = models.IntegerField(blank=True, null=True)
     text = models.TextField(blank=True, null=True)
-    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='operations')
+    # indexed by unique_file_revision
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='operations', db_index=False)
     revision = models.BigIntegerField()
     channel_name = models.TextField()
+
+    class Meta:
+        constraints = [
+            # the index of the history scans and the guard against two writers of the same revision
+            models.UniqueConstraint(fields=['file', 'revision'], name='unique_file_revision'),
+        ]
@@ -1,10 +1,10 @@
 from .models import Operations
-from .operations import NeutralOperation, Insert, Delete
+from .operations import NEUTRAL_OPERATION, Insert, Delete
 
 
 class OperationFactory:
     operations = {
-        Operations.Type.NEU: lambda *_: NeutralOperation(),
+        Operations.Type.NEU: lambda *_: NEUTRAL_OPERATION,
         Operations.Type.INSERT: lambda position, text: Insert(position, text),
         Operations.Type.DELETE: lambda position, text: Delete(position, text)
     }
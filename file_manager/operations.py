@@ -1,10 +1,12 @@
 class Operation:
+    __slots__ = ('start', 'text')
+
     def __init__(self, position, text):
         self.start = position
         self.text = text
 
     def __truediv__(self, prev_operation):
-        pass
+        return TRANSFORMATIONS[type(self), type(prev_operation)](self, prev_operation)
 
     def execute(self, file_content):
         pass
@@ -21,41 +23,34 @@ class Operation:
 
 
 class NeutralOperation(Operation):
+    __slots__ = ()
+    instance = None
+
+    def __new__(cls):
+        # the only neutral operation
+        if cls.instance is None:
+            cls.instance = super().__new__(cls)
+            Operation.__init__(cls.instance, None, None)
+        return cls.instance
+
     def __init__(self):
-        super().__init__(None, None)
+        pass
 
     def execute(self, file_content):
         return file_content
 
-    def __truediv__(self, prev_operation):
-        return NeutralOperation()
-
     def info(self):
         return {'type': 0}
 
 
 class Insert(Operation):
-    def execute(self, file_content):
-        return file_content[:self.start] + self.text + file_content[self.start:]
+    __slots__ = ()
 
-    def __truediv__(self, prev_operation):
-        # prev_operation - insert
-        if isinstance(prev_operation, Insert):
-            if self.start <= prev_operation.start:
-                return Insert(self.start, self.text)
-            else:
-                return Insert(self.start + len(prev_operation.text), self.text)
-        # prev_operation - delete
-        elif isinstance(prev_operation, Delete):
-            if self.start <= prev_operation.start:
-                return Insert(self.start, self.text)
-            elif self.start > prev_operation.end:
-                return Insert(self.start - len(prev_operation.text), self.text)
-            else:
-                return Insert(prev_operation.start, self.text)
-        # prev_operation - neu
-        elif isinstance(prev_operation, NeutralOperation):
-            return Insert(self.start, self.text)
+    def execute(self, file_content):
+        if isinstance(file_content, str):
+            return file_content[:self.start] + self.text + file_content[self.start:]
+        # document buffer
+        return file_content.insert(self.start, self.text)
 
     def info(self):
         return {'type': 1,
@@ -64,44 +59,135 @@ class Insert(Operation):
 
 
 class Delete(Operation):
-    def execute(self, file_content):
-        return file_content[:self.start] + file_content[self.start + len(self.text):]
+    __slots__ = ()
 
-    def __truediv__(self, prev_operation):
-        # prev_operation - insert
-        if isinstance(prev_operation, Insert):
-            if prev_operation.start <= self.start:
-                return Delete(self.start + len(prev_operation.text), self.text)
-            elif self.start < prev_operation.start < self.end:
-                difference = prev_operation.start - self.start
-                return Delete(self.start, self.text[:difference] + prev_operation.text + self.text[difference:])
-            else:
-                return Delete(self.start, self.text)
-        # prev_operation - delete
-        elif isinstance(prev_operation, Delete):
-            if self.end <= prev_operation.start:
-                return Delete(self.start, self.text)
-
-            elif (self.start < prev_operation.start) and (prev_operation.start < self.end <= prev_operation.end):
-                return Delete(self.start, self.text[:prev_operation.start - self.start])
-
-            elif (prev_operation.start <= self.start) and (self.end <= prev_operation.end):
-                return NeutralOperation()
-
-            elif (prev_operation.start <= self.start <= prev_operation.end) and (prev_operation.end < self.end):
-                return Delete(prev_operation.start, self.text[prev_operation.end - self.start:])
-
-            elif self.start > prev_operation.end:
-                return Delete(self.start - len(prev_operation.text), self.text)
-
-            else:
-                return Delete(self.start, self.text[:prev_operation.start - self.start] +
-                              self.text[prev_operation.end - self.start:])
-        # prev_operation - neu
-        elif isinstance(prev_operation, NeutralOperation):
-            return Delete(self.start, self.text)
+    def execute(self, file_content):
+        if isinstance(file_content, str):
+            return file_content[:self.start] + file_content[self.start + len(self.text):]
+        # document buffer
+        return file_content.delete(self.start, len(self.text))
 
     def info(self):
         return {'type': 2,
                 'position': self.start,
                 'text': self.text}
+
+
+NEUTRAL_OPERATION = NeutralOperation()
+
+
+# transformations of an operation to apply it after prev_operation
+
+def neutral_after_any(operation, prev_operation):
+    return NEUTRAL_OPERATION
+
+
+def any_after_neutral(operation, prev_operation):
+    # operations are immutable
+    return operation
+
+
+def insert_after_insert(operation, prev_operation):
+    if operation.start <= prev_operation.start:
+        return operation
+    else:
+        return Insert(operation.start + len(prev_operation.text), operation.text)
+
+
+def insert_after_delete(operation, prev_operation):
+    if operation.start <= prev_operation.start:
+        return operation
+    elif operation.start > prev_operation.end:
+        return Insert(operation.start - len(prev_operation.text), operation.text)
+    else:
+        return Insert(prev_operation.start, operation.text)
+
+
+def delete_after_insert(operation, prev_operation):
+    if prev_operation.start <= operation.start:
+        return Delete(operation.start + len(prev_operation.text), operation.text)
+    elif operation.start < prev_operation.start < operation.end:
+        difference = prev_operation.start - operation.start
+        return Delete(operation.start,
+                      operation.text[:difference] + prev_operation.text + operation.text[difference:])
+    else:
+        return operation
+
+
+def delete_after_delete(operation, prev_operation):
+    if operation.end <= prev_operation.start:
+        return operation
+
+    elif (operation.start < prev_operation.start) and (prev_operation.start < operation.end <= prev_operation.end):
+        return Delete(operation.start, operation.text[:prev_operation.start - operation.start])
+
+    elif (prev_operation.start <= operation.start) and (operation.end <= prev_operation.end):
+        return NEUTRAL_OPERATION
+
+    elif (prev_operation.start <= operation.start <= prev_operation.end) and (prev_operation.end < operation.end):
+        return Delete(prev_operation.start, operation.text[prev_operation.end - operation.start:])
+
+    elif operation.start > prev_operation.end:
+        return Delete(operation.start - len(prev_operation.text), operation.text)
+
+    else:
+        return Delete(operation.start, operation.text[:prev_operation.start - operation.start] +
+                      operation.text[prev_operation.end - operation.start:])
+
+
+TRANSFORMATIONS = {
+    (NeutralOperation, NeutralOperation): neutral_after_any,
+    (NeutralOperation, Insert): neutral_after_any,
+    (NeutralOperation, Delete): neutral_after_any,
+    (Insert, NeutralOperation): any_after_neutral,
+    (Insert, Insert): insert_after_insert,
+    (Insert, Delete): insert_after_delete,
+    (Delete, NeutralOperation): any_after_neutral,
+    (Delete, Insert): delete_after_insert,
+    (Delete, Delete): delete_after_delete,
+}
+
+
+def compose(operation, next_operation):
+    """
+    One operation with the effect of `operation` followed by `next_operation` or None if there is no such.
+    """
+    if isinstance(operation, NeutralOperation):
+        return next_operation
+    if isinstance(next_operation, NeutralOperation):
+        return operation
+
+    if isinstance(operation, Insert) and isinstance(next_operation, Insert):
+        # typing inside the inserted text
+        if operation.start <= next_operation.start <= operation.end:
+            offset = next_operation.start - operation.start
+            return Insert(operation.start, operation.text[:offset] + next_operation.text + operation.text[offset:])
+
+    elif isinstance(operation, Delete) and isinstance(next_operation, Delete):
+        # delete key
+        if next_operation.start == operation.start:
+            return Delete(operation.start, operation.text + next_operation.text)
+        # backspace
+        if next_operation.end == operation.start:
+            return Delete(next_operation.start, next_operation.text + operation.text)
+
+    elif isinstance(operation, Insert) and isinstance(next_operation, Delete):
+        # deleting a part of the inserted text
+        if operation.start <= next_operation.start and next_operation.end <= operation.end:
+            offset = next_operation.start - operation.start
+            text = operation.text[:offset] + operation.text[offset + len(next_operation.text):]
+            return Insert(operation.start, text) if text else NEUTRAL_OPERATION
+
+    return None
+
+
+def compact(operations):
+    # compose the neighbouring operations while it is possible
+    compacted_operations = []
+    for operation in operations:
+        composed_operation = compose(compacted_operations[-1], operation) if compacted_operations else None
+        if composed_operation is None:
+            compacted_operations.append(operation)
+        else:
+            compacted_operations[-1] = composed_operation
+    return compacted_operations
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+from django.conf import settings
+
+from .launched_files import SingletonMeta
+
+
+class GroupOutbox(metaclass=SingletonMeta):
+    """
+    Gathers the messages to a room for GROUP_BATCH_INTERVAL milliseconds and sends them
+    to the room as one batch instead of every message at once.
+    """
+    def __init__(self):
+        # {room: [message, ...]}, a room is here while its flush is scheduled or its batch is being sent
+        self.messages = {}
+        self.tasks = set()
+        self.lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return getattr(settings, 'GROUP_BATCH_INTERVAL', 0) / 1000
+
+    async def send(self, channel_layer, room, message):
+        """
+        message - {'text': encoded content} and optionally
+        {'channel_name': the sender, 'ack': encoded content for the sender}.
+        """
+        if not self.interval:
+            await channel_layer.group_send(room, {'type': 'send_text', **message})
+            return
+
+        with self.lock:
+            is_scheduled = room in self.messages
+            self.messages.setdefault(room, []).append(message)
+
+        if not is_scheduled:
+            # the event loop keeps only weak references to the tasks
+            task = asyncio.ensure_future(self.flush_later(channel_layer, room))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def flush_later(self, channel_layer, room):
+        # the room stays here until its batch is sent, the messages sent meanwhile go to the next batch
+        # of the same task, so the batches of a room are sent one after another
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                with self.lock:
+                    messages = self.messages[room]
+                    self.messages[room] = []
+
+                await channel_layer.group_send(room, {'type': 'send_batch', 'messages': messages})
+                with self.lock:
+                    if not self.messages[room]:
+                        del self.messages[room]
+                        return
+        except BaseException:
+            # the next message schedules a new flush
+            with self.lock:
+                self.messages.pop(room, None)
+            raise
+
+
+def encode_batch(texts):
+    # the messages are encoded already, the batch is put together without decoding them
+    return '{"type": "batch", "messages": [' + ', '.join(texts) + ']}'
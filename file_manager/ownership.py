@@ -0,0 +1,384 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import threading
+import time
+import traceback
+import uuid
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .document import DocumentsManager
+from .logger import file_manager_logger
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+WORKERS_KEY_PREFIX = 'workers'
+# the connections of the other workers, their document messages are handled by the owner of the file
+FORWARDED_CONNECTION = 'file_manager.consumers.ForwardedConnection'
+# the messages which need the document or the running file of the room
+FORWARDED_MESSAGES = frozenset(['file_info', 'change_file_config', 'apply_operation', 'apply_operations',
+                                'operation_history', 'run_file', 'file_input', 'stop_file'])
+
+# the workers are kept in one request, a new, stopped or dead worker changes the version of the ring
+REDIS_ADD_SCRIPT = """
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    redis.call('INCR', KEYS[3])
+end
+"""
+
+REDIS_REMOVE_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 1 then
+    redis.call('INCR', KEYS[3])
+end
+"""
+
+REDIS_RING_SCRIPT = """
+local dead_workers = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+if #dead_workers > 0 then
+    redis.call('ZREM', KEYS[2], unpack(dead_workers))
+    redis.call('HDEL', KEYS[1], unpack(dead_workers))
+    redis.call('INCR', KEYS[3])
+end
+return {redis.call('GET', KEYS[3]) or '0', redis.call('HGETALL', KEYS[1])}
+"""
+
+
+def ownership_enabled():
+    return getattr(settings, 'FILE_OWNERSHIP', False)
+
+
+def get_worker_max_age():
+    # seconds since the last heartbeat after which a worker is considered dead
+    return getattr(settings, 'WORKER_MAX_AGE', 30)
+
+
+def get_forward_timeout():
+    # seconds for the owner of a file to ack a forwarded message
+    return getattr(settings, 'FORWARD_TIMEOUT', 5)
+
+
+def hash_key(key):
+    # the same in every process, unlike hash()
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of the files to the workers. Every worker has FILE_OWNER_REPLICAS points of the ring,
+    a new or a dead worker moves only the files of its points.
+    """
+    def __init__(self, workers, replicas=None):
+        replicas = getattr(settings, 'FILE_OWNER_REPLICAS', 64) if replicas is None else replicas
+        points = sorted((hash_key(f'{worker}:{replica}'), worker) for worker in workers for replica in range(replicas))
+        self.hashes = [point_hash for point_hash, _ in points]
+        self.workers = [worker for _, worker in points]
+
+    def owner(self, key):
+        # None for an empty ring
+        if not self.hashes:
+            return None
+        return self.workers[bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)]
+
+
+class MemoryWorkers:
+    """
+    Workers in the memory of the process, for tests and a single node.
+    """
+    def __init__(self):
+        # {worker_id: [channel_name, last_seen]}
+        self.workers = {}
+        # changed by every new, stopped or dead worker
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add(self, worker_id, channel_name):
+        # a heartbeat too
+        with self.lock:
+            if worker_id not in self.workers:
+                self.version += 1
+            self.workers[worker_id] = [channel_name, time.time()]
+
+    def remove(self, worker_id):
+        with self.lock:
+            if self.workers.pop(worker_id, None) is not None:
+                self.version += 1
+
+    def ring(self, max_age):
+        """
+        -> (version, {worker_id: channel_name} of the live workers), the dead workers are removed.
+        """
+        oldest_seen = time.time() - max_age
+        with self.lock:
+            dead_workers = [worker_id for worker_id, (_, last_seen) in self.workers.items() if last_seen < oldest_seen]
+            if dead_workers:
+                for worker_id in dead_workers:
+                    del self.workers[worker_id]
+                self.version += 1
+            return self.version, {worker_id: channel_name for worker_id, (channel_name, _) in self.workers.items()}
+
+
+class RedisWorkers:
+    """
+    Workers in Redis: a hash of their channel names, a sorted set of their last heartbeats
+    and the version of the ring.
+    """
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured("RedisWorkers requires the redis package")
+        self.redis = redis.Redis.from_url(getattr(settings, 'WORKERS_REDIS_URL', 'redis://127.0.0.1:6379/0'),
+                                          decode_responses=True)
+        self.keys = [f'{WORKERS_KEY_PREFIX}:{key}' for key in ('channels', 'seen', 'version')]
+        self.add_script = self.redis.register_script(REDIS_ADD_SCRIPT)
+        self.remove_script = self.redis.register_script(REDIS_REMOVE_SCRIPT)
+        self.ring_script = self.redis.register_script(REDIS_RING_SCRIPT)
+
+    def add(self, worker_id, channel_name):
+        self.add_script(keys=self.keys, args=[worker_id, channel_name, time.time()])
+
+    def remove(self, worker_id):
+        self.remove_script(keys=self.keys, args=[worker_id])
+
+    def ring(self, max_age):
+        version, channels = self.ring_script(keys=self.keys, args=[time.time() - max_age])
+        return int(version), dict(zip(channels[::2], channels[1::2]))
+
+
+@functools.lru_cache(maxsize=None)
+def load_workers(path):
+    return import_string(path)()
+
+
+def get_workers():
+    """
+    The workers backend of WORKERS_BACKEND.
+    """
+    return load_workers(getattr(settings, 'WORKERS_BACKEND', 'file_manager.ownership.RedisWorkers'))
+
+
+class FileOwnership:
+    """
+    Ownership of the files by the workers. Only the owner of a file keeps its document,
+    the other workers forward the document messages of their connections to the channel of the owner.
+    The files of a stopped worker are handed off to the other workers through the database.
+    The workers converge on the version of the ring in the workers backend: a worker which sees a new version
+    notifies the others, a forwarded message of another version makes the receiver read the ring again.
+    """
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.channel_layer = None
+        self.channel_name = None
+        # {worker_id: channel_name} of the ring
+        self.channels = {}
+        self.ring = HashRing([])
+        self.version = None
+        # {message id: timeout handle} of the messages forwarded by this worker and not acked by the owner yet
+        self.pending = {}
+        # {channel_name: ForwardedConnection}
+        self.connections = {}
+        self.tasks = set()
+
+    @property
+    def is_started(self):
+        return self.channel_layer is not None
+
+    def owner_channel(self, file_id):
+        """
+        The channel of the owner of the file or None when the file is owned by this worker.
+        """
+        owner = self.ring.owner(file_id)
+        if owner is None or owner == self.worker_id:
+            return None
+        return self.channels[owner]
+
+    async def start(self, channel_layer):
+        if self.is_started:
+            return
+        self.channel_layer = channel_layer
+        self.channel_name = await channel_layer.new_channel('file_owner')
+        await sync_to_async(self.refresh, thread_sensitive=False)()
+
+        for coroutine in (self.listen(), self.heartbeat()):
+            # the event loop keeps only weak references to the tasks
+            task = asyncio.ensure_future(coroutine)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        # the other workers hand off the files owned by this worker now
+        await self.notify_workers()
+
+    async def stop(self):
+        if not self.is_started:
+            return
+        for task in list(self.tasks):
+            task.cancel()
+        for timeout in self.pending.values():
+            timeout.cancel()
+        self.pending.clear()
+        await sync_to_async(self.hand_off_all, thread_sensitive=False)()
+        await self.notify_workers()
+        self.channel_layer = None
+
+    async def notify_workers(self):
+        for worker_id, channel_name in self.channels.items():
+            if worker_id != self.worker_id:
+                await self.channel_layer.send(channel_name, {'type': 'refresh'})
+
+    async def forward(self, file_id, message):
+        """
+        Send the message to the owner of the file. A message with an id is acked by the owner,
+        otherwise its connection gets forward_timeout in FORWARD_TIMEOUT seconds.
+        """
+        channel_name = self.owner_channel(file_id)
+        if channel_name is None:
+            # the file has been handed off to this worker, the message is handled here
+            channel_name = self.channel_name
+        if 'id' in message and 'reply_channel' not in message:
+            self.pending[message['id']] = asyncio.get_event_loop().call_later(
+                get_forward_timeout(), self.time_out, message)
+            message = {**message, 'reply_channel': self.channel_name}
+        await self.channel_layer.send(channel_name, {**message, 'file_id': file_id, 'ring_version': self.version})
+
+    def time_out(self, message):
+        del self.pending[message['id']]
+        task = asyncio.ensure_future(self.answer_time_out(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def answer_time_out(self, message):
+        await self.channel_layer.send(message['channel_name'], {'type': 'forward_timeout',
+                                                                'id': message['id'],
+                                                                'content_type': message['content']['type']})
+        # the owner may be dead
+        await self.refresh_ring()
+
+    async def refresh_ring(self):
+        # the other workers read the ring again too when it has changed
+        if await sync_to_async(self.refresh, thread_sensitive=False)():
+            await self.notify_workers()
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(get_worker_max_age() / 3)
+            await self.refresh_ring()
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel_name)
+            try:
+                if message['type'] == 'refresh':
+                    await sync_to_async(self.refresh, thread_sensitive=False)()
+                elif message['type'] == 'forward_ack':
+                    timeout = self.pending.pop(message['id'], None)
+                    if timeout is not None:
+                        timeout.cancel()
+                else:
+                    await self.receive_forwarded(message)
+            except Exception as e:
+                file_manager_logger.error(f"FORWARDED MESSAGE FAILED {message} {e} {traceback.format_exc()}")
+
+    async def receive_forwarded(self, message):
+        if message.get('ring_version') != self.version:
+            # the sender has another ring, the file can be owned by another worker
+            await sync_to_async(self.refresh, thread_sensitive=False)()
+            if self.owner_channel(message['file_id']) is not None:
+                await self.forward(message['file_id'], message)
+                return
+
+        await database_sync_to_async(self.handle)(message)
+        if 'reply_channel' in message:
+            await self.channel_layer.send(message['reply_channel'], {'type': 'forward_ack',
+                                                                     'id': message['id']})
+
+    def refresh(self):
+        """
+        Read the ring of the workers backend, -> whether it has changed.
+        """
+        workers = get_workers()
+        workers.add(self.worker_id, self.channel_name)
+        version, channels = workers.ring(get_worker_max_age())
+        if version == self.version:
+            return False
+        self.version = version
+        self.channels = channels
+        self.ring = HashRing(channels)
+        self.hand_off()
+        return True
+
+    def hand_off(self):
+        # the documents of the files owned by another worker are written for their new owner
+        documents_manager = DocumentsManager()
+        for document in documents_manager.opened_documents():
+            if self.owner_channel(document.file_id) is not None:
+                documents_manager.close_document(document.file_id)
+
+    def hand_off_all(self):
+        get_workers().remove(self.worker_id)
+        self.channels.pop(self.worker_id, None)
+        self.ring = HashRing(self.channels)
+        documents_manager = DocumentsManager()
+        for document in documents_manager.opened_documents():
+            documents_manager.close_document(document.file_id)
+
+    def handle(self, message):
+        """
+        Handle a message forwarded by another worker: {'type': 'forward', 'content': message of the client, ...}
+        or {'type': 'forward_disconnect', 'last': the room is empty, ...}.
+        """
+        connection = self.connections.get(message['channel_name'])
+        if message['type'] == 'forward_disconnect':
+            if connection is None:
+                connection = import_string(FORWARDED_CONNECTION)(self.channel_layer, message)
+            else:
+                del self.connections[message['channel_name']]
+            connection.disconnect_forwarded(message['last'])
+            return
+
+        if connection is None:
+            connection = import_string(FORWARDED_CONNECTION)(self.channel_layer, message)
+            self.connections[message['channel_name']] = connection
+        connection.receive_forwarded(message)
+
+
+def find_owner_channel(file_id):
+    """
+    The channel of the owner of the file for a process which is not a worker, e.g. a management command.
+    None when there are no live workers.
+    """
+    _, channels = get_workers().ring(get_worker_max_age())
+    owner = HashRing(channels).owner(file_id)
+    return None if owner is None else channels[owner]
+
+
+@functools.lru_cache(maxsize=None)
+def get_ownership():
+    """
+    The ownership of this worker.
+    """
+    return FileOwnership()
+
+
+class OwnershipLifespan:
+    """
+    ASGI lifespan of a worker: its files are handed off on shutdown.
+    """
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await get_ownership().stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
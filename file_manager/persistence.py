@@ -0,0 +1,170 @@
+import atexit
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connections
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .launched_files import SingletonMeta
+from .logger import file_manager_logger
+from .codec import get_codec
+from .exceptions import RevisionConflictException, DocumentWriteException
+
+
+def single_writer():
+    # every file is written by one process: the owner of the file (FILE_OWNERSHIP) or the only worker (SINGLE_WORKER)
+    return getattr(settings, 'FILE_OWNERSHIP', False) or getattr(settings, 'SINGLE_WORKER', False)
+
+
+def broadcast_resync(document):
+    # the clients of the room have the operations which are lost, they take the content of the database
+    content, revision = document.state()
+    text = get_codec().dumps({'type': 'resync',
+                              'content': content,
+                              'revision': revision})
+    async_to_sync(get_channel_layer().group_send)(f'file_{document.file_id}', {'type': 'send_text', 'text': text})
+
+
+class Durability:
+    # every operation is written before it is broadcast
+    SYNC = 'sync'
+    # operations are collected and written by the background thread
+    WRITE_BEHIND = 'write_behind'
+
+
+def check_durability():
+    """
+    Warn when write-behind is configured but cannot take effect, returns whether the durability is as configured.
+    """
+    durability = getattr(settings, 'DOCUMENT_DURABILITY', Durability.WRITE_BEHIND)
+    if durability == Durability.WRITE_BEHIND and not single_writer():
+        file_manager_logger.warning("DOCUMENT_DURABILITY is 'write_behind' but neither SINGLE_WORKER "
+                                    "nor FILE_OWNERSHIP is set, every operation is written at once ('sync')")
+        return False
+    return True
+
+
+class PersisterMetrics:
+    def __init__(self):
+        self.flushes = 0
+        self.flushed_operations = 0
+        self.failed_flushes = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+    def add_flush(self, operations_number, lag):
+        self.flushes += 1
+        self.flushed_operations += operations_number
+        self.last_flush_lag = lag
+        self.max_flush_lag = max(self.max_flush_lag, lag)
+
+    def info(self):
+        return {'flushes': self.flushes,
+                'flushed_operations': self.flushed_operations,
+                'failed_flushes': self.failed_flushes,
+                'last_flush_lag': self.last_flush_lag,
+                'max_flush_lag': self.max_flush_lag}
+
+
+class DocumentPersister(metaclass=SingletonMeta):
+    """
+    Write-behind persistence of the opened documents.
+    A dirty document is flushed when it has been dirty for DOCUMENT_FLUSH_INTERVAL seconds
+    or has DOCUMENT_FLUSH_OPERATIONS unsaved operations, when it is closed and on shutdown.
+    """
+    def __init__(self):
+        self.dirty_documents = {}
+        self.metrics = PersisterMetrics()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    @property
+    def durability(self):
+        # the other workers would write the same revisions of the file
+        if not single_writer():
+            return Durability.SYNC
+        return getattr(settings, 'DOCUMENT_DURABILITY', Durability.WRITE_BEHIND)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'DOCUMENT_FLUSH_INTERVAL', 2)
+
+    @property
+    def flush_operations(self):
+        return getattr(settings, 'DOCUMENT_FLUSH_OPERATIONS', 100)
+
+    def schedule(self, document):
+        if self.durability == Durability.SYNC:
+            self.flush(document)
+            return
+
+        with self.condition:
+            self.dirty_documents.setdefault(document.file_id, document)
+            if len(document.pending_operations) >= self.flush_operations:
+                self.condition.notify()
+        self.start()
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="document persister", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush_all)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_interval / 2)
+                documents = [document for document in self.dirty_documents.values() if self.is_due(document)]
+
+            for document in documents:
+                self.flush(document)
+
+            # the thread must not keep connections between flushes
+            connections.close_all()
+
+    def is_due(self, document):
+        return document.dirty_since is not None and \
+            (time.monotonic() - document.dirty_since >= self.flush_interval or
+             len(document.pending_operations) >= self.flush_operations)
+
+    def flush(self, document):
+        with self.condition:
+            self.dirty_documents.pop(document.file_id, None)
+
+        try:
+            result = document.flush()
+        except RevisionConflictException as e:
+            # the document is reloaded, the operations are lost
+            self.metrics.failed_flushes += 1
+            file_manager_logger.error(e.message)
+            if self.durability == Durability.SYNC:
+                # the operation is not broadcast yet, its client gets the error
+                raise
+            broadcast_resync(document)
+            return
+        except Exception as e:
+            self.metrics.failed_flushes += 1
+            file_manager_logger.error(f"FLUSH FAILED {document.file_id} {e} {traceback.format_exc()}")
+            if self.durability == Durability.SYNC:
+                # nothing flushes later in sync mode, the operations are dropped before they are broadcast
+                document.reload()
+                raise DocumentWriteException(document.file_id)
+            # try again with the next flush
+            with self.condition:
+                self.dirty_documents.setdefault(document.file_id, document)
+            return
+
+        if result:
+            self.metrics.add_flush(*result)
+            file_manager_logger.info(f"FLUSH {document.file_id} {self.metrics.info()}")
+
+    def flush_all(self):
+        with self.condition:
+            documents = list(self.dirty_documents.values())
+
+        for document in documents:
+            self.flush(document)
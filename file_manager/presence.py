@@ -0,0 +1,172 @@
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+PRESENCE_KEY_PREFIX = 'presence'
+# rooms with presences, scanned by the expiry
+PRESENCE_ROOMS_KEY = f'{PRESENCE_KEY_PREFIX}:rooms'
+# dead connections removed by one request
+PRESENCE_EXPIRE_BATCH_SIZE = 1000
+
+
+def get_max_age():
+    # seconds since the last message after which a connection is considered dead
+    return getattr(settings, 'PRESENCE_MAX_AGE', 60)
+
+
+def get_touch_interval():
+    # a connection updates its last message time at most once in this number of seconds
+    return getattr(settings, 'PRESENCE_TOUCH_INTERVAL', 10)
+
+
+class MemoryPresence:
+    """
+    Presence of the connections in the memory of the process, for tests and a single worker.
+    """
+    def __init__(self):
+        # {room: {channel_name: [user_id, last_seen]}}
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def add(self, room, channel_name, user_id):
+        """
+        Add the connection, returns the number of connections of the user to the room.
+        """
+        with self.lock:
+            presences = self.rooms.setdefault(room, {})
+            presences[channel_name] = [user_id, time.time()]
+            return sum(1 for presence_user_id, _ in presences.values() if presence_user_id == user_id)
+
+    def remove(self, room, channel_name):
+        """
+        Remove the connection, returns the ids of the users left in the room.
+        """
+        with self.lock:
+            presences = self.rooms.get(room, {})
+            presences.pop(channel_name, None)
+            if not presences:
+                self.rooms.pop(room, None)
+            return {user_id for user_id, _ in presences.values()}
+
+    def touch(self, room, channel_name):
+        with self.lock:
+            presence = self.rooms.get(room, {}).get(channel_name)
+            if presence is not None:
+                presence[1] = time.time()
+
+    def channels(self, room, user_id=None):
+        with self.lock:
+            return [channel_name for channel_name, (presence_user_id, _) in self.rooms.get(room, {}).items()
+                    if user_id is None or presence_user_id == user_id]
+
+    def user_ids(self, room):
+        with self.lock:
+            return {user_id for user_id, _ in self.rooms.get(room, {}).values()}
+
+    def expire(self, max_age):
+        """
+        Remove the connections without messages for `max_age` seconds,
+        returns [(room, channel_name, user_id), ...].
+        """
+        expired = []
+        oldest_seen = time.time() - max_age
+        with self.lock:
+            for room, presences in list(self.rooms.items()):
+                for channel_name, (user_id, last_seen) in list(presences.items()):
+                    if last_seen < oldest_seen:
+                        del presences[channel_name]
+                        expired.append((room, channel_name, user_id))
+                if not presences:
+                    del self.rooms[room]
+        return expired
+
+
+class RedisPresence:
+    """
+    Presence of the connections in Redis. Every room has a sorted set of channel names
+    scored by the time of their last message and a hash of their user ids.
+    """
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured("RedisPresence requires the redis package")
+        self.redis = redis.Redis.from_url(getattr(settings, 'PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/0'),
+                                          decode_responses=True)
+
+    @staticmethod
+    def keys(room):
+        # -> (sorted set of the last seen times, hash of the user ids)
+        return f'{PRESENCE_KEY_PREFIX}:{room}:seen', f'{PRESENCE_KEY_PREFIX}:{room}:users'
+
+    def add(self, room, channel_name, user_id):
+        seen_key, users_key = self.keys(room)
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(seen_key, {channel_name: time.time()})
+        pipeline.hset(users_key, channel_name, user_id)
+        pipeline.sadd(PRESENCE_ROOMS_KEY, room)
+        pipeline.hvals(users_key)
+        return pipeline.execute()[-1].count(str(user_id))
+
+    def remove(self, room, channel_name):
+        seen_key, users_key = self.keys(room)
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(seen_key, channel_name)
+        pipeline.hdel(users_key, channel_name)
+        pipeline.hvals(users_key)
+        return {int(user_id) for user_id in pipeline.execute()[-1]}
+
+    def touch(self, room, channel_name):
+        # only a present connection is updated
+        self.redis.zadd(self.keys(room)[0], {channel_name: time.time()}, xx=True)
+
+    def channels(self, room, user_id=None):
+        presences = self.redis.hgetall(self.keys(room)[1])
+        return [channel_name for channel_name, presence_user_id in presences.items()
+                if user_id is None or presence_user_id == str(user_id)]
+
+    def user_ids(self, room):
+        return {int(user_id) for user_id in self.redis.hvals(self.keys(room)[1])}
+
+    def expire(self, max_age, batch_size=PRESENCE_EXPIRE_BATCH_SIZE):
+        expired = []
+        oldest_seen = time.time() - max_age
+        for room in self.redis.sscan_iter(PRESENCE_ROOMS_KEY):
+            seen_key, users_key = self.keys(room)
+            while True:
+                channel_names = self.redis.zrangebyscore(seen_key, '-inf', oldest_seen, start=0, num=batch_size)
+                if not channel_names:
+                    break
+
+                pipeline = self.redis.pipeline()
+                pipeline.hmget(users_key, channel_names)
+                pipeline.zrem(seen_key, *channel_names)
+                pipeline.hdel(users_key, *channel_names)
+                user_ids = pipeline.execute()[0]
+                expired.extend((room, channel_name, int(user_id))
+                               for channel_name, user_id in zip(channel_names, user_ids) if user_id is not None)
+
+            # a room is added again by the next connection
+            if not self.redis.zcard(seen_key):
+                self.redis.srem(PRESENCE_ROOMS_KEY, room)
+        return expired
+
+
+@functools.lru_cache(maxsize=None)
+def load_presence(path):
+    return import_string(path)()
+
+
+def get_presence():
+    """
+    The presence backend of PRESENCE_BACKEND.
+    """
+    return load_presence(getattr(settings, 'PRESENCE_BACKEND', 'file_manager.presence.RedisPresence'))
@@ -0,0 +1,256 @@
+import collections
+import functools
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .models import UserFiles
+from .serializers import serialize_user_with_access
+from .presence import get_presence
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+ROSTER_KEY_PREFIX = 'roster'
+
+# keeps the version, the current entry and the change in one request
+REDIS_UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local version = redis.call('INCR', KEYS[1])
+if ARGV[3] == '-' then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+elseif ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+end
+redis.call('RPUSH', KEYS[3], '{"version": ' .. version .. ', ' .. string.sub(ARGV[1], 2))
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[4]), -1)
+return version
+"""
+
+# another worker can load the same roster, the first one wins
+REDIS_LOAD_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX') then
+    redis.call('DEL', KEYS[2], KEYS[3])
+    for i = 2, #ARGV, 2 do
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+# a roster changed since `version` is kept, e.g. a user has joined the room after the last one left
+REDIS_DELETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+    return 1
+end
+return 0
+"""
+
+
+def get_changes_size():
+    # number of the last changes of a room kept for the clients asking for the changes since a version
+    return getattr(settings, 'ROSTER_CHANGES_SIZE', 100)
+
+
+def first_version():
+    # a roster loaded again does not continue the versions of the previous one
+    return int(time.time() * 1000)
+
+
+class MemoryRoster:
+    """
+    Rosters of the rooms in the memory of the process, for tests and a single worker.
+    """
+    def __init__(self):
+        # {room: [version, {user_id: user with access}, changes]}
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def get(self, room):
+        """
+        -> (version, {user_id: user with access}) or None when the roster is not loaded.
+        """
+        with self.lock:
+            if room not in self.rooms:
+                return None
+            version, entries, _ = self.rooms[room]
+            return version, dict(entries)
+
+    def load(self, room, entries):
+        with self.lock:
+            self.rooms.setdefault(room, [first_version(), entries, collections.deque(maxlen=get_changes_size())])
+        return self.get(room)
+
+    def update(self, room, change):
+        """
+        Apply the change of one user: 'entry' - the new user with access or None, 'active' - presence.
+        Returns the new version or None when the roster is not loaded.
+        """
+        with self.lock:
+            if room not in self.rooms:
+                return None
+            roster = self.rooms[room]
+            roster[0] += 1
+            if 'entry' in change:
+                if change['entry'] is None:
+                    roster[1].pop(change['user_id'], None)
+                else:
+                    roster[1][change['user_id']] = change['entry']
+            roster[2].append({'version': roster[0], **change})
+            return roster[0]
+
+    def changes(self, room, version):
+        """
+        -> (current version, changes since `version`) or None when they are not kept.
+        """
+        with self.lock:
+            if room not in self.rooms:
+                return None
+            current_version, _, changes = self.rooms[room]
+            return select_changes(current_version, list(changes), version)
+
+    def delete(self, room, version):
+        """
+        Delete the roster unless it has changed since `version`, returns whether it is deleted.
+        """
+        with self.lock:
+            if room not in self.rooms or self.rooms[room][0] != version:
+                return False
+            del self.rooms[room]
+            return True
+
+
+class RedisRoster:
+    """
+    Rosters of the rooms in Redis: the version, a hash of the users with access and a list of the last changes.
+    """
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured("RedisRoster requires the redis package")
+        self.redis = redis.Redis.from_url(getattr(settings, 'ROSTER_REDIS_URL', 'redis://127.0.0.1:6379/0'),
+                                          decode_responses=True)
+        self.update_script = self.redis.register_script(REDIS_UPDATE_SCRIPT)
+        self.load_script = self.redis.register_script(REDIS_LOAD_SCRIPT)
+        self.delete_script = self.redis.register_script(REDIS_DELETE_SCRIPT)
+
+    @staticmethod
+    def keys(room):
+        # -> (version, users, changes)
+        return tuple(f'{ROSTER_KEY_PREFIX}:{room}:{key}' for key in ('version', 'users', 'changes'))
+
+    def get(self, room):
+        version_key, users_key, _ = self.keys(room)
+        pipeline = self.redis.pipeline()
+        pipeline.get(version_key)
+        pipeline.hgetall(users_key)
+        version, entries = pipeline.execute()
+        if version is None:
+            return None
+        entries = sorted((int(user_id), json.loads(entry)) for user_id, entry in entries.items())
+        return int(version), dict(entries)
+
+    def load(self, room, entries):
+        args = [first_version()]
+        for user_id, entry in entries.items():
+            args.extend((user_id, json.dumps(entry)))
+        self.load_script(keys=self.keys(room), args=args)
+        return self.get(room)
+
+    def update(self, room, change):
+        if 'entry' not in change:
+            entry = ''
+        elif change['entry'] is None:
+            entry = '-'
+        else:
+            entry = json.dumps(change['entry'])
+        version = self.update_script(keys=self.keys(room),
+                                     args=[json.dumps(change), change['user_id'], entry, get_changes_size()])
+        return None if version is None else int(version)
+
+    def changes(self, room, version):
+        version_key, _, changes_key = self.keys(room)
+        pipeline = self.redis.pipeline()
+        pipeline.get(version_key)
+        pipeline.lrange(changes_key, 0, -1)
+        current_version, changes = pipeline.execute()
+        if current_version is None:
+            return None
+        return select_changes(int(current_version), [json.loads(change) for change in changes], version)
+
+    def delete(self, room, version):
+        return bool(self.delete_script(keys=self.keys(room), args=[version]))
+
+
+def select_changes(current_version, changes, version):
+    if version == current_version:
+        return current_version, []
+    # the changes since `version` must all be kept
+    if version > current_version or not changes or changes[0]['version'] > version + 1:
+        return None
+    return current_version, [change for change in changes if change['version'] > version]
+
+
+@functools.lru_cache(maxsize=None)
+def load_roster(path):
+    return import_string(path)()
+
+
+def get_roster():
+    """
+    The roster backend of ROSTER_BACKEND.
+    """
+    return load_roster(getattr(settings, 'ROSTER_BACKEND', 'file_manager.roster.RedisRoster'))
+
+
+def get_room_roster(room, file_id):
+    """
+    -> (version, {user_id: user with access}), the roster is loaded from the database by the first call.
+    """
+    roster = get_roster()
+    room_roster = roster.get(room)
+    if room_roster is None:
+        users_with_accesses = UserFiles.objects.with_users().filter(file__id=file_id).order_by('user__id')
+        room_roster = roster.load(room, {user_files.user_id: serialize_user_with_access(user_files)
+                                         for user_files in users_with_accesses})
+    return room_roster
+
+
+def get_active_users(room, file_id):
+    _, entries = get_room_roster(room, file_id)
+    user_ids = get_presence().user_ids(room)
+    return [entry for user_id, entry in entries.items() if user_id in user_ids]
+
+
+def get_all_users(room, file_id):
+    _, entries = get_room_roster(room, file_id)
+    return list(entries.values())
+
+
+def get_roster_since(room, file_id, version=None):
+    """
+    The changes since `version` or the whole roster when they are not kept.
+    """
+    if version is not None:
+        changes = get_roster().changes(room, version)
+        if changes is not None:
+            current_version, changes = changes
+            return {'version': current_version, 'changes': changes}
+
+    current_version, entries = get_room_roster(room, file_id)
+    user_ids = get_presence().user_ids(room)
+    return {'version': current_version,
+            'users': [{**entry, 'active': user_id in user_ids} for user_id, entry in entries.items()]}
+
+
+def update_roster(room, user_id, **change):
+    # a change of a roster which is not loaded is skipped, the roster is loaded with it
+    return get_roster().update(room, {'user_id': user_id, **change})
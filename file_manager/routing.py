@@ -1,7 +1,15 @@
+from django.conf import settings
 from django.urls import path
+from django.utils.module_loading import import_string
 
-from .consumers import FileEditorConsumer
 
-websocket_urlpatterns = [
-    path('files/<file_id>/<access_token>/', FileEditorConsumer.as_asgi()),
-]
+def get_websocket_urlpatterns(consumer):
+    return [
+        path('files/<file_id>/<access_token>/', consumer.as_asgi()),
+    ]
+
+
+FILE_EDITOR_CONSUMER = import_string(getattr(settings, 'FILE_EDITOR_CONSUMER',
+                                             'file_manager.consumers.FileEditorConsumer'))
+
+websocket_urlpatterns = get_websocket_urlpatterns(FILE_EDITOR_CONSUMER)
@@ -1,27 +1,63 @@
-import threading
+import asyncio
+import codecs
 import os
+import threading
 import traceback
 
-import pexpect
+from django.conf import settings
 
 from helpers.logger import create_logger
 
 
 FILE_PATH = '/home/username/Code_Docs/running_files/'
 DOCKER_IMAGES = {'python': 'code_docs_python'}
+# sent after the output of a run which is over RUN_OUTPUT_LIMIT
+OUTPUT_TRUNCATED = '\n[output truncated]\n'
 
 
 run_file_logger = create_logger("run_file_logger")
 
 
-class RunFileThread(threading.Thread):
-    def __init__(self, file_name, file_content, programming_language, consumer=1):
-        super().__init__(name="run file")
+def get_output_pacing_interval():
+    # seconds between two outputs of a run, the output read meanwhile is sent as one message
+    return getattr(settings, 'RUN_OUTPUT_PACING_INTERVAL', 50) / 1000
+
+
+def get_output_chunk_size():
+    return getattr(settings, 'RUN_OUTPUT_CHUNK_SIZE', 16 * 1024)
+
+
+def get_output_limit():
+    # 0 - no limit
+    return getattr(settings, 'RUN_OUTPUT_LIMIT', 1024 * 1024)
+
+
+def get_command(filename, programming_language):
+    # without a terminal the output of python is buffered until the end
+    return ['docker', 'run',
+            '--mount', f'type=bind,source={filename},destination=/root/my_file,readonly',
+            '--rm', '-i', '-e', 'PYTHONUNBUFFERED=1',
+            DOCKER_IMAGES[programming_language]]
+
+
+class RunFileTask:
+    """
+    Runs a file as an asyncio subprocess in the event loop: the output (stdout and stderr) is sent
+    to the consumer as soon as it is read and the inputs are written from a queue, no thread is taken by a run.
+    The consumer has async file_output and send_to_group, launched_file_manager and file.
+    """
+    def __init__(self, file_name, file_content, programming_language, consumer):
         self.filename = self.create_file(file_name, file_content)
-        self.docker_image = DOCKER_IMAGES[programming_language]
+        self.command = get_command(self.filename, programming_language)
         self.consumer = consumer
-        self.inputs = []
-        self.__close_force = False
+        self.loop = None
+        self.inputs = None
+        self.process = None
+        self.task = None
+        self.is_closed = False
+        # the task is registered before it is started, the inputs wait for the loop
+        self.pending_inputs = []
+        self.start_lock = threading.Lock()
 
     def create_file(self, file_name, file_content):
         generated_filename = FILE_PATH + file_name
@@ -40,56 +76,120 @@ class RunFileThread(threading.Thread):
             os.remove(self.filename)
         except OSError:
             run_file_logger.info("file was deleted")
-            pass
+
+    async def start(self):
+        with self.start_lock:
+            self.loop = asyncio.get_running_loop()
+            self.inputs = asyncio.Queue()
+            for file_input in self.pending_inputs:
+                self.inputs.put_nowait(file_input)
+            self.pending_inputs = []
+        # a task closed before the start kills its process as soon as it is created
+        self.task = asyncio.ensure_future(self.run())
 
     def add_input(self, file_input):
+        # the consumers call it from their threads too
         run_file_logger.info(f"ADD INPUT {file_input}")
-        self.inputs.append(file_input)
-        run_file_logger.info(f"INPUTS NOW {self.inputs}")
-
-    def run(self) -> None:
-        run_file_logger.info("start RunFileThread")
-        command = f'docker run ' \
-                  f'--mount type=bind,source={self.filename},destination=/root/my_file,readonly ' \
-                  f'--rm -it {self.docker_image}'
-
-        child = pexpect.spawn(command, encoding='utf-8')
-        child.timeout = 1
-        child.delimiter = pexpect.TIMEOUT
-        try:
-            while True:
-                # force process to stop
-                if self.__close_force:
-                    run_file_logger.info("force close child")
-                    child.close(force=True)
-                    break
-
-                if self.inputs:
-                    run_file_logger.info(f"before send input - {self.inputs[-1]}")
-                    child.sendline(self.inputs.pop(0))
+        with self.start_lock:
+            if self.loop is None:
+                self.pending_inputs.append(file_input)
+                return
+        self.loop.call_soon_threadsafe(self.inputs.put_nowait, file_input)
 
-                try:
-                    output = child.readline()
-                    if child.after == pexpect.TIMEOUT:
-                        # run_file_logger.info("in if")
-                        output = child.read(len(child.before))
-                    if output:
-                        self.consumer.file_output(output)
-                except Exception as exc:
-                    run_file_logger.error(f"{__name__} {exc} {traceback.format_exc()}")
-
-                if not child.isalive():
-                    if child.before:
-                        self.consumer.file_output(child.before)
-                    break
+    def close(self):
+        with self.start_lock:
+            if self.loop is None:
+                self.is_closed = True
+                return
+        self.loop.call_soon_threadsafe(self.kill)
+
+    def kill(self):
+        self.is_closed = True
+        if self.process is not None and self.process.returncode is None:
+            run_file_logger.info("force close child")
+            self.process.kill()
+
+    async def run(self):
+        run_file_logger.info("start RunFileTask")
+        exit_code = None
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.command,
+                                                                stdin=asyncio.subprocess.PIPE,
+                                                                stdout=asyncio.subprocess.PIPE,
+                                                                stderr=asyncio.subprocess.STDOUT)
+            if self.is_closed:
+                self.kill()
+
+            writer = asyncio.ensure_future(self.write_inputs())
+            try:
+                await self.read_output()
+                exit_code = await self.process.wait()
+            finally:
+                writer.cancel()
         except Exception as exc:
-            run_file_logger.error(f"123 {__name__} {exc} {traceback.format_exc()}")
-            self.consumer.file_output("Your time is over")
-            child.close(force=True)
+            run_file_logger.error(f"{__name__} {exc} {traceback.format_exc()}")
+            if self.process is not None:
+                self.kill()
         finally:
-            self.consumer.send_to_group({'type': 'END run_file', 'exit_code': child.exitstatus})
-            self.consumer.launched_file_manager.remove_stopped_file(self.consumer.file.pk)
+            # stop_file removes the file itself
+            launched_file_manager = self.consumer.launched_file_manager
+            if launched_file_manager.launched_files.get(self.consumer.file.pk) is self:
+                launched_file_manager.remove_stopped_file(self.consumer.file.pk)
             self.delete_file()
-
-    def close(self):
-        self.__close_force = True
+            # the file can be run again when the room gets the end
+            await self.consumer.send_to_group({'type': 'END run_file', 'exit_code': exit_code})
+
+    async def read_output(self):
+        """
+        The output is paced: it is sent at most once per RUN_OUTPUT_PACING_INTERVAL and at most RUN_OUTPUT_CHUNK_SIZE
+        bytes at once. Nothing is read while a full chunk waits for its turn, so a child writing faster than the pace
+        waits on the pipe. The pace is fixed, it does not follow how fast the room takes the output.
+        Only RUN_OUTPUT_LIMIT bytes of a run are sent, cut at a character boundary, the rest is read and dropped.
+        """
+        interval, chunk_size, limit = get_output_pacing_interval(), get_output_chunk_size(), get_output_limit()
+        # a character can be split between two reads
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        chunk = bytearray()
+        sent_size = 0
+        next_send = 0
+        while True:
+            if chunk and self.loop.time() >= next_send:
+                sent_size += len(chunk)
+                await self.send_output(decoder.decode(bytes(chunk)))
+                chunk.clear()
+                next_send = self.loop.time() + interval
+            elif len(chunk) >= chunk_size:
+                await asyncio.sleep(next_send - self.loop.time())
+            else:
+                # the first output after a pause is sent at once, the next ones wait for the interval
+                timeout = next_send - self.loop.time() if chunk else None
+                try:
+                    data = await asyncio.wait_for(self.process.stdout.read(chunk_size - len(chunk)), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    break
+                if limit and sent_size + len(chunk) + len(data) > limit:
+                    # the bytes of a split character kept by the decoder are counted in sent_size already
+                    allowed = limit - sent_size + len(decoder.getstate()[0])
+                    output = decoder.decode(bytes(chunk + data)).encode()[:allowed].decode('utf-8', 'ignore')
+                    await self.send_output(output + OUTPUT_TRUNCATED)
+                    while await self.process.stdout.read(chunk_size):
+                        pass
+                    return
+                chunk += data
+
+        await self.send_output(decoder.decode(bytes(chunk), final=True))
+
+    async def send_output(self, output):
+        if output:
+            await self.consumer.file_output(output)
+
+    async def write_inputs(self):
+        while True:
+            file_input = await self.inputs.get()
+            try:
+                self.process.stdin.write(f"{file_input}\n".encode())
+                await self.process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                return
@@ -1,13 +1,13 @@
 from rest_framework import serializers
 
 from file_manager.models import File, UserFiles, Operations
-from authentication.serializers import UserSerializer
+from authentication.serializers import UserSerializer, serialize_user
 
 
 class FileWithoutContentSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
-        exclude = ('created', 'users', 'content')
+        exclude = ('created', 'users', 'content', 'snapshot_revision')
 
 
 class UserFilesSerializer(serializers.ModelSerializer):
@@ -36,3 +36,32 @@ class OperationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Operations
         fields = ('type', 'position', 'text', 'revision', 'channel_name')
+
+
+# The websocket messages are built by plain functions with the same data as the serializers above,
+# a serializer instance costs more than the operation transformation itself.
+
+def serialize_user_with_access(user_files):
+    return {'user': serialize_user(user_files.user),
+            'access': int(user_files.access)}
+
+
+def serialize_file(file):
+    return {'id': str(file.id),
+            'name': str(file.name),
+            'programming_language': str(file.programming_language),
+            'content': str(file.content),
+            'link_access': int(file.link_access),
+            'last_revision': int(file.last_revision)}
+
+
+def serialize_operation(operation):
+    return {'type': int(operation.type),
+            'position': None if operation.position is None else int(operation.position),
+            'text': None if operation.text is None else str(operation.text),
+            'revision': int(operation.revision),
+            'channel_name': str(operation.channel_name)}
+
+
+def serialize_operations(operations):
+    return [serialize_operation(operation) for operation in operations]
@@ -1,6 +1,10 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
+import math
+import random
 
-from file_manager.operations import Insert, Delete, NeutralOperation
+from file_manager.operations import Insert, Delete, NeutralOperation, compose, compact
+from file_manager.document_buffer import Rope, StringBuffer, CHUNK_SIZE
+from file_manager.bulk_transform import OperationColumns, python_transform, numpy_transform, numpy
 
 
 class InsertInsertTestCase(TestCase):
@@ -258,6 +262,11 @@ class NeutralOperationTestCase(TestCase):
         current_text = (current_delete / prev_neu).execute(current_text)
         self.assertEqual(current_text, "Scofield")
 
+    def test_neu_is_singleton(self):
+        self.assertIs(NeutralOperation(), NeutralOperation())
+        self.assertIs(Delete(0, "Mi") / Delete(0, "Michael"), NeutralOperation())
+        self.assertFalse(hasattr(Insert(0, "oh, "), '__dict__'))
+
     def test_neu_after_neu(self):
         prev_neu = NeutralOperation()
         current_text = prev_neu.execute(self.text)
@@ -278,3 +287,169 @@ class NeutralOperationTestCase(TestCase):
         current_neu = NeutralOperation()
         current_text = (current_neu / prev_delete).execute(current_text)
         self.assertEqual(current_text, "Scofield")
+
+
+class ComposeTestCase(TestCase):
+    def setUp(self) -> None:
+        self.text = "Michael Scofield"
+
+    def assertComposed(self, operation, next_operation):
+        composed_operation = compose(operation, next_operation)
+        self.assertIsNotNone(composed_operation)
+        self.assertEqual(composed_operation.execute(self.text), next_operation.execute(operation.execute(self.text)))
+        return composed_operation
+
+    def test_typing(self):
+        operation = self.assertComposed(Insert(8, "J"), Insert(9, "."))
+        self.assertEqual(operation.info(), {'type': 1, 'position': 8, 'text': "J."})
+
+    def test_insert_inside_insert(self):
+        self.assertComposed(Insert(8, "J. "), Insert(9, "ohn"))
+
+    def test_backspace(self):
+        operation = self.assertComposed(Delete(7, " "), Delete(6, "l"))
+        self.assertEqual(operation.info(), {'type': 2, 'position': 6, 'text': "l "})
+
+    def test_delete_key(self):
+        self.assertComposed(Delete(0, "M"), Delete(0, "i"))
+
+    def test_delete_inserted_text(self):
+        self.assertComposed(Insert(8, "J. "), Delete(9, ". "))
+        self.assertIsInstance(self.assertComposed(Insert(8, "J. "), Delete(8, "J. ")), NeutralOperation)
+
+    def test_neu(self):
+        self.assertComposed(NeutralOperation(), Insert(0, "oh, "))
+        self.assertComposed(Delete(0, "Michael "), NeutralOperation())
+
+    def test_not_composed(self):
+        self.assertIsNone(compose(Insert(0, "J. "), Insert(8, "J. ")))
+        self.assertIsNone(compose(Delete(0, "Michael "), Delete(1, "cofield")))
+        self.assertIsNone(compose(Insert(8, "J. "), Delete(0, "Michael J")))
+        self.assertIsNone(compose(Delete(0, "Michael "), Insert(0, "Lincoln ")))
+
+    def test_compact(self):
+        operations = [Insert(16, " "), Insert(17, "i"), Insert(18, "s"), Delete(0, "Michael "), Delete(0, "S")]
+        compacted_operations = compact(operations)
+
+        self.assertEqual(len(compacted_operations), 2)
+        text = self.text
+        for operation in operations:
+            text = operation.execute(text)
+        for operation in compacted_operations:
+            self.text = operation.execute(self.text)
+        self.assertEqual(self.text, text)
+
+
+class BulkTransformTestCase(TestCase):
+    def setUp(self) -> None:
+        random.seed(1)
+        self.history = [self.random_operation() for _ in range(500)]
+        self.columns = OperationColumns()
+        for operation in self.history:
+            info = operation.info()
+            self.columns.add(info['type'], info.get('position'), info.get('text'))
+
+    @staticmethod
+    def random_operation():
+        position = random.randint(0, 300)
+        kind = random.random()
+        if kind < 0.45:
+            return Insert(position, "x" * random.randint(0, 5))
+        elif kind < 0.9:
+            return Delete(position, "x" * random.randint(0, 30))
+        return NeutralOperation()
+
+    def transform(self, operation):
+        for prev_operation in self.history:
+            operation /= prev_operation
+        return operation
+
+    def assertTransformed(self, bulk_transform):
+        for _ in range(300):
+            operation = self.random_operation()
+            self.assertEqual(bulk_transform(operation, self.columns).info(), self.transform(operation).info())
+
+    def test_python_transform(self):
+        self.assertTransformed(python_transform)
+
+    @skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_transform(self):
+        self.assertTransformed(numpy_transform)
+
+
+class DocumentBufferTestCase(TestCase):
+    def setUp(self) -> None:
+        self.text = "Michael Scofield"
+
+    def test_insert(self):
+        for buffer in (Rope(self.text), StringBuffer(self.text)):
+            buffer = Insert(8, "J. ").execute(buffer)
+            self.assertEqual(str(buffer), "Michael J. Scofield")
+
+    def test_delete(self):
+        for buffer in (Rope(self.text), StringBuffer(self.text)):
+            buffer = Delete(0, "Michael ").execute(buffer)
+            self.assertEqual(str(buffer), "Scofield")
+
+    def test_neu(self):
+        rope = NeutralOperation().execute(Rope(self.text))
+        self.assertEqual(str(rope), self.text)
+
+    def test_rope_random_operations(self):
+        text = "".join(random.choice("abc\n") for _ in range(5 * CHUNK_SIZE))
+        rope = Rope(text)
+
+        for _ in range(2000):
+            position = random.randint(0, len(text))
+            if random.random() < 0.6:
+                insert = Insert(position, "x" * random.randint(1, 2 * CHUNK_SIZE if random.random() < 0.05 else 3))
+                text = insert.execute(text)
+                rope = insert.execute(rope)
+            else:
+                delete = Delete(position, text[position:position + random.randint(1, 50)])
+                text = delete.execute(text)
+                rope = delete.execute(rope)
+            self.assertEqual(len(rope), len(text))
+
+        self.assertEqual(str(rope), text)
+
+    @staticmethod
+    def rope_depth(rope):
+        # -> (depth, number of chunks)
+        depth, chunks = 0, 0
+        stack = [(rope.root, 1)] if rope.root else []
+        while stack:
+            node, node_depth = stack.pop()
+            depth, chunks = max(depth, node_depth), chunks + 1
+            stack.extend((child, node_depth + 1) for child in (node.left, node.right) if child)
+        return depth, chunks
+
+    def test_rope_depth(self):
+        random.seed(0)
+        text = "".join(random.choice("abc\n") for _ in range(2 * CHUNK_SIZE))
+        rope = Rope(text)
+        # random edits and typing with backspaces
+        for _ in range(5000):
+            position = random.randint(0, len(text))
+            if random.random() < 0.5:
+                operation = Insert(position, "x" * random.randint(1, 5))
+            else:
+                operation = Delete(position, text[position:position + random.randint(1, 5)])
+            text = operation.execute(text)
+            rope = operation.execute(rope)
+
+        position = len(text) // 2
+        for _ in range(20000):
+            if random.random() < 0.8 or not position:
+                operation = Insert(position, "x")
+                position += 1
+            else:
+                operation = Delete(position - 1, text[position - 1])
+                position -= 1
+            text = operation.execute(text)
+            rope = operation.execute(rope)
+
+        self.assertEqual(str(rope), text)
+        depth, chunks = self.rope_depth(rope)
+        # O(log n) with the expected constant of a treap
+        self.assertLessEqual(depth, 4 * math.log2(chunks + 1) + 4)
@@ -1,11 +1,38 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from unittest.mock import patch
+import asyncio
+import json
+import sys
+import tempfile
+
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
 from file_manager.exceptions import (
-    FileDoesNotExistException, NoRequiredFileAccess
+    FileDoesNotExistException, NoRequiredFileAccess, RevisionConflictException, OperationsCompactedException,
+    RevisionTooOldException, DocumentWriteException, DocumentClosedException
 )
 from file_manager.file_manager_backend import FileManager
 from authentication.models import CustomUser
-from file_manager.models import UserFiles, File, Access
+from file_manager.models import UserFiles, File, Access, Operations
+from file_manager.document import Document, DocumentsManager
+from file_manager.persistence import DocumentPersister, check_durability
+from file_manager.compaction import compact_operations
+from file_manager.operations import Insert, Delete
+from file_manager.presence import MemoryPresence
+from file_manager.roster import MemoryRoster
+from file_manager.ownership import HashRing, MemoryWorkers
+from file_manager.channel_layers import HybridChannelLayer
+from file_manager.outbox import GroupOutbox
+from file_manager.run_file import RunFileTask
+from file_manager.launched_files import LaunchedFilesManager
+from file_manager.codec import JsonCodec, OrjsonCodec, load_codec, orjson
+from file_manager.serializers import (
+    UserWithAccessSerializer, FileSerializer, OperationSerializer, serialize_user_with_access, serialize_file,
+    serialize_operations
+)
 
 
 class CreateFileTestCase(TestCase):
@@ -99,3 +126,655 @@ class GenerateLinkTestCase(TestCase):
 
         decode_file = File.decode(encode_file)
         self.assertEqual(file, decode_file)
+
+
+class UsersWithAccessTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(username='Igor Mashtakov',
+                                                   email='masht@mail.ru',
+                                                   password='12345')
+        self.file = FileManager.create_file(name="file_1", programming_language="python", owner=self.user)
+        for index in range(3):
+            user = CustomUser.objects.create_user(username=f'user_{index}',
+                                                  email=f'{index}@mail.ru',
+                                                  password='12345')
+            UserFiles.objects.create(user=user, file=self.file, access=Access.EDITOR)
+
+    def tearDown(self) -> None:
+        File.objects.all().delete()
+
+    def test_serialize_in_one_query(self):
+        with self.assertNumQueries(1):
+            users = UserWithAccessSerializer(UserFiles.objects.with_users().filter(file=self.file), many=True).data
+
+        self.assertEqual({user['user']['username'] for user in users},
+                         {'Igor Mashtakov', 'user_0', 'user_1', 'user_2'})
+        self.assertEqual(set(users[0]['user']), {'id', 'username', 'email', 'account_color'})
+
+
+class SerializersTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(username='Igor Mashtakov',
+                                                   email='masht@mail.ru',
+                                                   password='12345')
+        self.file = FileManager.create_file(name="file_1", programming_language="python", owner=self.user)
+        File.objects.filter(pk=self.file.pk).update(content='print("ё")', last_revision=3)
+        self.file.refresh_from_db()
+
+    def tearDown(self) -> None:
+        File.objects.all().delete()
+
+    def test_same_json_as_serializers(self):
+        operations = [Operations.objects.create(file=self.file, type=Operations.Type.INSERT, position=0,
+                                                text='ё', revision=1, channel_name='channel_1'),
+                      Operations.objects.create(file=self.file, type=Operations.Type.NEU, revision=2,
+                                                channel_name='channel_1'),
+                      Operations(file=self.file, type=Operations.Type.DELETE, position=1, text='x', revision=3,
+                                 channel_name='channel_2')]
+        user_with_access = UserFiles.objects.with_users().get(file=self.file)
+
+        for data, serializer in [(serialize_file(self.file), FileSerializer(self.file)),
+                                 (serialize_user_with_access(user_with_access),
+                                  UserWithAccessSerializer(user_with_access)),
+                                 (serialize_operations(operations), OperationSerializer(operations, many=True))]:
+            self.assertEqual(json.dumps(data), json.dumps(serializer.data))
+
+
+@override_settings(DOCUMENT_DURABILITY='sync')
+class DocumentTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(username='Igor Mashtakov',
+                                                   email='masht@mail.ru',
+                                                   password='12345')
+        self.file = FileManager.create_file(name="file_1", programming_language="python", owner=self.user)
+        self.document = Document(self.file.pk, self.file.content, self.file.last_revision)
+
+    def tearDown(self) -> None:
+        File.objects.all().delete()
+
+    def test_closed_document(self):
+        document = DocumentsManager().open_document(self.file)
+        document.apply(Insert(0, "Michael"), 'channel')
+        DocumentsManager().close_document(self.file.pk)
+
+        # the operations of the connections which still have the document are rejected
+        with self.assertRaises(DocumentClosedException):
+            document.apply(Insert(0, "Scofield"), 'channel')
+        with self.assertRaises(DocumentClosedException):
+            with document.writing():
+                pass
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content, "Michael")
+        self.assertIsNot(DocumentsManager().open_document(self.file), document)
+        DocumentsManager().close_document(self.file.pk)
+
+    def test_apply(self):
+        self.document.apply(Insert(0, "Michael Scofield"), 'channel')
+        self.document.apply(Delete(0, "Michael "), 'channel')
+
+        self.assertEqual(self.document.content, "Scofield")
+        self.assertEqual(self.document.revision, 2)
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content, "Scofield")
+        self.assertEqual(self.file.last_revision, 2)
+        self.assertEqual(Operations.objects.filter(file=self.file).count(), 2)
+
+    def test_transform(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+        self.document.apply(Insert(0, "origami "), 'another_channel')
+
+        operation = self.document.transform(Insert(7, " Scofield"), 1)
+        self.document.apply(operation, 'channel')
+        self.assertEqual(self.document.content, "origami Michael Scofield")
+
+    def test_revision_conflict(self):
+        # another worker has written the revision
+        Operations.objects.create(type=Operations.Type.INSERT, position=0, text="Lincoln",
+                                  revision=1, file=self.file, channel_name='another_channel')
+        File.objects.filter(pk=self.file.pk).update(content="Lincoln", last_revision=1)
+
+        with self.assertRaises(RevisionConflictException):
+            self.document.apply(Insert(0, "Michael"), 'channel')
+
+        self.assertEqual(self.document.content, "Lincoln")
+        self.assertEqual(self.document.revision, 1)
+        self.assertEqual(Operations.objects.filter(file=self.file).count(), 1)
+
+    def test_write_error(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+
+        with patch.object(Operations.objects, 'bulk_create', side_effect=DatabaseError("connection lost")), \
+                self.assertRaises(DocumentWriteException):
+            self.document.apply(Insert(7, " Scofield"), 'channel')
+
+        # the operation which is not written is not kept either
+        self.assertEqual(self.document.content, "Michael")
+        self.assertEqual(self.document.revision, 1)
+        self.assertFalse(self.document.pending_operations)
+
+    def test_compact(self):
+        for index in range(5):
+            self.document.apply(Insert(0, str(index)), 'channel')
+
+        self.assertTrue(self.document.compact(2))
+        self.assertEqual(self.document.snapshot_revision, 3)
+        self.assertEqual([operation.revision for operation in self.document.operations_since(3)], [4, 5])
+        self.assertEqual(list(Operations.objects.filter(file=self.file).values_list('revision', flat=True)), [4, 5])
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.snapshot_revision, 3)
+        with self.assertRaises(OperationsCompactedException):
+            self.document.operations_since(2)
+
+    def test_compact_closed_file(self):
+        for index in range(5):
+            self.document.apply(Insert(0, str(index)), 'channel')
+
+        self.assertEqual(compact_operations(retention=1), 1)
+        self.assertEqual(Operations.objects.filter(file=self.file).count(), 1)
+        self.assertEqual(compact_operations(retention=1), 0)
+
+        # the document learns about the compaction from the database
+        del self.document.operations[:]
+        with self.assertRaises(OperationsCompactedException):
+            self.document.operations_since(2)
+
+    @override_settings(DOCUMENT_RESYNC_OPERATIONS=2)
+    def test_compact_composes_old_operations(self):
+        for index, letter in enumerate("hello"):
+            self.document.apply(Insert(index, letter), 'channel')
+        self.document.apply(Insert(0, "X"), 'another_channel')
+        self.document.apply(Insert(6, "!"), 'channel')
+        self.document.apply(Insert(7, "?"), 'channel')
+
+        # the operations up to the revision 6 are composed, the newer ones are kept for the clients
+        self.assertEqual(compact_operations(retention=100), 1)
+        self.assertEqual(list(Operations.objects.filter(file=self.file).order_by('revision')
+                              .values_list('revision', 'text')), [(5, "hello"), (6, "X"), (7, "!"), (8, "?")])
+        self.assertEqual(compact_operations(retention=100), 0)
+
+        self.assertEqual([row[3] for row in self.document.written_operations_since(5)], [6, 7, 8])
+        with self.assertRaises(RevisionTooOldException):
+            self.document.written_operations_since(3)
+
+    def test_transform_batch(self):
+        self.document.apply(Insert(0, "Michael Scofield"), 'channel')
+        self.document.apply(Insert(0, "oh, "), 'another_channel')
+
+        # "Michael Scofield" -> "Michael J. Scofield" -> "J. Scofield"
+        operations = self.document.transform_batch([Insert(8, "J. "), Delete(0, "Michael ")], 1)
+        operation_queries = self.document.apply_batch(operations, 'channel')
+
+        self.assertEqual(self.document.content, "oh, J. Scofield")
+        self.assertEqual([operation.revision for operation in operation_queries], [3, 4])
+        self.assertEqual(Operations.objects.filter(file=self.file).count(), 4)
+
+    def test_transform_by_bridge(self):
+        operation = self.document.transform(Insert(0, "abc"), 0, 'channel')
+        self.document.apply(operation, 'channel')
+        operation = self.document.transform(Insert(0, "XY"), 1, 'another_channel')
+        self.document.apply(operation, 'another_channel')
+
+        # the client has not received its first operation yet, its own operations are not transformed again
+        operation = self.document.transform(Insert(1, "d"), 0, 'channel')
+        self.document.apply(operation, 'channel')
+        self.assertEqual(self.document.content, "XYadbc")
+
+        self.document.remove_bridge('channel')
+        self.assertNotIn('channel', self.document.bridges)
+
+    def test_transform_by_rebuilt_bridge(self):
+        operation = self.document.transform(Insert(0, "abc"), 0, 'channel')
+        self.document.apply(operation, 'channel')
+        operation = self.document.transform(Insert(0, "XY"), 1, 'another_channel')
+        self.document.apply(operation, 'another_channel')
+
+        # the bridge is lost, the rebuilt one does not transform against the own operations either
+        self.document.remove_bridge('channel')
+        operation = self.document.transform(Insert(1, "d"), 0, 'channel')
+        self.document.apply(operation, 'channel')
+        self.assertEqual(self.document.content, "XYadbc")
+
+    def pipelined_operations(self, lose_bridge):
+        self.document.apply(Insert(0, "0123456789"), 'setup_channel')
+        operation = self.document.transform(Delete(8, "89"), 1, 'another_channel')
+        self.document.apply(operation, 'another_channel')
+        operation = self.document.transform(Insert(0, "A"), 1, 'channel')
+        self.document.apply(operation, 'channel')
+
+        lose_bridge()
+        # the next operation of the client is not based on its first one yet
+        operation = self.document.transform(Insert(10, "B"), 1, 'channel')
+        self.document.apply(operation, 'channel')
+
+    def test_transform_pipelined_operation_after_reload(self):
+        # the bridge catches up from the written operations
+        self.pipelined_operations(self.document.reload)
+        self.assertEqual(self.document.content, "A01234567B")
+
+    def test_transform_pipelined_operation_by_rebuilt_bridge(self):
+        # the operation of the other client is before the first operation of the client, the client takes the content
+        with self.assertRaises(RevisionTooOldException):
+            self.pipelined_operations(lambda: self.document.remove_bridge('channel'))
+        self.assertEqual(self.document.content, "A01234567")
+
+    def test_transform_by_new_bridge(self):
+        self.document.apply(Insert(0, "0123456789"), 'setup_channel')
+        operation = self.document.transform(Insert(2, "XY"), 1, 'another_channel')
+        self.document.apply(operation, 'another_channel')
+
+        # the history is transformed past the operation of the client only for its next operation
+        operation = self.document.transform(Insert(8, "a"), 1, 'channel')
+        self.document.apply(operation, 'channel')
+        self.assertIsNotNone(self.document.bridges['channel'].history)
+        operation = self.document.transform(Insert(0, "b"), 1, 'channel')
+        self.document.apply(operation, 'channel')
+        self.assertIsNone(self.document.bridges['channel'].history)
+        self.assertEqual(self.document.content, "b01XY234567a89")
+
+        # the client has the whole history, nothing is transformed
+        operation = self.document.transform(Delete(0, "b01XY"), 4, 'channel')
+        self.document.apply(operation, 'channel')
+        self.assertEqual(self.document.content, "234567a89")
+
+    @override_settings(DOCUMENT_RESYNC_OPERATIONS=2)
+    def test_resync_by_operations_number(self):
+        for index in range(3):
+            self.document.apply(Insert(0, str(index)), 'channel')
+
+        self.assertEqual(len(self.document.operations_since(1)), 2)
+        with self.assertRaises(RevisionTooOldException):
+            self.document.transform(Insert(0, "Michael"), 0)
+
+    @override_settings(DOCUMENT_RESYNC_BYTES=10)
+    def test_resync_by_bytes(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+        self.document.apply(Insert(7, " Scofield"), 'channel')
+
+        self.assertEqual(len(self.document.operations_since(1)), 1)
+        with self.assertRaises(RevisionTooOldException):
+            self.document.transform(Insert(0, "J. "), 0)
+
+    @override_settings(DOCUMENT_DURABILITY='write_behind')
+    def test_workers_without_single_writer(self):
+        # the documents of the same file in two workers
+        another_document = Document(self.file.pk, self.file.content, self.file.last_revision)
+        with self.document.writing():
+            self.document.apply(self.document.transform(Insert(0, "Michael"), 0, 'channel'), 'channel')
+        with another_document.writing():
+            operation = another_document.transform(Insert(0, "Lincoln "), 0, 'another_channel')
+            operation_query = another_document.apply(operation, 'another_channel')
+
+        # the operation of the other worker is loaded first, every operation is written at once
+        self.assertEqual(operation_query.revision, 2)
+        self.assertEqual(another_document.content, "Lincoln Michael")
+        self.assertEqual(self.document.state(), ("Lincoln Michael", 2))
+        self.assertEqual(list(Operations.objects.filter(file=self.file).values_list('revision', flat=True)), [1, 2])
+
+    def test_operations_since_older_than_log(self):
+        for index in range(3):
+            self.document.apply(Insert(0, str(index)), 'channel')
+        del self.document.operations[:2]
+
+        operations = self.document.operations_since(0)
+        self.assertEqual([operation.revision for operation in operations], [1, 2, 3])
+
+
+@override_settings(SINGLE_WORKER=True, DOCUMENT_DURABILITY='write_behind', DOCUMENT_FLUSH_INTERVAL=3600,
+                   DOCUMENT_FLUSH_OPERATIONS=3)
+class DocumentPersisterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(username='Igor Mashtakov',
+                                                   email='masht@mail.ru',
+                                                   password='12345')
+        self.file = FileManager.create_file(name="file_1", programming_language="python", owner=self.user)
+        self.document = DocumentsManager().open_document(self.file)
+        self.persister = DocumentPersister()
+
+        # flush only from the test thread
+        self.start_patcher = patch.object(DocumentPersister, 'start')
+        self.start_patcher.start()
+
+    def tearDown(self) -> None:
+        DocumentsManager().close_document(self.file.pk)
+        File.objects.all().delete()
+
+        self.start_patcher.stop()
+
+    def test_operations_are_not_written_at_once(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content, "")
+        self.assertFalse(Operations.objects.exists())
+        self.assertEqual(self.document.content, "Michael")
+
+    def test_flush(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+        self.document.apply(Insert(7, " Scofield"), 'channel')
+        flushes = self.persister.metrics.flushes
+
+        with self.assertLogs('file_manager_logger', 'INFO') as logs:
+            self.persister.flush(self.document)
+        self.assertIn("'flushed_operations'", logs.output[0])
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content, "Michael Scofield")
+        self.assertEqual(self.file.last_revision, 2)
+        self.assertEqual(list(Operations.objects.filter(file=self.file).values_list('revision', flat=True)), [2])
+        self.assertEqual(self.persister.metrics.flushes, flushes + 1)
+        self.assertEqual(self.document.persisted_revision, 2)
+
+        # nothing to write
+        self.persister.flush(self.document)
+        self.assertEqual(self.persister.metrics.flushes, flushes + 1)
+
+    def test_flush_composes_operations(self):
+        for position, char in enumerate("Michael"):
+            self.document.apply(Insert(position, char), 'channel')
+        self.document.apply(Insert(0, "oh, "), 'another_channel')
+        self.persister.flush(self.document)
+
+        operations = Operations.objects.filter(file=self.file).order_by('revision')
+        self.assertEqual([(operation.revision, operation.text) for operation in operations],
+                         [(7, "Michael"), (8, "oh, ")])
+
+        # the history older than the in-memory log is composed
+        del self.document.operations[:]
+        self.assertEqual([operation.revision for operation in self.document.operations_since(7)], [8])
+        self.assertEqual([operation.revision for operation in self.document.operations_since(0)], [7, 8])
+        with self.assertRaises(RevisionTooOldException):
+            self.document.operations_since(3)
+
+    def test_revision_conflict(self):
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f'file_{self.file.pk}', channel_name)
+
+        # broadcast to the room but not written
+        self.document.apply(Insert(0, "Michael"), 'channel')
+        # another worker has written the revision
+        Operations.objects.create(type=Operations.Type.INSERT, position=0, text="Lincoln",
+                                  revision=1, file=self.file, channel_name='another_channel')
+        File.objects.filter(pk=self.file.pk).update(content="Lincoln", last_revision=1)
+
+        self.persister.flush(self.document)
+
+        # the room takes the content of the database
+        message = async_to_sync(channel_layer.receive)(channel_name)
+        self.assertEqual(message['type'], 'send_text')
+        self.assertEqual(json.loads(message['text']), {'type': 'resync', 'content': "Lincoln", 'revision': 1})
+        self.assertEqual(self.document.content, "Lincoln")
+        async_to_sync(channel_layer.group_discard)(f'file_{self.file.pk}', channel_name)
+
+    def test_document_is_due_by_operations_number(self):
+        self.document.apply(Insert(0, "1"), 'channel')
+        self.document.apply(Insert(0, "2"), 'channel')
+        self.assertFalse(self.persister.is_due(self.document))
+
+        self.document.apply(Insert(0, "3"), 'channel')
+        self.assertTrue(self.persister.is_due(self.document))
+
+    def test_flush_on_close(self):
+        self.document.apply(Insert(0, "Michael"), 'channel')
+        DocumentsManager().close_document(self.file.pk)
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content, "Michael")
+        self.assertNotIn(self.file.pk, self.persister.dirty_documents)
+
+    def test_check_durability(self):
+        self.assertTrue(check_durability())
+
+        # write-behind without a single writer falls back to sync
+        with override_settings(SINGLE_WORKER=False, FILE_OWNERSHIP=False), \
+                self.assertLogs('file_manager_logger', 'WARNING') as logs:
+            self.assertFalse(check_durability())
+            self.assertEqual(self.persister.durability, 'sync')
+        self.assertIn("DOCUMENT_DURABILITY", logs.output[0])
+
+        with override_settings(SINGLE_WORKER=False, DOCUMENT_DURABILITY='sync'):
+            self.assertTrue(check_durability())
+
+
+class MemoryPresenceTestCase(TestCase):
+    def setUp(self) -> None:
+        self.presence = MemoryPresence()
+
+    def test_add_and_remove(self):
+        self.assertEqual(self.presence.add('file_1', 'channel_1', 1), 1)
+        self.assertEqual(self.presence.add('file_1', 'channel_2', 1), 2)
+        self.assertEqual(self.presence.add('file_1', 'channel_3', 2), 1)
+        self.assertEqual(self.presence.user_ids('file_1'), {1, 2})
+        self.assertEqual(self.presence.channels('file_1', 1), ['channel_1', 'channel_2'])
+
+        self.assertEqual(self.presence.remove('file_1', 'channel_1'), {1, 2})
+        self.assertEqual(self.presence.remove('file_1', 'channel_2'), {2})
+        self.assertEqual(self.presence.remove('file_1', 'channel_3'), set())
+        self.assertEqual(self.presence.user_ids('file_1'), set())
+
+    def test_expire(self):
+        self.presence.add('file_1', 'channel_1', 1)
+        self.presence.add('file_2', 'channel_2', 2)
+        self.presence.rooms['file_1']['channel_1'][1] -= 100
+
+        self.assertEqual(self.presence.expire(60), [('file_1', 'channel_1', 1)])
+        self.assertEqual(self.presence.user_ids('file_1'), set())
+        self.assertEqual(self.presence.user_ids('file_2'), {2})
+
+
+@override_settings(ROSTER_CHANGES_SIZE=2)
+class MemoryRosterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.roster = MemoryRoster()
+
+    def test_update(self):
+        self.assertIsNone(self.roster.update('file_1', {'user_id': 1, 'active': True}))
+
+        version, entries = self.roster.load('file_1', {1: {'id': 1}})
+        self.assertEqual(entries, {1: {'id': 1}})
+        self.assertEqual(self.roster.update('file_1', {'user_id': 2, 'entry': {'id': 2}}), version + 1)
+        self.assertEqual(self.roster.update('file_1', {'user_id': 1, 'entry': None}), version + 2)
+        self.assertEqual(self.roster.get('file_1'), (version + 2, {2: {'id': 2}}))
+
+    def test_changes(self):
+        version, _ = self.roster.load('file_1', {})
+        self.assertEqual(self.roster.changes('file_1', version), (version, []))
+
+        for user_id in range(3):
+            self.roster.update('file_1', {'user_id': user_id, 'active': True})
+
+        self.assertEqual(self.roster.changes('file_1', version + 1),
+                         (version + 3, [{'version': version + 2, 'user_id': 1, 'active': True},
+                                        {'version': version + 3, 'user_id': 2, 'active': True}]))
+        # the first change is not kept
+        self.assertIsNone(self.roster.changes('file_1', version))
+        self.assertIsNone(self.roster.changes('file_2', version))
+
+    def test_delete(self):
+        version, _ = self.roster.load('file_1', {})
+        left_version = self.roster.update('file_1', {'user_id': 1, 'active': False})
+        # a user joins the room after the last one has left
+        self.roster.update('file_1', {'user_id': 2, 'active': True})
+
+        self.assertFalse(self.roster.delete('file_1', left_version))
+        self.assertEqual(self.roster.get('file_1')[0], left_version + 1)
+        self.assertTrue(self.roster.delete('file_1', left_version + 1))
+        self.assertIsNone(self.roster.get('file_1'))
+        self.assertFalse(self.roster.delete('file_1', version))
+
+
+class CodecTestCase(TestCase):
+    content = {'type': 'apply_operation', 'operation': {'type': 1, 'position': 0, 'text': 'ё\n'}, 'revision': 1}
+
+    def test_json_codec(self):
+        self.assertEqual(JsonCodec.loads(JsonCodec.dumps(self.content)), self.content)
+
+    def test_orjson_codec(self):
+        if orjson is None:
+            self.skipTest("orjson is not installed")
+
+        codec = OrjsonCodec()
+        self.assertEqual(codec.loads(codec.dumps(self.content)), self.content)
+        # the text of both codecs is the same json
+        self.assertEqual(json.loads(codec.dumps(self.content)), json.loads(JsonCodec.dumps(self.content)))
+        self.assertIsInstance(load_codec(None), OrjsonCodec)
+
+
+class HashRingTestCase(TestCase):
+    def test_owner(self):
+        self.assertIsNone(HashRing([]).owner('file'))
+
+        ring = HashRing(['worker_1', 'worker_2', 'worker_3'])
+        owners = {file_id: ring.owner(file_id) for file_id in range(1000)}
+        self.assertEqual(set(owners.values()), {'worker_1', 'worker_2', 'worker_3'})
+        # the same owners in every process
+        self.assertEqual(owners, {file_id: HashRing(['worker_3', 'worker_2', 'worker_1']).owner(file_id)
+                                  for file_id in range(1000)})
+
+    def test_new_worker(self):
+        ring = HashRing(['worker_1', 'worker_2', 'worker_3'])
+        new_ring = HashRing(['worker_1', 'worker_2', 'worker_3', 'worker_4'])
+
+        # only the files of the new worker move
+        moved_files = [file_id for file_id in range(1000) if ring.owner(file_id) != new_ring.owner(file_id)]
+        self.assertTrue(all(new_ring.owner(file_id) == 'worker_4' for file_id in moved_files))
+        self.assertLess(len(moved_files), 400)
+
+
+class MemoryWorkersTestCase(TestCase):
+    def test_ring(self):
+        workers = MemoryWorkers()
+        workers.add('worker_1', 'channel_1')
+        workers.add('worker_2', 'channel_2')
+        self.assertEqual(workers.ring(60), (2, {'worker_1': 'channel_1', 'worker_2': 'channel_2'}))
+
+        # a heartbeat does not change the ring
+        workers.add('worker_1', 'channel_1')
+        workers.workers['worker_2'][1] -= 100
+        self.assertEqual(workers.ring(60), (3, {'worker_1': 'channel_1'}))
+
+        workers.remove('worker_1')
+        self.assertEqual(workers.ring(60), (4, {}))
+
+
+class HybridChannelLayerTestCase(TestCase):
+    def setUp(self) -> None:
+        self.channel_layer = HybridChannelLayer(hosts=[('127.0.0.1', 6379)])
+        self.local_channel = async_to_sync(self.channel_layer.new_channel)()
+        self.remote_channel = 'specific.remote!1'
+
+    def test_is_local(self):
+        self.assertTrue(self.channel_layer.is_local(self.local_channel))
+        self.assertFalse(self.channel_layer.is_local(self.remote_channel))
+        self.assertFalse(self.channel_layer.is_local('file_owner'))
+
+    def test_only_remote_members_through_redis(self):
+        self.channel_layer.local_channels[self.local_channel] += 1
+
+        connection_to_channel_keys, channel_key_to_message, _ = self.channel_layer._map_channel_keys_to_connection(
+            [self.local_channel, self.remote_channel], {'type': 'send_text', 'text': '{}'})
+        self.assertEqual(list(channel_key_to_message), [self.channel_layer.prefix + 'specific.remote!'])
+
+    def test_group_send(self):
+        async def group_send():
+            try:
+                await self.channel_layer.group_add('file_1', self.local_channel)
+            except OSError:
+                self.skipTest("Redis is not running")
+
+            await self.channel_layer.group_send('file_1', {'type': 'send_text', 'text': '{}'})
+            message = await self.channel_layer.receive(self.local_channel)
+            await self.channel_layer.group_discard('file_1', self.local_channel)
+            await self.channel_layer.flush()
+            return message
+
+        self.assertEqual(async_to_sync(group_send)(), {'type': 'send_text', 'text': '{}'})
+        self.assertEqual(self.channel_layer.local_groups, {})
+
+
+class SlowChannelLayer:
+    def __init__(self):
+        self.batches = []
+        self.sends = 0
+        self.max_sends = 0
+
+    async def group_send(self, room, message):
+        self.sends += 1
+        self.max_sends = max(self.max_sends, self.sends)
+        await asyncio.sleep(0.05)
+        self.batches.append([message['text'] for message in message['messages']])
+        self.sends -= 1
+
+
+@override_settings(GROUP_BATCH_INTERVAL=10)
+class GroupOutboxTestCase(TestCase):
+    def test_flush_later(self):
+        channel_layer = SlowChannelLayer()
+        outbox = GroupOutbox()
+
+        async def send_messages():
+            await outbox.send(channel_layer, 'file_1', {'text': '1'})
+            # the first batch is being sent
+            await asyncio.sleep(0.03)
+            await outbox.send(channel_layer, 'file_1', {'text': '2'})
+            await outbox.send(channel_layer, 'file_1', {'text': '3'})
+            while outbox.tasks:
+                await asyncio.gather(*outbox.tasks)
+
+        async_to_sync(send_messages)()
+        self.assertEqual(channel_layer.batches, [['1'], ['2', '3']])
+        self.assertEqual(channel_layer.max_sends, 1)
+        self.assertEqual(outbox.messages, {})
+
+
+class RunFileConsumer:
+    # the consumer as RunFileTask sees it
+    def __init__(self, file_id):
+        self.file = SimpleNamespace(pk=file_id)
+        self.launched_file_manager = LaunchedFilesManager()
+        self.outputs = []
+        self.messages = []
+
+    async def file_output(self, file_output):
+        self.outputs.append(file_output)
+
+    async def send_to_group(self, message):
+        self.messages.append(message)
+
+
+class RunFileTaskTestCase(TestCase):
+    def run_task(self, content, before_start):
+        """
+        Run a file by the python of the tests, `before_start(task)` is called after the task is registered.
+        """
+        consumer = RunFileConsumer('1278')
+        with tempfile.TemporaryDirectory() as file_path, \
+                patch('file_manager.run_file.FILE_PATH', f'{file_path}/'), \
+                patch('file_manager.run_file.get_command',
+                      lambda filename, programming_language: [sys.executable, '-u', filename]):
+            task = RunFileTask(consumer.file.pk, content, 'python', consumer)
+            consumer.launched_file_manager.add_running_file(consumer.file.pk, task)
+            before_start(task)
+
+            async def run():
+                await task.start()
+                await task.task
+
+            async_to_sync(run)()
+        self.assertFalse(consumer.launched_file_manager.file_is_running(consumer.file.pk))
+        return consumer
+
+    def test_input_before_start(self):
+        consumer = self.run_task("print('Hello,', input())\n", lambda task: task.add_input('Igor'))
+
+        self.assertEqual(''.join(consumer.outputs), 'Hello, Igor\n')
+        self.assertEqual(consumer.messages, [{'type': 'END run_file', 'exit_code': 0}])
+
+    def test_close_before_start(self):
+        consumer = self.run_task("print('Hello,', input())\n", lambda task: task.close())
+
+        # the process is killed as soon as it is created
+        self.assertEqual(consumer.outputs, [])
+        self.assertNotEqual(consumer.messages[0]['exit_code'], 0)
@@ -1,6 +1,6 @@
 import json
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APIClient
 
@@ -183,6 +183,8 @@ class GenerateLinkTestCase(TestCase):
         self.assertEqual(file.pk, self.user.files.get().pk)
 
 
+@override_settings(PRESENCE_BACKEND='file_manager.presence.MemoryPresence',
+                   ROSTER_BACKEND='file_manager.roster.MemoryRoster')
 class LeaveFileTestCase(TestCase):
     def setUp(self) -> None:
         self.client = APIClient()
@@ -1,15 +1,32 @@
 from unittest.mock import patch
+from itertools import count
+import asyncio
 import json
+import os
+import sys
+import tempfile
+import threading
+import time
 
 from channels.testing import WebsocketCommunicator
-from django.test import TransactionTestCase
-from channels_presence.models import Presence
+from django.test import TransactionTestCase, override_settings
 from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.layers import get_channel_layer
 
 from CodeDocs_backend.asgi import application
 from authentication.models import CustomUser
 from file_manager.models import File, UserFiles, Access, Operations
 from file_manager.file_manager_backend import FileManager
+from file_manager.compaction import compact_operations
+from file_manager.document import DocumentsManager
+from file_manager.routing import get_websocket_urlpatterns
+from file_manager.async_consumers import AsyncFileEditorConsumer
+from file_manager.presence import get_presence, load_presence
+from file_manager.roster import get_roster, get_room_roster, load_roster, update_roster
+from file_manager.editor import prune_presences
+from file_manager.ownership import FileOwnership, HashRing, get_ownership, load_workers
+from file_manager.run_file import OUTPUT_TRUNCATED
 from authentication.serializers import UserSerializer
 from file_manager.serializers import (
     FileSerializer, UserWithAccessSerializer, OperationSerializer
@@ -29,7 +46,10 @@ class MockJWTTokenUserAuthentication:
             print(e)
 
 
+@override_settings(DOCUMENT_DURABILITY='sync', PRESENCE_BACKEND='file_manager.presence.MemoryPresence',
+                   ROSTER_BACKEND='file_manager.roster.MemoryRoster')
 class FileEditorConsumerTestCase(TransactionTestCase):
+    websocket_application = application.application_mapping["websocket"]
 
     def setUp(self) -> None:
         self.user = CustomUser.objects.create_user(username='Igor Mashtakov',
@@ -52,9 +72,16 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
         self.token_patcher.stop()
         self.user_patcher.stop()
+        load_presence.cache_clear()
+        load_roster.cache_clear()
+        get_ownership.cache_clear()
+        load_workers.cache_clear()
+
+    def get_channel_names(self, user_id=None):
+        return get_presence().channels(f"file_{self.file.pk}", user_id)
 
     async def test_connection__file_does_not_exist(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              "/files/yuyu/1278/")
         await communicator.connect()
 
@@ -72,7 +99,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         await sync_to_async(delete_user_file_relation)()
 
         # user without access to file
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -81,7 +108,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertEqual(channel_name_answer['type'], 'websocket.send')
 
         channel_name_json = json.loads(channel_name_answer['text'])
-        channel_name = (await sync_to_async(Presence.objects.get)(user=self.user)).channel_name
+        channel_name, = self.get_channel_names(self.user.pk)
         right_channel_name_json = {'type': "channel_name",
                                    'channel_name': channel_name}
         self.assertDictEqual(channel_name_json, right_channel_name_json)
@@ -105,14 +132,14 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(answer, right_answer)
 
     async def test_connection__one_connection(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
         # channel_name
         channel_name_answer = await communicator.output_queue.get()
         channel_name_json = json.loads(channel_name_answer['text'])
-        channel_name = (await sync_to_async(Presence.objects.get)(user=self.user)).channel_name
+        channel_name, = self.get_channel_names(self.user.pk)
         right_channel_name_json = {'type': "channel_name",
                                    'channel_name': channel_name}
         self.assertDictEqual(channel_name_json, right_channel_name_json)
@@ -136,14 +163,14 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_connection__two_connections_from_one_user(self):
         # the first connection
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
         # channel_name
         channel_name_answer = await communicator.output_queue.get()
         channel_name_json = json.loads(channel_name_answer['text'])
-        channel_name = (await sync_to_async(Presence.objects.get)(user=self.user)).channel_name
+        channel_name, = self.get_channel_names(self.user.pk)
         right_channel_name_json = {'type': "channel_name",
                                    'channel_name': channel_name}
         self.assertDictEqual(channel_name_json, right_channel_name_json)
@@ -166,7 +193,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(answer, right_answer)
 
         # the second connection
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -174,9 +201,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         another_channel_name_answer = await another_communicator.output_queue.get()
         another_channel_name_json = json.loads(another_channel_name_answer['text'])
 
-        def get_last_presence():
-            return Presence.objects.filter(user=self.user).last().channel_name
-        another_channel_name = await sync_to_async(get_last_presence)()
+        another_channel_name = self.get_channel_names(self.user.pk)[-1]
         right_another_channel_name_json = {'type': "channel_name",
                                            'channel_name': another_channel_name}
         self.assertDictEqual(another_channel_name_json, right_another_channel_name_json)
@@ -190,10 +215,10 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
         # no new user answer
         self.assertTrue(await another_communicator.receive_nothing(1))
-        self.assertEqual(2, await sync_to_async(Presence.objects.count)())  # number of connections
+        self.assertEqual(2, len(self.get_channel_names()))  # number of connections
 
     async def test_file_info(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -211,7 +236,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(file_answer, right_file_answer)
 
     async def test_active_users__one_user(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -234,7 +259,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_active_users__users(self):
         # the first user connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -249,7 +274,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         for user_data in users_data:
             _ = await sync_to_async(CustomUser.objects.create_user)(**user_data)
 
-            another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+            another_communicator = WebsocketCommunicator(self.websocket_application,
                                                          f"/files/{self.file.pk}/1278/")
             await another_communicator.connect()
             _ = await communicator.output_queue.get()  # new user
@@ -267,9 +292,115 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
         await sync_to_async(check_active_users)()
 
+    async def test_roster(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        await communicator.send_json_to({'type': 'roster'})
+        roster_answer = json.loads((await communicator.output_queue.get())['text'])
+
+        def access_to_file():
+            user_with_access = UserFiles.objects.get(user=self.user, file=self.file)
+            return UserWithAccessSerializer(user_with_access).data
+
+        version = roster_answer['version']
+        self.assertDictEqual(roster_answer, {'type': 'roster',
+                                             'version': version,
+                                             'users': [{**await sync_to_async(access_to_file)(), 'active': True}]})
+
+        # the changes since the version of the client
+        await sync_to_async(update_roster)(f"file_{self.file.pk}", self.user.pk, active=False)
+        await communicator.send_json_to({'type': 'roster', 'version': version})
+        roster_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertDictEqual(roster_answer, {'type': 'roster',
+                                             'version': version + 1,
+                                             'changes': [{'version': version + 1,
+                                                          'user_id': self.user.pk,
+                                                          'active': False}]})
+
+    async def test_heartbeat(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        # the client has been idle for a long time, but sends heartbeats
+        room = f"file_{self.file.pk}"
+        channel_name, = self.get_channel_names(self.user.pk)
+        get_presence().rooms[room][channel_name][1] -= 100
+        await communicator.send_json_to({'type': 'heartbeat'})
+        await communicator.send_json_to({'type': 'active_users'})
+        _ = await communicator.output_queue.get()  # active_users
+
+        self.assertEqual(await sync_to_async(prune_presences)(60), 0)
+        self.assertEqual(self.get_channel_names(self.user.pk), [channel_name])
+
+        await communicator.disconnect()
+
+    async def test_prune_presences(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 0,
+                                         'operation': {'type': Operations.Type.INSERT,
+                                                       'position': 0,
+                                                       'text': "Michael"}})
+        _ = await communicator.output_queue.get()  # apply_operation
+
+        # another user connects
+        await sync_to_async(CustomUser.objects.create_user)(username='Shon', email='d@merfi.com', password='surgeon')
+        another_communicator = WebsocketCommunicator(self.websocket_application,
+                                                     f"/files/{self.file.pk}/1278/")
+        await another_communicator.connect()
+        _ = await another_communicator.output_queue.get()  # channel_name
+        _ = await another_communicator.output_queue.get()  # file_status
+        _ = await another_communicator.output_queue.get()  # new_user
+        _ = await communicator.output_queue.get()  # new_user
+
+        room = f"file_{self.file.pk}"
+        channel_name, = self.get_channel_names(self.user.pk)
+        version, _ = await sync_to_async(get_room_roster)(room, self.file.pk)
+
+        # the first connection has not sent messages for a long time
+        get_presence().rooms[room][channel_name][1] -= 100
+        self.assertEqual(await sync_to_async(prune_presences)(60), 1)
+
+        delete_user_answer = json.loads((await another_communicator.output_queue.get())['text'])
+        self.assertDictEqual(delete_user_answer, {'type': 'delete_user',
+                                                  'user': UserSerializer(self.user).data})
+        self.assertEqual(await sync_to_async(get_roster().changes)(room, version),
+                         (version + 1, [{'version': version + 1, 'user_id': self.user.pk, 'active': False}]))
+
+        # the last connection closes the room
+        for presence in get_presence().rooms[room].values():
+            presence[1] -= 100
+        self.assertEqual(await sync_to_async(prune_presences)(60), 1)
+
+        self.assertIsNone(DocumentsManager().get_document(self.file.pk))
+        self.assertIsNone(await sync_to_async(get_roster().get)(room))
+        self.assertFalse(await sync_to_async(Operations.objects.filter(file=self.file).exists)())
+        self.assertEqual((await sync_to_async(File.objects.get)(pk=self.file.pk)).last_revision, 0)
+
+        await communicator.disconnect()
+        await another_communicator.disconnect()
+
     async def test_active_users__two_connections_from_one_user(self):
         # the first connection
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -278,7 +409,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await communicator.output_queue.get()  # new_user
 
         # the second connection
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -299,10 +430,10 @@ class FileEditorConsumerTestCase(TransactionTestCase):
                               'users': await sync_to_async(access_to_file)()}
         self.assertDictEqual(users_answer, right_users_answer)
 
-        self.assertEqual(2, await sync_to_async(Presence.objects.count)())  # number of connections
+        self.assertEqual(2, len(self.get_channel_names()))  # number of connections
 
     async def test_all_users__one_user(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -325,7 +456,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_all_users__two_connections_from_one_user(self):
         # the first connection
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -334,7 +465,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await communicator.output_queue.get()  # new_user
 
         # the second connection
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -355,11 +486,11 @@ class FileEditorConsumerTestCase(TransactionTestCase):
                               'users': await sync_to_async(access_to_file)()}
         self.assertDictEqual(users_answer, right_users_answer)
 
-        self.assertEqual(2, await sync_to_async(Presence.objects.count)())  # number of connections
+        self.assertEqual(2, len(self.get_channel_names()))  # number of connections
 
     async def test_all_users__several_users(self):
         # the first user connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -387,7 +518,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(users_answer, right_users_answer)
 
     async def test_change_file_config__change_filename(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -409,7 +540,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(file_answer, right_file_answer)
 
     async def test_change_file_config__change_filename_and_pl(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -432,7 +563,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(file_answer, right_file_answer)
 
     async def test_change_file_config__change_to_the_same_config(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -452,7 +583,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(file_answer, right_file_answer)
 
     async def test_change_file_config__change_nothing(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -470,7 +601,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         self.assertDictEqual(file_answer, right_file_answer)
 
     async def test_change_link_access(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -493,7 +624,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_change_user_access__cannot_change_user_access(self):
         # the first user connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -505,7 +636,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                 email='1@mail.ru',
                                                                 password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -534,7 +665,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         await sync_to_async(change_access)()
 
         # the first user connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -546,7 +677,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                 email='1@mail.ru',
                                                                 password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -568,7 +699,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_change_user_access__oks(self):
         # the first user connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -580,7 +711,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         another_user = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                            email='1@mail.ru',
                                                                            password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -602,8 +733,51 @@ class FileEditorConsumerTestCase(TransactionTestCase):
                                       'user': await sync_to_async(another_user_with_access)()}
         self.assertDictEqual(change_access_answer, right_change_access_answer)
 
+    async def test_change_user_access__refreshes_access(self):
+        # the first user connect
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        # the second user connect as a viewer
+        another_user = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
+                                                                           email='1@mail.ru',
+                                                                           password='15')
+        another_communicator = WebsocketCommunicator(self.websocket_application,
+                                                     f"/files/{self.file.pk}/1278/")
+        await another_communicator.connect()
+
+        _ = await another_communicator.output_queue.get()  # channel_name
+        _ = await another_communicator.output_queue.get()  # file_status
+        _ = await another_communicator.output_queue.get()  # new_user
+        _ = await communicator.output_queue.get()  # new_user
+
+        operation = {'type': 'apply_operation',
+                     'revision': 0,
+                     'operation': {'type': Operations.Type.INSERT,
+                                   'position': 0,
+                                   'text': "Hello!"}}
+        await another_communicator.send_json_to(operation)
+        self.assertTrue(await communicator.receive_nothing(1))
+
+        await communicator.send_json_to({'type': 'change_user_access',
+                                         'new_access': Access.EDITOR,
+                                         'another_user_id': another_user.pk})
+        _ = await communicator.output_queue.get()  # change_user_access
+        _ = await another_communicator.output_queue.get()  # change_user_access
+
+        # the cached access of the second connection is refreshed
+        await another_communicator.send_json_to(operation)
+        apply_operation_answer = await communicator.output_queue.get()
+        self.assertDictEqual(apply_operation_answer, await another_communicator.output_queue.get())
+        self.assertEqual(json.loads(apply_operation_answer['text'])['operation']['revision'], 1)
+
     async def test_apply_operation__one_operation(self):
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -639,7 +813,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_apply_operation__several_operations(self):
         # the first connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -654,7 +828,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                 email='1@mail.ru',
                                                                 password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -708,7 +882,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
     async def test_apply_operation__owner_and_viewer(self):
         # the first connect
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -720,7 +894,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                 email='1@mail.ru',
                                                                 password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -773,9 +947,97 @@ class FileEditorConsumerTestCase(TransactionTestCase):
 
         await sync_to_async(check_result)()
 
+    async def test_apply_operations(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        operations = [{'type': Operations.Type.INSERT,
+                       'position': 0,
+                       'text': "Hello!"},
+                      {'type': Operations.Type.INSERT,
+                       'position': 5,
+                       'text': " World"},
+                      {'type': Operations.Type.DELETE,
+                       'position': 0,
+                       'text': "He"}]
+        await communicator.send_json_to({'type': 'apply_operations',
+                                         'revision': 0,
+                                         'operations': operations})
+
+        apply_operations_answer = json.loads((await communicator.output_queue.get())['text'])
+
+        def check_operations():
+            # the operations are composed into one
+            self.file.refresh_from_db()
+            self.assertEqual(self.file.last_revision, 1)
+            self.assertEqual(self.file.content, "llo World!")
+
+            db_operations = Operations.objects.filter(file=self.file).order_by('revision')
+            right_answer = {'type': 'apply_operations',
+                            'first_revision': 1,
+                            'last_revision': 1,
+                            'operations': OperationSerializer(db_operations, many=True).data}
+            self.assertDictEqual(apply_operations_answer, right_answer)
+
+        await sync_to_async(check_operations)()
+
+    async def test_apply_operation__resync_after_compaction(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        for revision, (position, text) in enumerate(((0, "Michael"), (7, " J."), (10, " Scofield"))):
+            await communicator.send_json_to({'type': 'apply_operation',
+                                             'revision': revision,
+                                             'operation': {'type': Operations.Type.INSERT,
+                                                           'position': position,
+                                                           'text': text}})
+            _ = await communicator.output_queue.get()  # apply_operation
+
+        await sync_to_async(compact_operations)(retention=1)
+
+        # the client does not know about the revisions 1 and 2
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 0,
+                                         'operation': {'type': Operations.Type.INSERT,
+                                                       'position': 0,
+                                                       'text': "oh, "}})
+        resync_answer = json.loads((await communicator.output_queue.get())['text'])
+        right_resync_answer = {'type': 'resync',
+                               'content': "Michael J. Scofield",
+                               'revision': 3}
+        self.assertDictEqual(resync_answer, right_resync_answer)
+
+        await communicator.send_json_to({'type': 'operation_history',
+                                         'revision': 1})
+        resync_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertDictEqual(resync_answer, right_resync_answer)
+
+        # the client rebases its operation on the content
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 3,
+                                         'operation': {'type': Operations.Type.INSERT,
+                                                       'position': 0,
+                                                       'text': "oh, "}})
+        operation_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertEqual(operation_answer['operation']['revision'], 4)
+
+        await communicator.send_json_to({'type': 'file_info'})
+        file_info_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertEqual(file_info_answer['file']['content'], "oh, Michael J. Scofield")
+
     async def test_change_cursor_position(self):
         # the first connection
-        communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        communicator = WebsocketCommunicator(self.websocket_application,
                                              f"/files/{self.file.pk}/1278/")
         await communicator.connect()
 
@@ -787,7 +1049,7 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
                                                                 email='1@mail.ru',
                                                                 password='15')
-        another_communicator = WebsocketCommunicator(application.application_mapping["websocket"],
+        another_communicator = WebsocketCommunicator(self.websocket_application,
                                                      f"/files/{self.file.pk}/1278/")
         await another_communicator.connect()
 
@@ -805,3 +1067,363 @@ class FileEditorConsumerTestCase(TransactionTestCase):
         right_cursor_answer = {**dispatch,
                                'user_id': self.user.pk}
         self.assertDictEqual(change_cursor_answer, right_cursor_answer)
+
+    @override_settings(OPERATION_ACK=True)
+    async def test_apply_operation__ack(self):
+        # the first connection
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        channel_name = json.loads((await communicator.output_queue.get())['text'])['channel_name']
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        # the second connection
+        another_communicator = WebsocketCommunicator(self.websocket_application,
+                                                     f"/files/{self.file.pk}/1278/")
+        await another_communicator.connect()
+
+        _ = await another_communicator.output_queue.get()  # channel_name
+        _ = await another_communicator.output_queue.get()  # file_status
+
+        operation = {'type': Operations.Type.INSERT,
+                     'position': 0,
+                     'text': "Hello!"}
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 0,
+                                         'operation': operation})
+
+        # the connection which sent the operation gets only its revision
+        ack_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertDictEqual(ack_answer, {'type': 'ack', 'revision': 1})
+
+        apply_operation_answer = json.loads((await another_communicator.output_queue.get())['text'])
+        self.assertDictEqual(apply_operation_answer,
+                             {'type': 'apply_operation',
+                              'operation': {**operation, 'revision': 1, 'channel_name': channel_name}})
+
+    @override_settings(GROUP_BATCH_INTERVAL=200)
+    async def test_apply_operation__batch(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        for revision, text in enumerate(["Hello", " World"]):
+            await communicator.send_json_to({'type': 'apply_operation',
+                                             'revision': revision,
+                                             'operation': {'type': Operations.Type.INSERT,
+                                                           'position': revision * 5,
+                                                           'text': text}})
+
+        # the operations come in one message in their order
+        batch_answer = json.loads((await communicator.output_queue.get())['text'])
+
+        def right_batch_answer():
+            operations = Operations.objects.filter(file=self.file).order_by('revision')
+            return {'type': 'batch',
+                    'messages': [{'type': 'apply_operation', 'operation': operation}
+                                 for operation in OperationSerializer(operations, many=True).data]}
+
+        self.assertDictEqual(batch_answer, await sync_to_async(right_batch_answer)())
+        self.assertTrue(await communicator.receive_nothing(0.3))
+
+    @override_settings(FILE_OWNERSHIP=True, WORKERS_BACKEND='file_manager.ownership.MemoryWorkers')
+    async def test_apply_operation__forwarded_to_owner(self):
+        # another worker of the same channel layer owns the file
+        worker_id = get_ownership().worker_id
+        owner = next(FileOwnership(f'owner_{index}') for index in count()
+                     if HashRing([worker_id, f'owner_{index}']).owner(self.file.pk) == f'owner_{index}')
+        await owner.start(get_channel_layer())
+
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        channel_name = json.loads((await communicator.output_queue.get())['text'])['channel_name']
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        operation = {'type': Operations.Type.INSERT,
+                     'position': 0,
+                     'text': "Hello!"}
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 0,
+                                         'operation': operation})
+
+        # the owner broadcasts the operation
+        apply_operation_answer = json.loads((await communicator.output_queue.get())['text'])
+        self.assertDictEqual(apply_operation_answer,
+                             {'type': 'apply_operation',
+                              'operation': {**operation, 'revision': 1, 'channel_name': channel_name}})
+        self.assertEqual(list(owner.connections), [channel_name])
+
+        # and answers to the connection, the opened document is not read from the database again
+        with patch.object(File, 'refresh_from_db', autospec=True, side_effect=File.refresh_from_db) as refresh_from_db:
+            await communicator.send_json_to({'type': 'operation_history',
+                                             'revision': 1})
+            operation_history_answer = json.loads((await communicator.output_queue.get())['text'])
+        refresh_from_db.assert_not_called()
+        self.assertDictEqual(operation_history_answer, {'type': 'operation_history',
+                                                        'operations': []})
+
+        # the owner has acked the forwarded messages
+        for _ in range(50):
+            if not get_ownership().pending:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(get_ownership().pending, {})
+
+        # the owner closes the room
+        await communicator.disconnect()
+        for _ in range(50):
+            if not owner.connections:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(owner.connections, {})
+
+        await owner.stop()
+        await get_ownership().stop()
+
+    @override_settings(FILE_OWNERSHIP=True, WORKERS_BACKEND='file_manager.ownership.MemoryWorkers')
+    async def test_forward__another_ring(self):
+        channel_layer = get_channel_layer()
+        worker = FileOwnership('worker')
+        owner = next(FileOwnership(f'owner_{index}') for index in count()
+                     if HashRing(['worker', f'owner_{index}']).owner(self.file.pk) == f'owner_{index}')
+        await worker.start(channel_layer)
+        await owner.start(channel_layer)
+
+        # the message of a worker with another ring comes to a worker which does not own the file
+        connection_channel = await channel_layer.new_channel()
+        reply_channel = await channel_layer.new_channel()
+        await channel_layer.send(worker.channel_name, {'type': 'forward',
+                                                       'id': 'message_1',
+                                                       'channel_name': connection_channel,
+                                                       'reply_channel': reply_channel,
+                                                       'user_id': self.user.pk,
+                                                       'access': Access.OWNER,
+                                                       'content': {'type': 'file_info'},
+                                                       'file_id': self.file.pk,
+                                                       'ring_version': None})
+
+        # the worker forwards it to the owner, which answers and acks it
+        file_info_answer = await asyncio.wait_for(channel_layer.receive(connection_channel), 2)
+        self.assertEqual(json.loads(file_info_answer['text'])['type'], 'file_info')
+        self.assertEqual(await asyncio.wait_for(channel_layer.receive(reply_channel), 2),
+                         {'type': 'forward_ack', 'id': 'message_1'})
+        self.assertEqual(list(owner.connections), [connection_channel])
+        self.assertEqual(worker.connections, {})
+        self.assertEqual(worker.version, owner.version)
+
+        await owner.stop()
+        await worker.stop()
+
+    @override_settings(FILE_OWNERSHIP=True, WORKERS_BACKEND='file_manager.ownership.MemoryWorkers',
+                       FORWARD_TIMEOUT=0.2)
+    async def test_apply_operation__owner_does_not_ack(self):
+        # the owner of the file is registered but does not read its channel
+        worker_id = get_ownership().worker_id
+        owner_id = next(f'owner_{index}' for index in count()
+                        if HashRing([worker_id, f'owner_{index}']).owner(self.file.pk) == f'owner_{index}')
+        await sync_to_async(load_workers('file_manager.ownership.MemoryWorkers').add)(owner_id, 'file_owner.dead!1')
+
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        await communicator.send_json_to({'type': 'apply_operation',
+                                         'revision': 0,
+                                         'operation': {'type': Operations.Type.INSERT,
+                                                       'position': 0,
+                                                       'text': "Hello!"}})
+        timeout_answer = json.loads((await communicator.receive_output(2))['text'])
+        self.assertEqual(timeout_answer['type'], 'apply_operation')
+        self.assertEqual(timeout_answer['error_code'], 4504)
+        self.assertEqual(get_ownership().pending, {})
+
+        await communicator.disconnect()
+        await get_ownership().stop()
+
+    async def test_run_file(self):
+        def save_content():
+            File.objects.filter(pk=self.file.pk).update(content="print('name?', flush=True)\n"
+                                                                "print('Hello,', input())\n")
+
+        await sync_to_async(save_content)()
+
+        # the file is run by the python of the tests instead of docker
+        with tempfile.TemporaryDirectory() as file_path, \
+                patch('file_manager.run_file.FILE_PATH', f'{file_path}/'), \
+                patch('file_manager.run_file.get_command',
+                      lambda filename, programming_language: [sys.executable, '-u', filename]):
+            communicator = WebsocketCommunicator(self.websocket_application,
+                                                 f"/files/{self.file.pk}/1278/")
+            await communicator.connect()
+
+            _ = await communicator.output_queue.get()  # channel_name
+            _ = await communicator.output_queue.get()  # file_status
+            _ = await communicator.output_queue.get()  # new_user
+
+            await communicator.send_json_to({'type': 'run_file'})
+            start_answer = json.loads((await communicator.output_queue.get())['text'])
+            self.assertDictEqual(start_answer, {'type': 'START run_file'})
+
+            # the output comes before the end of the run, a line can be read in parts
+            outputs = []
+            while ''.join(outputs) != 'name?\n':
+                file_output_answer = json.loads((await communicator.output_queue.get())['text'])
+                self.assertDictEqual(file_output_answer, {'type': 'file_output',
+                                                          'file_output': file_output_answer['file_output'],
+                                                          'index': len(outputs)})
+                outputs.append(file_output_answer['file_output'])
+
+            await communicator.send_json_to({'type': 'file_input', 'file_input': 'Igor'})
+            outputs = []
+            while True:
+                answer = json.loads((await communicator.output_queue.get())['text'])
+                if answer['type'] != 'file_output':
+                    break
+                outputs.append(answer['file_output'])
+
+            self.assertEqual(''.join(outputs), 'Hello, Igor\n')
+            self.assertDictEqual(answer, {'type': 'END run_file', 'exit_code': 0})
+            self.assertEqual(os.listdir(file_path), [])
+
+    async def run_file_outputs(self, content):
+        """
+        -> (the outputs of a run of the file with the content, END run_file)
+        """
+        await sync_to_async(File.objects.filter(pk=self.file.pk).update)(content=content)
+
+        with tempfile.TemporaryDirectory() as file_path, \
+                patch('file_manager.run_file.FILE_PATH', f'{file_path}/'), \
+                patch('file_manager.run_file.get_command',
+                      lambda filename, programming_language: [sys.executable, '-u', filename]):
+            communicator = WebsocketCommunicator(self.websocket_application,
+                                                 f"/files/{self.file.pk}/1278/")
+            await communicator.connect()
+
+            _ = await communicator.output_queue.get()  # channel_name
+            _ = await communicator.output_queue.get()  # file_status
+            _ = await communicator.output_queue.get()  # new_user
+
+            await communicator.send_json_to({'type': 'run_file'})
+            _ = await communicator.output_queue.get()  # START run_file
+
+            outputs = []
+            while True:
+                answer = json.loads((await communicator.output_queue.get())['text'])
+                if answer['type'] != 'file_output':
+                    return outputs, answer
+                self.assertEqual(answer['index'], len(outputs))
+                outputs.append(answer['file_output'])
+
+    @override_settings(RUN_OUTPUT_PACING_INTERVAL=500)
+    async def test_run_file__output_coalescing(self):
+        outputs, end_answer = await self.run_file_outputs("for i in range(1000):\n"
+                                                          "    print(i)\n")
+
+        self.assertEqual(''.join(outputs), ''.join(f'{i}\n' for i in range(1000)))
+        # the lines printed within the interval are sent together
+        self.assertLess(len(outputs), 10)
+        self.assertDictEqual(end_answer, {'type': 'END run_file', 'exit_code': 0})
+
+    @override_settings(RUN_OUTPUT_PACING_INTERVAL=0, RUN_OUTPUT_CHUNK_SIZE=64, RUN_OUTPUT_LIMIT=1000)
+    async def test_run_file__output_limit(self):
+        outputs, end_answer = await self.run_file_outputs("for i in range(10000):\n"
+                                                          "    print(i)\n")
+
+        self.assertEqual(''.join(outputs), ''.join(f'{i}\n' for i in range(10000))[:1000] + OUTPUT_TRUNCATED)
+        self.assertTrue(all(len(output) <= 64 for output in outputs[:-1]))
+        # the rest of the output is read, the program is not stopped by a full pipe
+        self.assertDictEqual(end_answer, {'type': 'END run_file', 'exit_code': 0})
+
+    @override_settings(RUN_OUTPUT_PACING_INTERVAL=0, RUN_OUTPUT_CHUNK_SIZE=63, RUN_OUTPUT_LIMIT=999)
+    async def test_run_file__output_limit_multibyte(self):
+        outputs, end_answer = await self.run_file_outputs("import sys\n"
+                                                          "sys.stdout.buffer.write('é'.encode() * 1000)\n")
+
+        # the output is cut at a character boundary
+        self.assertEqual(''.join(outputs), 'é' * 499 + OUTPUT_TRUNCATED)
+        self.assertDictEqual(end_answer, {'type': 'END run_file', 'exit_code': 0})
+
+    @override_settings(CURSOR_FLUSH_RATE=2)
+    async def test_change_cursor_position__coalescing(self):
+        # the first connection
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        # the second_connect
+        _ = await sync_to_async(CustomUser.objects.create_user)(username='Michael Scofield',
+                                                                email='1@mail.ru',
+                                                                password='15')
+        another_communicator = WebsocketCommunicator(self.websocket_application,
+                                                     f"/files/{self.file.pk}/1278/")
+        await another_communicator.connect()
+
+        _ = await another_communicator.output_queue.get()  # channel_name
+        _ = await another_communicator.output_queue.get()  # file_status
+        _ = await another_communicator.output_queue.get()  # new_user
+        _ = await communicator.output_queue.get()  # new_user
+
+        for position in range(3):
+            await communicator.send_json_to({'type': 'change_cursor_position',
+                                             'position': position})
+
+        # only the last cursor of the user is sent
+        change_cursor_answer = json.loads((await another_communicator.output_queue.get())['text'])
+        self.assertDictEqual(change_cursor_answer, {'type': 'change_cursor_position',
+                                                    'position': 2,
+                                                    'user_id': self.user.pk})
+        self.assertTrue(await another_communicator.receive_nothing(1))
+
+
+class AsyncFileEditorConsumerTestCase(FileEditorConsumerTestCase):
+    websocket_application = URLRouter(get_websocket_urlpatterns(AsyncFileEditorConsumer))
+
+    async def test_disconnect__document_lock(self):
+        communicator = WebsocketCommunicator(self.websocket_application,
+                                             f"/files/{self.file.pk}/1278/")
+        await communicator.connect()
+
+        _ = await communicator.output_queue.get()  # channel_name
+        _ = await communicator.output_queue.get()  # file_status
+        _ = await communicator.output_queue.get()  # new_user
+
+        # a transformation of another connection holds the lock of the document
+        document = DocumentsManager().get_document(self.file.pk)
+        is_locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with document.lock:
+                is_locked.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        is_locked.wait()
+
+        disconnect = asyncio.ensure_future(communicator.disconnect())
+        # the event loop goes on while the disconnect waits for the lock
+        started_at = time.monotonic()
+        await asyncio.sleep(0.2)
+        self.assertLess(time.monotonic() - started_at, 2)
+        self.assertFalse(disconnect.done())
+
+        release.set()
+        await disconnect
+        thread.join()